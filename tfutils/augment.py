@@ -0,0 +1,137 @@
+"""
+Batched image augmentation.
+
+The functions in this module operate on a whole batch of images of shape
+[batch, height, width, channels] at once.  Per-image random parameters (crop offsets,
+flips, color factors) are drawn by a single random op per function, so that with a fixed
+seed each image gets its own reproducible draw from one random stream, and the work is
+done by a handful of batched kernels instead of a per-image subgraph under tf.map_fn.
+"""
+from __future__ import absolute_import, division, print_function
+
+import tensorflow as tf
+
+
+def _pair(size):
+    if isinstance(size, (list, tuple)):
+        assert len(size) == 2, size
+        return tuple(size)
+    return (size, size)
+
+
+def _subseed(seed, offset):
+    return None if seed is None else seed + offset
+
+
+def crop(images, offsets, crop_size):
+    """
+    Crop every image of a batch at its own offset.
+
+    Arguments:
+        - images: tensor of shape [batch, height, width, channels], of any dtype
+        - offsets: int32 tensor of shape [batch, 2] with the [y, x] offset of each crop
+        - crop_size (int or pair of ints): size of the crops
+
+    The crops are gathered row-wise and then column-wise, so the dtype of the images is
+    preserved and no interpolation takes place.
+    """
+    crop_h, crop_w = _pair(crop_size)
+    n = tf.shape(images)[0]
+    channels = images.get_shape()[3]
+
+    batch_inds = tf.tile(tf.expand_dims(tf.range(n), 1), [1, crop_h])
+    rows = tf.expand_dims(offsets[:, 0], 1) + tf.range(crop_h)
+    images = tf.gather_nd(images, tf.stack([batch_inds, rows], axis=2))
+
+    images = tf.transpose(images, [0, 2, 1, 3])
+    batch_inds = tf.tile(tf.expand_dims(tf.range(n), 1), [1, crop_w])
+    cols = tf.expand_dims(offsets[:, 1], 1) + tf.range(crop_w)
+    images = tf.gather_nd(images, tf.stack([batch_inds, cols], axis=2))
+    images = tf.transpose(images, [0, 2, 1, 3])
+
+    images.set_shape([None, crop_h, crop_w, channels])
+    return images
+
+
+def random_crop(images, crop_size, seed=None):
+    """
+    Take an independent, uniformly placed crop_size crop of every image in the batch.
+    """
+    crop_h, crop_w = _pair(crop_size)
+    shape = tf.shape(images)
+    limits = tf.stack([shape[1] - crop_h + 1, shape[2] - crop_w + 1])
+    offsets = tf.random_uniform([shape[0], 2], seed=seed)
+    offsets = tf.cast(offsets * tf.cast(limits, tf.float32), tf.int32)
+    offsets = tf.minimum(offsets, limits - 1)
+    return crop(images, offsets, crop_size)
+
+
+def center_crop(images, crop_size):
+    """
+    Take the central crop_size crop of every image in the batch.
+    """
+    crop_h, crop_w = _pair(crop_size)
+    shape = tf.shape(images)
+    offset = tf.stack([(shape[1] - crop_h) // 2, (shape[2] - crop_w) // 2])
+    offsets = tf.tile(tf.expand_dims(offset, 0), [shape[0], 1])
+    return crop(images, offsets, crop_size)
+
+
+def random_flip_left_right(images, seed=None):
+    """
+    Mirror each image of the batch horizontally with probability 1/2.
+    """
+    flip = tf.random_uniform([tf.shape(images)[0]], seed=seed) < 0.5
+    return tf.where(flip, tf.reverse(images, [2]), images)
+
+
+def color_jitter(images, brightness=0., contrast=0., saturation=0., seed=None):
+    """
+    Randomly perturb brightness, contrast and saturation of each image of the batch.
+
+    The images are expected to be float RGB images with values in [0, 1].  Each image
+    gets a brightness delta uniform in [-brightness, brightness], and contrast and
+    saturation factors uniform in [1 - contrast, 1 + contrast] and
+    [1 - saturation, 1 + saturation] respectively.  Results are clipped to [0, 1].
+    """
+    n = tf.shape(images)[0]
+    factors = tf.random_uniform([n, 3], minval=-1., maxval=1., seed=seed)
+    factors = tf.reshape(factors, [n, 1, 1, 3])
+    if brightness:
+        images = images + brightness * factors[:, :, :, 0:1]
+    if contrast:
+        means = tf.reduce_mean(images, axis=[1, 2], keep_dims=True)
+        images = (images - means) * (1. + contrast * factors[:, :, :, 1:2]) + means
+    if saturation:
+        gray = tf.image.rgb_to_grayscale(images)
+        images = gray + (images - gray) * (1. + saturation * factors[:, :, :, 2:3])
+    return tf.clip_by_value(images, 0., 1.)
+
+
+def augment_images(images, crop_size, train=True, flip=False, jitter=None, seed=None):
+    """
+    Standard batched augmentation chain.
+
+    Arguments:
+        - images: uint8 or float tensor of shape [batch, height, width, channels]
+        - crop_size (int or pair of ints): size of the crops
+        - train (bool, default=True): if True, random crops (and the optional flips and
+          color jitter) are applied, otherwise images are center cropped.
+        - flip (bool, default=False): whether to randomly flip images left to right
+        - jitter (dict or None): if not None, keyword arguments of color_jitter
+        - seed (int or None): seed of the random streams.  The crop, flip and jitter ops
+          respectively use seed, seed + 1 and seed + 2.
+
+    Images are cropped before being converted to float32 in [0, 1], so that only the
+    pixels that are kept get converted.
+    """
+    if train:
+        images = random_crop(images, crop_size, seed=seed)
+    else:
+        images = center_crop(images, crop_size)
+    images = tf.image.convert_image_dtype(images, dtype=tf.float32)
+    if train and flip:
+        images = random_flip_left_right(images, seed=_subseed(seed, 1))
+    if train and jitter:
+        images = color_jitter(images, seed=_subseed(seed, 2), **jitter)
+    return images
@@ -25,7 +25,7 @@ from tensorflow.python.ops import variables
 import numpy as np
 
 import tfutils.utils as utils
-from tfutils.data import get_queue
+from tfutils.data import get_queue, STOPPABLE_PROVIDERS
 from tfutils.optimizer import ClipOptimizer
 from tfutils.error import HiLossError, NoGlobalStepError, NoChangeError
 from tfutils.utils import (sonify,
@@ -807,6 +807,9 @@ def start_queues(sess):
     """Helper function for starting queues before running processes."""
     coord = tf.train.Coordinator()
     threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+    # providers with worker processes stop them when the queues are stopped
+    for provider in sess.graph.get_collection(STOPPABLE_PROVIDERS):
+        threads.append(provider.stop_on(coord))
     return coord, threads
 
 
@@ -1465,6 +1468,12 @@ def get_data(func, queue_params=None, **data_params):
     assert len(input_ops) > 0, len(input_ops)
     batch_size = data_params['batch_size']
     data_params['func'] = func
+    if getattr(data_provider, 'skip_queue', False):
+        # the provider buffers batches itself, use its op directly
+        assert len(input_ops) == 1, len(input_ops)
+        assert queue_params['batch_size'] == batch_size, (queue_params['batch_size'], batch_size)
+        inputs = data_provider.postprocess_batch(input_ops[0])
+        return data_params, [], inputs
     enqueue_ops = []
     queue = get_queue(input_ops[0], shape_flag=batch_size!=1, **queue_params)
     for input_op in input_ops:
@@ -1479,6 +1488,8 @@ def get_data(func, queue_params=None, **data_params):
         inputs = queue.dequeue()
     else:
         inputs = queue.dequeue_many(queue_params['batch_size'])
+    if hasattr(data_provider, 'postprocess_batch'):
+        inputs = data_provider.postprocess_batch(inputs)
     return data_params, [queue], inputs
 
 
@@ -226,6 +226,153 @@ def standard_tests():
     print(gr)
 
 
+def imagenet_postproc_tests(crop_size=IMSIZE, nsteps=NSTEPS):
+    """
+    Compares the host-side cost of the ImageNet HDF5 postprocessing when converting the
+    full batch to float32 before cropping, and when cropping the uint8 batch (the float32
+    conversion then happens in the graph).  Reports time per batch and bytes per batch
+    that go through py_func and the queue.
+    """
+    ims = np.random.randint(0, 256, size=(BATCH_SIZE, 256, 256, 3)).astype(np.uint8)
+    off = (256 - crop_size) // 2
+
+    def float_then_crop(ims):
+        norm = ims.astype(np.float32) / 255.0
+        return norm[:, off: off + crop_size, off: off + crop_size]
+
+    def crop_uint8(ims):
+        return np.ascontiguousarray(ims[:, off: off + crop_size, off: off + crop_size])
+
+    durs = []
+    for func in [float_then_crop, crop_uint8]:
+        for step in range(nsteps):
+            start_time = time.time()
+            out = func(ims)
+            durs.append([func.__name__, step, time.time() - start_time, out.nbytes])
+    df = pandas.DataFrame(durs, columns=['kind', 'stepno', 'dur', 'bytes'])
+    print(df.groupby('kind')[['dur', 'bytes']].mean())
+    return df
+
+
+class RandomBatchReader(object):
+    """
+    Reader producing constant random float32 image batches, to time batch transport alone.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, subslice=None, shape=(IMSIZE, IMSIZE, 3)):
+        self.data_length = BATCH_SIZE * NSTEPS if subslice is None else len(subslice)
+        self.subsliceinds = np.arange(self.data_length)
+        self.labels = ['data', 'labels']
+        self._data = np.random.randn(batch_size, *shape).astype(np.float32)
+        self._labels = np.random.randint(0, 1000, size=[batch_size]).astype(np.int64)
+
+    def next(self):
+        return [self._data, self._labels]
+
+
+def transport_tests(n_workers=2, nsteps=NSTEPS):
+    """
+    Times the delivery of 256x224x224x3 float32 batches: produced in the tensorflow
+    threads (ParallelBySliceProvider), produced in worker processes and pickled through
+    multiprocessing queues, and produced in worker processes and written into shared memory
+    (with and without the tensorflow queue).
+    """
+    configs = [('py_func', data.ParallelBySliceProvider, {}, False),
+               ('process pool (queue)', data.ProcessPoolProvider,
+                {'n_workers': n_workers, 'transport': 'queue'}, False),
+               ('process pool (shm)', data.ProcessPoolProvider,
+                {'n_workers': n_workers, 'transport': 'shm'}, False),
+               ('process pool (shm, no tf queue)', data.ProcessPoolProvider,
+                {'n_workers': n_workers, 'transport': 'shm', 'skip_queue': True}, True)]
+    durs = []
+    for kind, provider, kwargs, skip_queue in configs:
+        tf.reset_default_graph()
+        dp = provider(RandomBatchReader, {}, batch_size=BATCH_SIZE, n_threads=1, **kwargs)
+        ops = dp.init_ops()
+        if skip_queue:
+            inputs = ops[0]
+        else:
+            queue = data.get_queue(ops[0], queue_type='fifo', batch_size=BATCH_SIZE)
+            tf.train.queue_runner.add_queue_runner(
+                tf.train.queue_runner.QueueRunner(queue, [queue.enqueue_many(ops[0])]))
+            inputs = queue.dequeue_many(BATCH_SIZE)
+        sess = tf.Session()
+        coord, threads = base.start_queues(sess)
+        sess.run(inputs)
+        for step in tqdm.trange(nsteps, desc='running ' + kind):
+            start_time = time.time()
+            sess.run(inputs)
+            durs.append([kind, step, time.time() - start_time])
+        coord.request_stop()
+        if hasattr(dp, 'stop'):
+            dp.stop()
+        sess.close()
+    df = pandas.DataFrame(durs, columns=['kind', 'stepno', 'dur'])
+    print(df.groupby('kind').dur.agg([np.mean, np.median, np.std]))
+    return df
+
+
+def _timeit(func, *args, **kwargs):
+    nrep = kwargs.pop('nrep', 3)
+    durs = []
+    for _ in range(nrep):
+        start_time = time.time()
+        func(*args, **kwargs)
+        durs.append(time.time() - start_time)
+    return min(durs)
+
+
+def data_utils_tests(n=2 * 10 ** 6, n_labels=1000, block_size=BATCH_SIZE, n_blocks=100):
+    """
+    Microbenchmarks of the array utilities used when constructing HDF5 readers, against
+    the previous (sort/list based) implementations.
+    """
+    def perminverse_lists(s):
+        X = np.array(range(len(s)))
+        X[s] = range(len(s))
+        return X
+
+    def isin_sort(X, Y):
+        T = Y.copy()
+        T.sort()
+        D = T.searchsorted(X)
+        T = np.append(T, np.array([0]))
+        return T[D] == X
+
+    def unique_labels_argsort(larray):
+        labels_unique = np.unique(larray)
+        s = larray.argsort()
+        cat_s = larray[s]
+        ss = np.array([0] + ((cat_s[1:] != cat_s[:-1]).nonzero()[0] + 1).tolist() + [len(cat_s)])
+        labels = np.repeat(np.arange(len(labels_unique)), ss[1:] - ss[:-1])
+        return labels[perminverse_lists(s)]
+
+    rng = np.random.RandomState(0)
+    perm = rng.permutation(n)
+    labels = rng.randint(0, n_labels, size=n).astype(np.int64)
+    subslice = np.sort(rng.choice(n, size=n // 10, replace=False))
+    blocks = [np.arange(i * block_size, (i + 1) * block_size) for i in range(n_blocks)]
+
+    def isin_blocks(Y):
+        for b in blocks:
+            data.isin(b, Y)
+
+    def isin_sort_blocks(Y):
+        for b in blocks:
+            isin_sort(b, Y)
+
+    durs = [['perminverse', 'lists', _timeit(perminverse_lists, perm)],
+            ['perminverse', 'vectorized', _timeit(data.perminverse, perm)],
+            ['get_unique_labels', 'argsort', _timeit(unique_labels_argsort, labels)],
+            ['get_unique_labels', 'unique', _timeit(data.get_unique_labels, labels)],
+            ['isin x %d' % n_blocks, 'sort per call', _timeit(isin_sort_blocks, subslice)],
+            ['isin x %d' % n_blocks, 'Membership reused',
+             _timeit(lambda: isin_blocks(data.Membership(subslice)))]]
+    df = pandas.DataFrame(durs, columns=['function', 'implementation', 'dur'])
+    print(df)
+    return df
+
+
 def search_queue_params():
     df = []
 
@@ -0,0 +1,426 @@
+"""
+Dataset format converters.
+
+Fixed-shape attributes (images, labels, means, ...) can be stored in a columnar format of
+memory-mapped .npy shards, which NpyShardsProvider reads with no parsing or decoding.  A
+dataset in this format is a directory with one subdirectory per attribute, holding one
+.npy file per shard, and a manifest (see tfutils/manifest.py) listing the shards, their
+record counts and the attribute metadata:
+    dataset/
+        manifest.pkl
+        images/00000.npy, images/00001.npy, ...
+        labels/00000.npy, labels/00001.npy, ...
+
+This module writes such datasets (NpyShardWriter) and converts HDF5 files and TFRecords
+datasets to them.  It also converts HDF5 files to TFRecords datasets, as read by
+TFRecordsParallelByFileProvider (hdf5_to_tfrecords), with a pool of worker processes.
+
+Usage:
+    python -m tfutils.convert hdf5-to-npy input.hdf5 output_dir [--keys images labels]
+    python -m tfutils.convert tfrecords-to-npy output_dir source_dir1 [source_dir2 ...]
+    python -m tfutils.convert hdf5-to-tfrecords input.hdf5 output_dir [--image-size 256 256]
+                              [--encoding jpeg] [--compression GZIP] [--workers 8]
+                              [--pack 256]
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import io
+import fnmatch
+import cPickle
+import itertools
+import argparse
+import multiprocessing
+
+import numpy as np
+import h5py
+import tensorflow as tf
+
+from tfutils import data
+from tfutils import manifest
+
+DEFAULT_SHARD_RECORDS = 2 ** 14
+DEFAULT_BLOCK_ROWS = 2 ** 12
+DEFAULT_TFRECORDS_SHARD_RECORDS = 1024
+IMAGE_ENCODINGS = {'jpeg': ('JPEG', {'quality': 95}),
+                   'png': ('PNG', {})}
+
+
+class NpyShardWriter(object):
+    """
+    Writer of a dataset in the columnar .npy shard format.
+
+    Arguments:
+        - directory (str): output directory
+        - meta (dict): attribute metadata, {attr: {'dtype': ..., 'shape': ...}}, with the
+          dtype as a tensorflow or numpy dtype and the shape of one record
+        - shard_records (int): number of records per shard (the last shard may be smaller)
+
+    Batches of records are added with write, and close writes the last shard and the
+    manifest, which it returns.
+    """
+    def __init__(self, directory, meta, shard_records=DEFAULT_SHARD_RECORDS):
+        self.directory = directory
+        self.meta = {k: {'dtype': tf.as_dtype(meta[k]['dtype']), 'shape': list(meta[k]['shape'])}
+                     for k in meta}
+        self.attrs = sorted(self.meta)
+        self.shard_records = shard_records
+        self.buffers = {k: [] for k in self.attrs}
+        self.buffered = 0
+        self.files = []
+        for attr in self.attrs:
+            if not os.path.isdir(os.path.join(directory, attr)):
+                os.makedirs(os.path.join(directory, attr))
+
+    def write(self, batch):
+        """Add a batch of records, given as a dict of arrays with one row per record."""
+        n = len(batch[self.attrs[0]])
+        for attr in self.attrs:
+            dtype = self.meta[attr]['dtype'].as_numpy_dtype
+            arr = np.asarray(batch[attr], dtype=dtype)
+            assert len(arr) == n, 'All attributes must have the same number of records'
+            self.buffers[attr].append(arr.reshape([n] + self.meta[attr]['shape']))
+        self.buffered += n
+        while self.buffered >= self.shard_records:
+            self.flush(self.shard_records)
+
+    def flush(self, n):
+        name = '%05d' % len(self.files)
+        nbytes = 0
+        for attr in self.attrs:
+            arr = np.concatenate(self.buffers[attr])
+            path = manifest.npy_shard_path(self.directory, attr, name)
+            np.save(path, arr[:n])
+            nbytes += os.path.getsize(path)
+            self.buffers[attr] = [arr[n:]]
+        self.buffered -= n
+        self.files.append({'name': name, 'bytes': nbytes, 'mtime': None, 'records': n, 'crc32': None})
+
+    def close(self):
+        if self.buffered:
+            self.flush(self.buffered)
+        m = {'version': manifest.MANIFEST_VERSION,
+             'format': manifest.NPY_FORMAT,
+             'file_pattern': None,
+             'files': self.files,
+             'meta': self.meta,
+             'compression': None}
+        manifest.write_manifest(self.directory, m)
+        return m
+
+
+def hdf5_to_npy(hdf5source, directory, keys=None,
+                shard_records=DEFAULT_SHARD_RECORDS,
+                block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Convert the datasets keys (by default all top-level datasets) of the HDF5 file
+    hdf5source, which must have the same length, to the .npy shard format in directory.
+    The data is copied block_rows rows at a time.  Returns the manifest.
+    """
+    with h5py.File(hdf5source, 'r') as f:
+        if keys is None:
+            keys = [k for k in f.keys() if isinstance(f[k], h5py.Dataset)]
+        lens = [len(f[k]) for k in keys]
+        assert all([l == lens[0] for l in lens]), lens
+        meta = {k: {'dtype': f[k].dtype, 'shape': f[k].shape[1:]} for k in keys}
+        writer = NpyShardWriter(directory, meta, shard_records=shard_records)
+        for start in range(0, lens[0], block_rows):
+            writer.write({k: f[k][start: start + block_rows] for k in keys})
+    return writer.close()
+
+
+def tfrecords_to_npy(source_dirs, directory,
+                     meta_dicts=None,
+                     trans_dicts=None,
+                     file_pattern=data.DEFAULT_TFRECORDS_GLOB_PATTERN,
+                     batch_size=256,
+                     shard_records=DEFAULT_SHARD_RECORDS):
+    """
+    Convert a TFRecords dataset, as read by TFRecordsParallelByFileProvider with the same
+    source_dirs, meta_dicts, trans_dicts and file_pattern, to the .npy shard format in
+    directory.  Records are decoded by the standard postprocessing (raw bytes and encoded
+    images), batch_size records at a time; all attributes must decode to fixed-shape arrays.
+    Returns the manifest.
+    """
+    source_dirs = data.listify(source_dirs)
+    parsed_meta_dicts = data.parse_standard_tfmeta(source_dirs)
+    compressions = data.get_compressions(parsed_meta_dicts)
+    source_paths = data.get_data_paths(source_dirs, data.get_file_patterns(file_pattern, compressions))
+    meta_dicts = data.complete_metadata(meta_dicts, parsed_meta_dicts)
+    packings = data.get_packings(meta_dicts)
+    assert len(set(packings)) == 1, 'All attribute groups must have the same packing: %s' % packings
+    meta_dict, parser_list = data.merge_meta(meta_dicts, trans_dicts)
+    for k in meta_dict:
+        assert meta_dict[k]['dtype'] != tf.string or meta_dict[k].get('format'), \
+            'Attribute %s is not decoded to an array' % k
+
+    graph = tf.Graph()
+    with graph.as_default():
+        serialized = [tf.placeholder(tf.string, [None]) for _ in source_dirs]
+        ops = {}
+        for j, parsers in enumerate(parser_list):
+            op = tf.parse_example(serialized[j], parsers)
+            if trans_dicts and trans_dicts[j]:
+                for k in trans_dicts[j]:
+                    if k in op:
+                        op[trans_dicts[j][k]] = op.pop(k)
+            ops.update(op)
+        ops = data.apply_postprocess(ops, data.add_standard_postprocessing(None, meta_dict))
+    sess = tf.Session(graph=graph)
+
+    options = [tf.python_io.TFRecordOptions(data.TFRECORDS_COMPRESSION_TYPES[c]) if c else None
+               for c in compressions]
+    writer = NpyShardWriter(directory, meta_dict, shard_records=shard_records)
+    for paths in zip(*source_paths):
+        records = itertools.izip(*[tf.python_io.tf_record_iterator(path, options=opts)
+                                   for path, opts in zip(paths, options)])
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            feed_dict = {s: [r[j] for r in batch] for j, s in enumerate(serialized)}
+            writer.write(sess.run(ops, feed_dict=feed_dict))
+    sess.close()
+    return writer.close()
+
+
+def is_image(shape):
+    return len(shape) == 3 and shape[2] == 3
+
+
+def get_record_meta(dataset, image_shape=None, encoding=None):
+    """
+    Metadata of the attribute written from the HDF5 dataset: strings are stored as tf.string,
+    booleans as uint8, and images (of shape [height, width, 3]) are resized to image_shape
+    and encoded with encoding if these are given.
+    """
+    dtype = dataset.dtype
+    shape = list(dataset.shape[1:])
+    if dtype.kind in 'SUO':
+        return {'dtype': tf.string, 'shape': []}
+    if dtype == np.bool_:
+        dtype = np.uint8
+    meta = {'dtype': tf.as_dtype(dtype), 'shape': shape}
+    if is_image(shape):
+        if image_shape is not None:
+            meta['shape'] = list(image_shape) + [3]
+        if encoding is not None:
+            assert meta['dtype'] == tf.uint8, 'Only uint8 images can be encoded'
+            assert encoding in IMAGE_ENCODINGS, 'Unknown image encoding %s' % encoding
+            meta['format'] = encoding
+    return meta
+
+
+def resize_image(image, shape):
+    from PIL import Image
+    return np.array(Image.fromarray(image).resize((shape[1], shape[0]), Image.BICUBIC))
+
+
+def encode_image(image, encoding):
+    from PIL import Image
+    fmt, kwargs = IMAGE_ENCODINGS[encoding]
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+
+def to_feature(value, meta):
+    """tf.train.Feature holding one record value of an attribute with metadata meta."""
+    dtype = meta['dtype']
+    if meta.get('format') is not None or is_image(meta['shape']):
+        if list(value.shape) != meta['shape']:
+            value = resize_image(value, meta['shape'])
+        if meta.get('format') is not None:
+            return tf.train.Feature(bytes_list=tf.train.BytesList(value=[encode_image(value, meta['format'])]))
+    if dtype == tf.string:
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(value)]))
+    elif dtype == tf.float32:
+        return tf.train.Feature(float_list=tf.train.FloatList(value=np.ravel(value).tolist()))
+    elif dtype == tf.int64:
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=np.ravel(value).tolist()))
+    value = np.asarray(value, dtype=dtype.as_numpy_dtype)
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value.tostring()]))
+
+
+def to_packed_feature(values, meta):
+    """tf.train.Feature holding the raw bytes of the consecutive record values of a packed attribute."""
+    if list(values.shape[1:]) != meta['shape']:
+        values = [resize_image(value, meta['shape']) for value in values]
+    values = np.asarray(values, dtype=meta['dtype'].as_numpy_dtype)
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[values.tostring()]))
+
+
+def get_tfrecords_options(compression):
+    if compression is None:
+        return None
+    return tf.python_io.TFRecordOptions(data.TFRECORDS_COMPRESSION_TYPES[compression])
+
+
+def shard_name(shard):
+    return '%05d.tfrecords' % shard
+
+
+def _write_tfrecords_shard(args):
+    """Write records [start, stop) of each key of hdf5source to the shard files of shard."""
+    hdf5source, directory, metas, shard, start, stop, block_rows, compression, pack = args
+    options = get_tfrecords_options(compression)
+    paths = {k: os.path.join(directory, k, shard_name(shard)) for k in metas}
+    writers = {k: tf.python_io.TFRecordWriter(paths[k] + manifest.PARTIAL_FILE_SUFFIX, options=options)
+               for k in metas}
+    with h5py.File(hdf5source, 'r') as f:
+        for b0 in range(start, stop, block_rows):
+            b1 = min(b0 + block_rows, stop)
+            for k in metas:
+                values = f[k][b0: b1]
+                if pack:
+                    features = [to_packed_feature(values[p: p + pack], metas[k])
+                                for p in range(0, len(values), pack)]
+                else:
+                    features = [to_feature(value, metas[k]) for value in values]
+                for feature in features:
+                    datum = tf.train.Example(features=tf.train.Features(feature={k: feature}))
+                    writers[k].write(datum.SerializeToString())
+    for k in metas:
+        writers[k].close()
+        os.rename(paths[k] + manifest.PARTIAL_FILE_SUFFIX, paths[k])
+    return shard, stop - start
+
+
+def hdf5_to_tfrecords(hdf5source, directory,
+                      keys=None,
+                      shard_records=DEFAULT_TFRECORDS_SHARD_RECORDS,
+                      image_shape=None,
+                      encoding=None,
+                      compression=None,
+                      n_workers=None,
+                      block_rows=None,
+                      pack=None):
+    """
+    Convert the datasets keys (by default all top-level datasets) of the HDF5 file
+    hdf5source, which must have the same length, to TFRecords files.
+
+    Each key is written to its own attribute group directory, directory/key, with one
+    tf.train.Example per record, in shards of shard_records records named 00000.tfrecords,
+    00001.tfrecords, ...  The last shard holds the remaining records, however few.  The
+    shards are written concurrently by n_workers processes (by default one per CPU), each
+    reading its records from the HDF5 file in blocks of block_rows rows (by default the
+    largest multiple of the chunk rows of the datasets up to 256, or the chunk rows if
+    larger).  shard_records is rounded up to a multiple of block_rows, so that shard
+    boundaries fall on chunks.  Shards (and partial shards) left in the attribute group
+    directories by an earlier conversion are removed first.
+
+    Images (uint8 datasets of shape [N, height, width, 3]) are resized to image_shape
+    ([height, width]) if given, and encoded with encoding ('jpeg' or 'png') if given; other
+    data is stored as int64 or float lists or raw bytes (see get_record_meta).  The files can
+    be compressed with compression ('GZIP' or 'ZLIB').
+
+    If pack is not None, each Example holds the raw bytes of pack consecutive records (the
+    last one of the dataset possibly fewer), declared by a "packed" key in the metadata, which
+    makes small attributes much faster to parse (see TFRecordsParallelByFileProvider).  All
+    keys are then packed, and none can be a string or an encoded image.  block_rows is rounded
+    up to a multiple of pack.
+
+    Each attribute group directory gets a meta.pkl file and a manifest (see
+    tfutils/manifest.py).  Returns the dict of the manifests of the keys.
+    """
+    with h5py.File(hdf5source, 'r') as f:
+        if keys is None:
+            keys = [k for k in f.keys() if isinstance(f[k], h5py.Dataset)]
+        lens = [len(f[k]) for k in keys]
+        assert all([l == lens[0] for l in lens]), lens
+        N = lens[0]
+        metas = {k: get_record_meta(f[k], image_shape=image_shape, encoding=encoding) for k in keys}
+        if block_rows is None:
+            chunk_rows = [f[k].chunks[0] for k in keys if f[k].chunks is not None]
+            cr = max(chunk_rows) if chunk_rows else 1
+            block_rows = max(1, 256 // cr) * cr
+    if pack is not None:
+        block_rows = ((block_rows - 1) // pack + 1) * pack
+        for k in keys:
+            assert metas[k]['dtype'] != tf.string and metas[k].get('format') is None, \
+                'Attribute %s cannot be packed' % k
+            metas[k]['packed'] = pack
+    shard_records = ((shard_records - 1) // block_rows + 1) * block_rows
+    if compression is not None:
+        assert compression in data.TFRECORDS_COMPRESSION_TYPES, 'Unknown compression %s' % compression
+        for k in keys:
+            metas[k]['compression'] = compression
+
+    for k in keys:
+        if not os.path.isdir(os.path.join(directory, k)):
+            os.makedirs(os.path.join(directory, k))
+        for name in fnmatch.filter(os.listdir(os.path.join(directory, k)),
+                                   manifest.DEFAULT_FILE_PATTERN + '*'):
+            os.remove(os.path.join(directory, k, name))
+        with open(os.path.join(directory, k, 'meta.pkl'), 'w') as meta_file:
+            cPickle.dump({k: metas[k]}, meta_file)
+
+    tasks = [(hdf5source, directory, metas, shard, start, min(start + shard_records, N), block_rows,
+              compression, pack)
+             for shard, start in enumerate(range(0, N, shard_records))]
+    records = {}
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for shard, n in pool.imap_unordered(_write_tfrecords_shard, tasks):
+            records[shard_name(shard)] = n
+    finally:
+        pool.close()
+        pool.join()
+
+    manifests = {}
+    for k in keys:
+        m = manifest.build_manifest(os.path.join(directory, k),
+                                    count=lambda path, c: records[os.path.basename(path)])
+        manifest.write_manifest(os.path.join(directory, k), m)
+        manifests[k] = m
+    return manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert datasets between formats.')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('hdf5-to-npy', help='convert an HDF5 file to .npy shards')
+    p.add_argument('source', help='input HDF5 file')
+    p.add_argument('dest', help='output directory')
+    p.add_argument('--keys', nargs='*', default=None, help='datasets to convert (default: all)')
+    p.add_argument('--shard-records', type=int, default=DEFAULT_SHARD_RECORDS, help='records per shard')
+    p = subparsers.add_parser('tfrecords-to-npy', help='convert a TFRecords dataset to .npy shards')
+    p.add_argument('dest', help='output directory')
+    p.add_argument('sources', nargs='+', help='TFRecords directories, one per attribute group')
+    p.add_argument('--shard-records', type=int, default=DEFAULT_SHARD_RECORDS, help='records per shard')
+    p = subparsers.add_parser('hdf5-to-tfrecords', help='convert an HDF5 file to TFRecords shards')
+    p.add_argument('source', help='input HDF5 file')
+    p.add_argument('dest', help='output directory')
+    p.add_argument('--keys', nargs='*', default=None, help='datasets to convert (default: all)')
+    p.add_argument('--shard-records', type=int, default=DEFAULT_TFRECORDS_SHARD_RECORDS,
+                   help='records per shard')
+    p.add_argument('--image-size', type=int, nargs=2, default=None, help='height and width of resized images')
+    p.add_argument('--encoding', default=None, choices=sorted(IMAGE_ENCODINGS), help='image encoding')
+    p.add_argument('--compression', default=None, choices=sorted(data.TFRECORDS_COMPRESSION_TYPES),
+                   help='compression of the files')
+    p.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    p.add_argument('--pack', type=int, default=None, help='records packed in each Example')
+    args = parser.parse_args()
+    if args.command == 'hdf5-to-tfrecords':
+        manifests = hdf5_to_tfrecords(args.source, args.dest,
+                                      keys=args.keys,
+                                      shard_records=args.shard_records,
+                                      image_shape=args.image_size,
+                                      encoding=args.encoding,
+                                      compression=args.compression,
+                                      n_workers=args.workers,
+                                      pack=args.pack)
+        for k in sorted(manifests):
+            m = manifests[k]
+            print('%s: %d shards, %d records' % (os.path.join(args.dest, k), len(m['files']),
+                                                 sum([f['records'] for f in m['files']])))
+        return
+    if args.command == 'hdf5-to-npy':
+        m = hdf5_to_npy(args.source, args.dest, keys=args.keys, shard_records=args.shard_records)
+    else:
+        m = tfrecords_to_npy(args.sources, args.dest, shard_records=args.shard_records)
+    print('%s: %d shards, %d records' % (args.dest, len(m['files']), sum([f['records'] for f in m['files']])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,31 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import sys
+import glob
 import functools
 import itertools
 import copy
 import cPickle
+import hashlib
+import tempfile
+import shutil
+import collections
 import logging
 import threading
+import Queue
+import atexit
+import traceback
+import multiprocessing
 
 import numpy as np
 import h5py
 import tensorflow as tf
 from tensorflow.contrib.learn.python.learn.datasets.mnist import read_data_sets
 
+from tfutils import augment
+from tfutils import manifest
+from tfutils.error import WorkerError
 from tfutils.utils import isstring
 
 logging.basicConfig()
@@ -31,6 +44,18 @@ class DataProviderBase(object):
         """
         raise NotImplementedError()
 
+    def postprocess_batch(self, inputs):
+        """
+        Hook applied by base.get_data to the dictionary of tensors dequeued from the
+        data queue.  By default it is the identity; providers that defer work until
+        after the queue (see ParallelByFileProviderBase) override it.
+        """
+        return inputs
+
+
+DEFAULT_STAGING_BYTES = 2 ** 34
+SHORT_FILE_QUEUE_CAPACITY = 2
+
 
 class ParallelByFileProviderBase(DataProviderBase):
     def __init__(self,
@@ -42,6 +67,16 @@ class ParallelByFileProviderBase(DataProviderBase):
                  read_args=None,
                  read_kwargs=None,
                  trans_dicts=None,
+                 postprocess_after_dequeue=False,
+                 staging_dir=None,
+                 staging_bytes=DEFAULT_STAGING_BYTES,
+                 staging_lookahead=None,
+                 balance=False,
+                 file_weights=None,
+                 readahead=0,
+                 drop_consumed=False,
+                 epoch_order='cycle',
+                 page_cache_bytes=None,
                  **kwargs):
         """
         This is a base class for parallelizing data reading across large groups of (small-ish)
@@ -115,6 +150,63 @@ class ParallelByFileProviderBase(DataProviderBase):
           given attribute produced by the j-th group does not appear in d_j, the original
           attribute name is retained.
 
+        - postprocess_after_dequeue (bool, default=False): if True, the postprocess operations
+          are not applied to the per-thread input ops.  Instead the queue stores the data as
+          read (e.g. raw serialized or encoded bytes), and the postprocessing chain is applied
+          once, vectorized over the dequeued batch, by calling postprocess_batch on the output
+          of the dequeue (base.get_data does this automatically).  This cuts the memory held
+          in queues and shuffle buffers, and avoids copying the postprocessing subgraph
+          n_threads times.  Postprocessing functions must then accept a batch of data,
+          which is the case for the standard decode_raw/reshape postprocessing.
+
+        - staging_dir (str or None): if not None, a local scratch directory (e.g. on a local
+          SSD) to which the files are copied in the background by a StagingCache, ahead of
+          the readers, for datasets living on network filesystems.  Once a local copy
+          exists, the file queues hand it to the readers instead of the original path.
+
+        - staging_bytes (int): byte budget of the local copies; least recently read copies
+          are evicted to stay within it.
+
+        - staging_lookahead (int or None): number of files (per attribute group) staged ahead
+          of the file queues; by default 2 * n_threads.
+
+        - balance (bool, default=False): if True, the files are handed out to the threads by
+          a BalancedFileScheduler, which splits each epoch's files between threads so that
+          they get about the same amount of data rather than the same number of files, and
+          lets threads that run out of files take the pending files of the others.
+
+        - file_weights (list of numbers or None): amount of data of each file (tuple of files
+          across attribute groups), used if balance is True.  By default, the total byte size
+          of the files.  balance can also be 'records', in which case file_weights must be
+          given (the record counts of the files).
+
+        - readahead (int, default=0): number of upcoming files of each thread whose reading
+          is started ahead of the readers by a FileReadAhead (with posix_fadvise(WILLNEED),
+          or background sequential reads where fadvise is not available), so that readers
+          do not wait for cold I/O at file boundaries.  Only applies to local files.
+
+        - drop_consumed (bool, default=False): if True, the pages of files that have been
+          read are dropped from the page cache (posix_fadvise(DONTNEED)), so that one-shot
+          training data does not evict more useful pages.  A file is considered read once
+          each thread has been handed a few more files; dropping the pages of a file that
+          is still being read only costs re-reading them.
+
+        - epoch_order (str, default='cycle'): order of the files across epochs (see
+          cache_aware_cycle), for datasets slightly larger than memory, where reading files
+          in the same order every epoch evicts each file from the page cache just before it
+          is read again:
+              - 'cycle': the same order every epoch (or a new random order if shuffle)
+              - 'alternate': alternately forwards and backwards, so that each epoch starts
+                with the files read last
+              - 'rotate': each epoch starts with the last files of the previous epoch that
+                fit in page_cache_bytes, followed by the others in the same order
+          With shuffle=True, 'alternate' and 'rotate' both bias the random order of each
+          epoch: the files read last in the previous epoch that fit in page_cache_bytes come
+          first, in random order, followed by the others in random order.
+
+        - page_cache_bytes (int or None): amount of file data expected to stay in the page
+          cache, used by epoch_order; by default half of the physical memory.
+
         - **kwargs: any other keyword arguments are simple attached to the object for use
           by subclasses.
         """
@@ -125,6 +217,7 @@ class ParallelByFileProviderBase(DataProviderBase):
         self.n_attrs = len(self.source_paths)
         self.n_threads = n_threads
         self.postprocess = {} if postprocess is None else postprocess
+        self.postprocess_after_dequeue = postprocess_after_dequeue
         if read_args is not None:
             assert len(read_args) == self.n_attrs
         else:
@@ -141,7 +234,26 @@ class ParallelByFileProviderBase(DataProviderBase):
         for _k in kwargs:
             setattr(self, _k, kwargs[_k])
 
-        if self.n_attrs == 1:
+        self.staging = None
+        if staging_dir is not None:
+            # file names are resolved when they enter the file queues, so keep these short
+            # and protect the copies that are queued or being read from eviction
+            protect = (SHORT_FILE_QUEUE_CAPACITY + 2) * self.n_threads * self.n_attrs
+            self.staging = StagingCache(staging_dir, staging_bytes, protect=protect)
+            if staging_lookahead is None:
+                staging_lookahead = 2 * self.n_threads
+
+        self.readahead = None
+        if readahead or drop_consumed:
+            self.readahead = FileReadAhead()
+
+        assert epoch_order in ['cycle', 'alternate', 'rotate'], epoch_order
+        assert not (balance and epoch_order != 'cycle'), 'balance uses its own file order'
+        assert balance in [False, True, 'records'], balance
+        assert balance != 'records' or file_weights is not None, \
+            'balance="records" needs the record counts of the files as file_weights'
+        if self.n_attrs == 1 and self.staging is None and self.readahead is None and not balance \
+                and epoch_order == 'cycle':
             fq = tf.train.string_input_producer(self.source_paths[0],
                                                 shuffle=shuffle,
                                                 seed=shuffle_seed)
@@ -149,41 +261,80 @@ class ParallelByFileProviderBase(DataProviderBase):
         else:
             self.file_queues = []
             tuples = zip(*self.source_paths)
-            if shuffle:
-                rng = np.random.RandomState(seed=shuffle_seed)
-                tuples = random_cycle(tuples, rng)
+            capacity = 32
+            # number of files handed to a thread after which its earlier files are done
+            consumed_after = (SHORT_FILE_QUEUE_CAPACITY + 2) if drop_consumed else None
+            if balance:
+                if file_weights is None:
+                    file_weights = [sum([tf.gfile.Stat(path).length for path in t]) for t in tuples]
+                self.scheduler = BalancedFileScheduler(tuples, file_weights, self.n_threads,
+                                                       shuffle=shuffle, seed=shuffle_seed)
+                thread_tuples = [ScheduledFiles(self.scheduler, n) for n in range(self.n_threads)]
+                if self.staging is not None:
+                    lookahead = max(1, staging_lookahead // self.n_threads)
+                    thread_tuples = [StagedIterator(t, self.staging, lookahead) for t in thread_tuples]
+                if self.readahead is not None:
+                    thread_tuples = [ReadAheadIterator(t, self.readahead, readahead, consumed_after)
+                                     for t in thread_tuples]
+                # files are handed out when the readers need them
+                capacity = SHORT_FILE_QUEUE_CAPACITY
             else:
-                tuples = itertools.cycle(tuples)
-            tuples = threadsafe_iter(tuples)
+                rng = np.random.RandomState(seed=shuffle_seed) if shuffle else None
+                if epoch_order != 'cycle':
+                    if page_cache_bytes is None:
+                        page_cache_bytes = get_page_cache_bytes()
+                    if file_weights is None:
+                        file_weights = [sum([tf.gfile.Stat(path).length for path in t]) for t in tuples]
+                    tuples = cache_aware_cycle(tuples, file_weights, page_cache_bytes,
+                                               order=epoch_order, rng=rng)
+                elif shuffle:
+                    tuples = random_cycle(tuples, rng)
+                else:
+                    tuples = itertools.cycle(tuples)
+                if self.staging is not None:
+                    tuples = StagedIterator(tuples, self.staging, staging_lookahead)
+                    capacity = SHORT_FILE_QUEUE_CAPACITY
+                if self.readahead is not None:
+                    if consumed_after is not None:
+                        consumed_after *= self.n_threads
+                    tuples = ReadAheadIterator(tuples, self.readahead,
+                                               readahead * self.n_threads, consumed_after)
+                    capacity = SHORT_FILE_QUEUE_CAPACITY
+                thread_tuples = [threadsafe_iter(tuples)] * self.n_threads
             for n in range(self.n_threads):
-                coord = Coordinator(tuples, n)
+                coord = Coordinator(thread_tuples[n], n)
                 fqs = []
                 for j in range(self.n_attrs):
                     item = Item(coord, j)
                     func = tf.py_func(item.next, [], [tf.string])
-                    fq = tf.train.string_input_producer(func, shuffle=False)
+                    fq = tf.train.string_input_producer(func, shuffle=False, capacity=capacity)
                     fqs.append(fq)
                 self.file_queues.append(fqs)
 
     def init_ops(self):
-        self.input_ops = []
-        for thread_num in range(self.n_threads):
-            op = {}
-            for attr_num in range(self.n_attrs):
-                fq = self.file_queues[thread_num][attr_num]
-                args = self.read_args[attr_num]
-                kwargs = self.read_kwargs[attr_num]
-                _op = self.get_input_op(fq, *args, **kwargs)
-                if self.trans_dicts and self.trans_dicts[attr_num]:
-                    td = self.trans_dicts[attr_num]
-                    for k in td:
-                        if k in _op:
-                            _op[td[k]] = _op.pop(k)
-                op.update(_op)
-            self.input_ops.append(op)
-        self.apply_postprocessing()
+        self.input_ops = [self.get_thread_op(thread_num) for thread_num in range(self.n_threads)]
+        if not self.postprocess_after_dequeue:
+            self.apply_postprocessing()
         return self.input_ops
 
+    def get_thread_op(self, thread_num):
+        """
+        Dictionary of the data read by thread thread_num, merged across attribute groups.
+        """
+        op = {}
+        for attr_num in range(self.n_attrs):
+            fq = self.file_queues[thread_num][attr_num]
+            args = self.read_args[attr_num]
+            kwargs = self.read_kwargs[attr_num]
+            _op = self.get_input_op(fq, *args, **kwargs)
+            if self.trans_dicts and self.trans_dicts[attr_num]:
+                td = self.trans_dicts[attr_num]
+                for k in td:
+                    if k in _op:
+                        _op[td[k]] = _op.pop(k)
+            op.update(_op)
+        return op
+
     def get_input_op(self, fq, *args, **kwargs):
         """
         This is the main method that returns a tensorflow data reading operation.
@@ -209,20 +360,336 @@ class ParallelByFileProviderBase(DataProviderBase):
     def apply_postprocessing(self):
         ops = self.input_ops
         for i in range(len(ops)):
-            for source in self.postprocess:
-                op = ops[i][source]
-                for func, args, kwargs in self.postprocess[source]:
-                    op = func(op, *args, **kwargs)
-                ops[i][source] = op
+            ops[i] = self.postprocess_ops(ops[i])
+
+    def postprocess_ops(self, ops):
+        return apply_postprocess(ops, self.postprocess)
+
+    def postprocess_batch(self, inputs):
+        if self.postprocess_after_dequeue:
+            return self.postprocess_ops(inputs)
+        return inputs
+
+
+def apply_postprocess(ops, postprocess):
+    """
+    Apply postprocessing chains of the form
+         {attr: [(func1, args1, kwargs1), (func2, args2, kwargs2) ...], ... }
+    to a dictionary of tensors, returning a new dictionary.
+    """
+    ops = dict(ops)
+    for source in postprocess:
+        op = ops[source]
+        for func, args, kwargs in postprocess[source]:
+            op = func(op, *args, **kwargs)
+        ops[source] = op
+    return ops
+
+
+DEFAULT_TFRECORDS_GLOB_PATTERN = manifest.DEFAULT_FILE_PATTERN
+
+
+class StagingCache(object):
+    """
+    Local copies of remote files, made by a background thread.
+
+    Files requested with stage are copied (with tf.gfile, so any filesystem supported by
+    tensorflow works) into scratch_dir, under a name derived from their path, and
+    registered once complete.  resolve maps a path to its local copy if one exists, and
+    otherwise to the path itself.  The copies are kept within max_bytes by evicting the
+    least recently resolved ones, except for the protect most recently resolved, which
+    may still be queued for reading.  Local copies left in scratch_dir by earlier runs are
+    reused if their size matches the original.
+    """
+    def __init__(self, scratch_dir, max_bytes, protect=0):
+        self.scratch_dir = scratch_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+        self.files = collections.OrderedDict()
+        self.origins = {}
+        self.sizes = {}
+        self.requested = set()
+        self.recent = collections.deque(maxlen=max(protect, 1))
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def nbytes(self):
+        return sum(self.sizes.values())
+
+    def local_path(self, path):
+        return os.path.join(self.scratch_dir,
+                            '%s-%s' % (hashlib.sha1(path).hexdigest()[:16], os.path.basename(path)))
 
+    def stage(self, path):
+        with self.lock:
+            if path in self.requested:
+                return
+            self.requested.add(path)
+        self.pending.put(path)
+
+    def source_of(self, path):
+        """Original path of the local copy path (path itself if it is not a local copy)."""
+        return self.origins.get(path, path)
+
+    def resolve(self, path):
+        with self.lock:
+            if path not in self.files:
+                return path
+            # move to the most recently used end
+            local = self.files.pop(path)
+            self.files[path] = local
+            self.recent.append(path)
+            return local
+
+    def make_room(self, size):
+        with self.lock:
+            for path in list(self.files):
+                if self.nbytes + size <= self.max_bytes:
+                    break
+                if path in self.recent:
+                    continue
+                local = self.files.pop(path)
+                self.sizes.pop(path)
+                self.requested.discard(path)
+                os.remove(local)
+            return self.nbytes + size <= self.max_bytes
+
+    def run(self):
+        while True:
+            path = self.pending.get()
+            try:
+                size = tf.gfile.Stat(path).length
+                local = self.local_path(path)
+                if not (os.path.exists(local) and os.path.getsize(local) == size):
+                    if not self.make_room(size):
+                        with self.lock:
+                            self.requested.discard(path)
+                        continue
+                    tmp_path = local + '.tmp'
+                    tf.gfile.Copy(path, tmp_path, overwrite=True)
+                    os.rename(tmp_path, local)
+                with self.lock:
+                    self.files[path] = local
+                    self.origins[local] = path
+                    self.sizes[path] = size
+            except Exception:
+                log.warning('Could not stage %s:\n%s' % (path, traceback.format_exc()))
+                with self.lock:
+                    self.requested.discard(path)
+
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+READAHEAD_BLOCK_BYTES = 2 ** 20
+
+
+def _get_posix_fadvise():
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+
+    def _fadvise(fd, offset, length, advice):
+        ret = func(fd, offset, length, advice)
+        if ret != 0:
+            raise OSError(ret, os.strerror(ret))
+    return _fadvise
+
+posix_fadvise = _get_posix_fadvise()
+
+
+def fadvise(path, advice):
+    """
+    posix_fadvise(advice) on the whole of the local file path.  Returns False if
+    fadvise is not available or path is not a local file.
+    """
+    if posix_fadvise is None or not os.path.isfile(path):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+class FileReadAhead(object):
+    """
+    Page cache hints for the files of a data provider.
+
+    prefetch(path) asks the kernel to start reading path in the background
+    (posix_fadvise(WILLNEED)), or where that is not available, reads it sequentially in a
+    background thread; drop(path) evicts its pages (posix_fadvise(DONTNEED)).
+    """
+    def __init__(self):
+        self.pending = None
+        self.thread = None
+        self.lock = threading.Lock()
 
-DEFAULT_TFRECORDS_GLOB_PATTERN = '*.tfrecords'
+    def prefetch(self, path):
+        if not fadvise(path, POSIX_FADV_WILLNEED) and os.path.isfile(path):
+            self.read_in_background(path)
+
+    def drop(self, path):
+        fadvise(path, POSIX_FADV_DONTNEED)
+
+    def read_in_background(self, path):
+        with self.lock:
+            if self.thread is None:
+                self.pending = Queue.Queue()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.pending.put(path)
+
+    def run(self):
+        while True:
+            path = self.pending.get()
+            try:
+                with open(path, 'rb') as f:
+                    while f.read(READAHEAD_BLOCK_BYTES):
+                        pass
+            except (IOError, OSError):
+                log.warning('Could not read ahead %s' % path)
+
+
+class ReadAheadIterator(object):
+    """
+    Wraps an iterator over tuples of paths, prefetching the files of the next lookahead
+    tuples with readahead and, if consumed_after is not None, dropping the pages of the
+    files handed out consumed_after tuples earlier.
+    """
+    def __init__(self, itr, readahead, lookahead, consumed_after=None):
+        self.itr = itr
+        self.readahead = readahead
+        self.lookahead = lookahead
+        self.consumed_after = consumed_after
+        self.buffer = collections.deque()
+        self.handed_out = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while len(self.buffer) <= self.lookahead:
+            paths = self.itr.next()
+            if self.buffer or self.lookahead:
+                for path in paths:
+                    self.readahead.prefetch(path)
+            self.buffer.append(paths)
+        paths = self.buffer.popleft()
+        if self.consumed_after is not None:
+            self.handed_out.append(paths)
+            if len(self.handed_out) > self.consumed_after:
+                done = self.handed_out.popleft()
+                upcoming = set(itertools.chain(paths, *self.buffer))
+                for path in done:
+                    # with few files, the same file may be coming up again
+                    if path not in upcoming:
+                        self.readahead.drop(path)
+        return paths
+
+
+class BalancedFileScheduler(object):
+    """
+    Thread-safe assignment of files to threads, balanced by amount of data.
+
+    At the start of each epoch, the files (in decreasing weight order, or in a random order
+    if shuffle is True) are assigned one by one to the thread with the least total weight
+    assigned so far.  Each thread then reads its own files in order; a thread that has
+    read all of its files for the epoch takes the last pending file of the thread with
+    the most pending weight.  The next epoch starts when all files have been handed out.
+    """
+    def __init__(self, files, weights, n_threads, shuffle=False, seed=0):
+        assert len(files) == len(weights), (len(files), len(weights))
+        self.files = files
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.n_threads = n_threads
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed=seed)
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.assign()
+
+    def assign(self):
+        if self.shuffle:
+            order = self.rng.permutation(len(self.files))
+        else:
+            order = np.argsort(-self.weights, kind='mergesort')
+        self.pending = [collections.deque() for _ in range(self.n_threads)]
+        loads = np.zeros(self.n_threads)
+        for i in order:
+            t = loads.argmin()
+            self.pending[t].append(i)
+            loads[t] += self.weights[i]
+
+    def pending_weight(self, t):
+        return sum([self.weights[i] for i in self.pending[t]])
+
+    def next(self, t):
+        with self.lock:
+            if not any(self.pending):
+                self.epoch += 1
+                self.assign()
+            if self.pending[t]:
+                i = self.pending[t].popleft()
+            else:
+                victim = max(range(self.n_threads), key=self.pending_weight)
+                i = self.pending[victim].pop()
+            return self.files[i]
+
+
+class ScheduledFiles(object):
+    """Iterator over the files handed out to thread t by a BalancedFileScheduler."""
+    def __init__(self, scheduler, t):
+        self.scheduler = scheduler
+        self.t = t
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.scheduler.next(self.t)
+
+
+class StagedIterator(object):
+    """
+    Wraps an iterator over tuples of paths, staging the files of the next lookahead tuples
+    in cache and replacing paths by their local copies when these exist.
+    """
+    def __init__(self, itr, cache, lookahead):
+        self.itr = itr
+        self.cache = cache
+        self.lookahead = lookahead
+        self.buffer = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while len(self.buffer) <= self.lookahead:
+            paths = self.itr.next()
+            for path in paths:
+                self.cache.stage(path)
+            self.buffer.append(paths)
+        return tuple([self.cache.resolve(path) for path in self.buffer.popleft()])
 
 
 def get_data_paths(paths, file_pattern=DEFAULT_TFRECORDS_GLOB_PATTERN):
-    if not isinstance(paths, list):
-        assert isstring(paths)
-        paths = [paths]
+    paths = listify(paths)
     if not isinstance(file_pattern, list):
         assert isstring(file_pattern)
         file_patterns = [file_pattern] * len(paths)
@@ -232,10 +699,7 @@ def get_data_paths(paths, file_pattern=DEFAULT_TFRECORDS_GLOB_PATTERN):
     datasources = []
     for path, file_pattern in zip(paths, file_patterns):
         if os.path.isdir(path):
-            tfrecord_pattern = os.path.join(path, file_pattern)
-            datasource = tf.gfile.Glob(tfrecord_pattern)
-            datasource.sort()
-            datasources.append(datasource)
+            datasources.append(manifest.glob_data_files(path, file_pattern))
         else:
             datasources.append([path])
     dl = map(len, datasources)
@@ -243,8 +707,71 @@ def get_data_paths(paths, file_pattern=DEFAULT_TFRECORDS_GLOB_PATTERN):
     return datasources
 
 
-def get_parser(shape, dtype):
-    dtype = dtype if dtype in [tf.float32, tf.int64] else tf.string
+def listify(paths):
+    if not isinstance(paths, list):
+        assert isstring(paths)
+        paths = [paths]
+    return paths
+
+
+def get_manifests(paths, file_pattern=DEFAULT_TFRECORDS_GLOB_PATTERN):
+    """
+    Manifests of the directories of paths, or None unless all of them have an up-to-date
+    manifest for file_pattern (a string, or a list of strings with one pattern per path).
+    A manifest is out of date if the files of its directory matching its pattern are not
+    the ones it lists (see manifest.is_stale).
+    """
+    paths = listify(paths)
+    if not isinstance(file_pattern, list):
+        file_pattern = [file_pattern] * len(paths)
+    manifests = []
+    for path, pattern in zip(paths, file_pattern):
+        m = manifest.load_manifest(path, pattern) if os.path.isdir(path) else None
+        if m is None:
+            return None
+        if manifest.is_stale(path, m):
+            log.warning('The manifest of %s does not match its files, rebuild it with '
+                        '"python -m tfutils.manifest %s"; not using manifests' % (path, path))
+            return None
+        manifests.append(m)
+    return manifests
+
+
+TFRECORDS_COMPRESSION_TYPES = manifest.COMPRESSION_TYPES
+
+
+def get_compressions(meta_dicts, compression=None):
+    """
+    Compression of the files of each attribute group: compression if it is a list, the
+    same compression for all groups if it is a string, or otherwise the "compression" key
+    of the metadata of the attributes of each group (None for uncompressed files).
+    """
+    if isinstance(compression, list):
+        assert len(compression) == len(meta_dicts), (compression, len(meta_dicts))
+        compressions = compression
+    elif compression is not None:
+        compressions = [compression] * len(meta_dicts)
+    else:
+        compressions = []
+        for md in meta_dicts:
+            cs = set([md[k].get('compression') for k in md])
+            assert len(cs) <= 1, 'Attributes of the same files declare different compressions: %s' % cs
+            compressions.append(cs.pop() if cs else None)
+    for c in compressions:
+        assert c is None or c in TFRECORDS_COMPRESSION_TYPES, 'Unknown compression %s' % c
+    return compressions
+
+
+def get_file_patterns(file_pattern, compressions):
+    """
+    File patterns of attribute groups with the given compressions: the default pattern
+    also matches suffixed names (e.g. file.tfrecords.gz) for compressed groups.
+    """
+    return [manifest.compressed_file_pattern(file_pattern, c) for c in compressions]
+
+
+def get_parser(shape, dtype, packed=None):
+    dtype = dtype if dtype in [tf.float32, tf.int64] and not packed else tf.string
     shape = shape if dtype in [tf.float32, tf.int64] else []
     return tf.FixedLenFeature(shape, dtype)
 
@@ -312,7 +839,7 @@ def merge_meta(meta_dicts, trans_dicts):
     meta_dict = {}
     parser_list = []
     for ind, md in enumerate(meta_dicts):
-        parsers = {k: get_parser(md[k]['shape'], md[k]['dtype']) for k in md}
+        parsers = {k: get_parser(md[k]['shape'], md[k]['dtype'], md[k].get('packed')) for k in md}
         parser_list.append(parsers)
         if trans_dicts and trans_dicts[ind]:
             td = trans_dicts[ind]
@@ -323,14 +850,85 @@ def merge_meta(meta_dicts, trans_dicts):
     return meta_dict, parser_list
 
 
-def add_standard_postprocessing(postprocess, meta_dict):
+ENCODED_IMAGE_FORMATS = {'jpeg': tf.image.decode_jpeg,
+                         'png': tf.image.decode_png}
+DEFAULT_DECODE_PARALLELISM = 16
+
+
+def decode_images(data, format, shape, dtype=tf.uint8,
+                  parallel_iterations=DEFAULT_DECODE_PARALLELISM):
+    """
+    Decode a batch of encoded (jpeg or png) images.
+
+    Arguments:
+        - data: string tensor of shape [batch] holding the encoded images
+        - format (str): one of the keys of ENCODED_IMAGE_FORMATS
+        - shape (list of ints): shape of the decoded images
+        - dtype (tf.DType, default=tf.uint8): dtype of the decoded images
+        - parallel_iterations (int): number of images decoded in parallel
+    """
+    decoder = ENCODED_IMAGE_FORMATS[format]
+    shape = list(shape)
+    channels = shape[-1] if len(shape) == 3 else 0
+
+    def _decode(im):
+        kwargs = {'dtype': dtype} if format == 'png' else {}
+        return tf.reshape(decoder(im, channels=channels, **kwargs), shape)
+
+    return tf.map_fn(_decode, data,
+                     dtype=dtype,
+                     parallel_iterations=parallel_iterations,
+                     back_prop=False)
+
+
+def get_packings(meta_dicts):
+    """
+    Number of records packed in each tf.train.Example of each attribute group (None for
+    groups of one record per Example), from the "packed" metadata of the attributes, which
+    must be the same for all attributes of a group.
+    """
+    packings = []
+    for md in meta_dicts:
+        packed = set([md[k].get('packed') for k in md])
+        assert len(packed) == 1, 'Attributes of a group must have the same packing: %s' % packed
+        packings.append(packed.pop())
+    return packings
+
+
+def unpack_records(data, dtype, shape):
+    """
+    Unpack a batch of packed records.
+
+    Arguments:
+        - data: string tensor of shape [batch], each element holding the raw bytes of
+          consecutive records (any number of them)
+        - dtype (tf.DType): dtype of the records
+        - shape (list of ints): shape of one record
+    Returns a tensor of shape [records] + shape, the records of all elements in order.
+    """
+    data = tf.decode_raw(tf.reduce_join(data, 0), dtype)
+    return tf.reshape(data, [-1] + list(shape))
+
+
+def add_standard_postprocessing(postprocess, meta_dict,
+                                decode_parallelism=DEFAULT_DECODE_PARALLELISM):
     if postprocess is None:
         postprocess = {}
     for k in meta_dict:
         if k not in postprocess:
             postprocess[k] = []
         dtype = meta_dict[k]['dtype']
-        if dtype not in [tf.string, tf.int64, tf.float32]:
+        fmt = meta_dict[k].get('format')
+        if meta_dict[k].get('packed'):
+            assert fmt is None and dtype != tf.string, \
+                'Only fixed-size raw attributes can be packed, not %s' % k
+            postprocess[k].insert(0, (unpack_records, (dtype, meta_dict[k]['shape']), {}))
+        elif fmt is not None:
+            assert fmt in ENCODED_IMAGE_FORMATS, 'Unknown image format %s for %s' % (fmt, k)
+            postprocess[k].insert(0, (decode_images,
+                                      (fmt, meta_dict[k]['shape'], dtype),
+                                      {'parallel_iterations': decode_parallelism}))
+        elif dtype not in [tf.string, tf.int64, tf.float32]:
             postprocess[k].insert(0, (tf.decode_raw, (meta_dict[k]['dtype'], ), {}))
             postprocess[k].insert(1, (tf.reshape, ([-1] + meta_dict[k]['shape'], ), {}))
     return postprocess
@@ -344,6 +942,10 @@ class TFRecordsParallelByFileProvider(ParallelByFileProviderBase):
                  postprocess=None,
                  trans_dicts=None,
                  file_pattern=DEFAULT_TFRECORDS_GLOB_PATTERN,
+                 decode_parallelism=DEFAULT_DECODE_PARALLELISM,
+                 decoded_cache_dir=None,
+                 use_manifest=True,
+                 compression=None,
                  **kwargs):
         """
         Subclass of ParallelByFileProviderBase specific to TFRecords files.
@@ -377,9 +979,42 @@ class TFRecordsParallelByFileProvider(ParallelByFileProviderBase):
                file2.tfrecords
                 ....
 
+        Image attributes can also be stored encoded as jpeg or png, by adding a "format" key
+        to their metadata, e.g.
+            {"images": {"dtype": tf.uint8, "shape": (256, 256, 3), "format": "jpeg"}}
+        where dtype and shape describe the decoded images.  Such attributes are decoded in
+        parallel (decode_parallelism images at a time) by the standard postprocessing.
+
+        The files of an attribute group can be compressed TFRecords files, declared by a
+        "compression" key ('GZIP' or 'ZLIB') in the metadata of the attributes of the group,
+        e.g.
+            {"labels": {"dtype": tf.int64, "shape": (), "compression": "GZIP"}}
+        or in the manifest of the directory.  Each reader thread decompresses its own files.
+        With the default file_pattern, the files of compressed groups may also have a
+        suffix, e.g. file1.tfrecords.gz.
+
+        Small attributes (labels, ids, ...) can be stored packed, with each tf.train.Example
+        holding the raw bytes of up to N consecutive records of each attribute of the group,
+        declared by a "packed" key in the metadata of all the attributes of the group, e.g.
+            {"labels": {"dtype": tf.int64, "shape": (), "packed": 256}}
+        (see tfutils.convert.hdf5_to_tfrecords).  Packed groups read batch_size / N
+        Examples at a time, which batch_size must be a multiple of, and the standard
+        postprocessing unpacks them into batch_size records.  All attribute groups must have
+        the same packing, so that their Examples stay aligned, and packing cannot be combined
+        with postprocess_after_dequeue, which would enqueue the Examples still packed.
+
         If no such metadata pickle files exist, metadata can be supplied by passing the meta_dicts
         argument.
 
+        If every source_dir has a manifest (see tfutils/manifest.py, and build one with
+        "python -m tfutils.manifest source_dir"), the file lists and the saved metadata are
+        read from the manifests instead of globbing the directories and loading the meta*.pkl
+        files.  If the manifests have record counts, the provider has num_records and
+        total_batches attributes (counting the files of the first attribute group).  The
+        byte size of each file (summed over the attribute groups) is in file_bytes.  A
+        manifest is only used if its directory holds exactly the files it lists; otherwise
+        the directories are globbed as without manifests.
+
         Arguments:
             - source_dirs (string or list of strings): List of directory names in which
               files reside.  All files inside each directory of the form '*.tfrecords'
@@ -405,76 +1040,788 @@ class TFRecordsParallelByFileProvider(ParallelByFileProviderBase):
               the attributes "ids" and "means" are loaded for the second source_path, and the attribute
               "segmentations" for the third.
             - file_pattern (str, optional): pattern for selecting files in glob format.
+            - decode_parallelism (int, optional): number of encoded images decoded in parallel.
+            - decoded_cache_dir (str or None): if not None, directory of a DecodedCache of the
+              records after the standard decoding (see add_standard_postprocessing) and before
+              the postprocess argument, which is then applied to the data read from the cache.
+              Not supported with packed attribute groups.
+              During the first epoch the decoded records are recorded; once every file has
+              been read, batches are read from the cache instead of the TFRecords files, in
+              this and later runs.  The cache is keyed on the files (paths, sizes and
+              modification times), the metadata and the decoding operations, so changing any
+              of them builds a new cache.  All attributes must decode to fixed-shape arrays.
+            - use_manifest (bool, default=True): whether to use the manifests of the
+              source_dirs when they all have one matching file_pattern.  With manifests, the
+              balance argument of ParallelByFileProviderBase can also be 'records', to balance
+              threads by record counts rather than byte sizes, and byte sizes are taken from
+              the manifests.
+            - compression (str, list of strs or None): compression of the files ('GZIP',
+              'ZLIB' or None), for all attribute groups or one per group, overriding the
+              compression declared in the metadata or manifests.
 
         """
         self.source_dirs = source_dirs
         self.batch_size = batch_size
-        parsed_meta_dicts = parse_standard_tfmeta(self.source_dirs)
+        self.manifests = get_manifests(source_dirs, file_pattern) if use_manifest else None
+        if self.manifests is None:
+            assert kwargs.get('balance') != 'records' or kwargs.get('file_weights') is not None, \
+                'balance="records" needs manifests with record counts (see tfutils/manifest.py)'
+            parsed_meta_dicts = parse_standard_tfmeta(self.source_dirs)
+            self.compressions = get_compressions(parsed_meta_dicts, compression)
+            source_paths = get_data_paths(source_dirs, get_file_patterns(file_pattern, self.compressions))
+        else:
+            parsed_meta_dicts = [m['meta'] for m in self.manifests]
+            if compression is None:
+                compression = [m.get('compression') for m in self.manifests]
+            self.compressions = get_compressions(parsed_meta_dicts, compression)
+            source_paths = [manifest.manifest_paths(path, m)
+                            for path, m in zip(listify(source_dirs), self.manifests)]
+            dl = map(len, source_paths)
+            assert all([dl[0] == _d for _d in dl[1:]]), dl
+            assert dl[0] > 0, 'The manifests of %s list no files' % source_dirs
+            records = [f['records'] for f in self.manifests[0]['files']]
+            if None not in records:
+                self.file_records = records
+                self.num_records = sum(records)
+                self.total_batches = (self.num_records - 1) // self.batch_size + 1
+            self.file_bytes = [sum([m['files'][i]['bytes'] for m in self.manifests])
+                               for i in range(len(records))]
+            if kwargs.get('balance') and kwargs.get('file_weights') is None:
+                if kwargs['balance'] == 'records':
+                    assert None not in records, 'The manifests have no record counts'
+                    kwargs['file_weights'] = records
+                else:
+                    kwargs['file_weights'] = self.file_bytes
         self.meta_dicts = complete_metadata(meta_dicts, parsed_meta_dicts)
+        self.packings = get_packings(self.meta_dicts)
+        assert len(set(self.packings)) == 1, \
+            'All attribute groups must have the same packing: %s' % self.packings
+        assert not self.packings[0] or batch_size % self.packings[0] == 0, \
+            'batch_size %d is not a multiple of the packing %d' % (batch_size, self.packings[0])
+        assert not self.packings[0] or not kwargs.get('postprocess_after_dequeue'), \
+            'Packed attribute groups cannot be postprocessed after dequeue'
         self.meta_dict, self.parser_list = merge_meta(self.meta_dicts,
                                                       trans_dicts)
-        postprocess = add_standard_postprocessing(postprocess, self.meta_dict)
-        source_paths = get_data_paths(source_dirs, file_pattern)
+        self.decoded_cache = None
+        if decoded_cache_dir is not None:
+            assert not any(self.packings), 'Packed attribute groups cannot be cached'
+            decode = add_standard_postprocessing(None, self.meta_dict,
+                                                 decode_parallelism=decode_parallelism)
+            key = get_decoded_cache_key(source_paths, self.meta_dict, decode)
+            self.decoded_cache = DecodedCache(decoded_cache_dir, key, self.meta_dict, decode,
+                                              n_files=len(source_paths[0]),
+                                              batch_size=batch_size,
+                                              shuffle=kwargs.get('shuffle', False),
+                                              shuffle_seed=kwargs.get('shuffle_seed', 0))
+        else:
+            postprocess = add_standard_postprocessing(postprocess, self.meta_dict,
+                                                      decode_parallelism=decode_parallelism)
+        read_args = zip(self.parser_list, self.compressions, self.packings)
         super(TFRecordsParallelByFileProvider, self).__init__(source_paths,
-                                                              read_args=[(p, ) for p in self.parser_list],
+                                                              read_args=read_args,
                                                               postprocess=postprocess,
                                                               trans_dicts=trans_dicts,
                                                               **kwargs)
+        if self.decoded_cache is not None and self.staging is not None:
+            # record keys name the local copies once these exist
+            self.decoded_cache.source_of = self.staging.source_of
+
+    def get_thread_op(self, thread_num):
+        if self.decoded_cache is None:
+            return super(TFRecordsParallelByFileProvider, self).get_thread_op(thread_num)
+        read = super(TFRecordsParallelByFileProvider, self).get_thread_op
+        return self.decoded_cache.input_op(functools.partial(read, thread_num), thread_num)
+
+    def get_input_op(self, fq, parsers, compression=None, packed=None):
+        options = None
+        if compression is not None:
+            options = tf.python_io.TFRecordOptions(TFRECORDS_COMPRESSION_TYPES[compression])
+        reader = tf.TFRecordReader(options=options)
+        keys, serialized_data = reader.read_up_to(fq, self.batch_size // packed if packed else self.batch_size)
+        data = tf.parse_example(serialized_data, parsers)
+        if self.decoded_cache is not None:
+            data[RECORD_KEY] = keys
+        return data
+
+
+RECORD_KEY = '__record_key__'
+
+
+def func_name(func):
+    """Name identifying func (and the bound arguments of a functools.partial)."""
+    name = getattr(func, '__name__', None)
+    if name is None and isinstance(func, functools.partial):
+        name = '%s%s%s' % (getattr(func.func, '__name__', repr(func.func)), func.args, func.keywords)
+    return '%s.%s' % (getattr(func, '__module__', ''), name or repr(func))
 
-    def get_input_op(self, fq, parsers):
-        reader = tf.TFRecordReader()
-        _, serialized_data = reader.read_up_to(fq, self.batch_size)
-        return tf.parse_example(serialized_data, parsers)
+
+def code_hash(code, h=None):
+    """SHA1 of a code object: its bytecode, constants (and nested code objects) and names."""
+    if h is None:
+        h = hashlib.sha1()
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            code_hash(const, h)
+        else:
+            h.update(repr(const))
+    return h
+
+
+def is_module_level(func):
+    """Whether func is the object named after it in its module, e.g. a library function."""
+    module = sys.modules.get(getattr(func, '__module__', None))
+    return module is not None and getattr(module, getattr(func, '__name__', ''), None) is func
+
+
+def value_hash(value, h, seen=None, strict=True):
+    """
+    Update the hash h with value, in a way that does not change from run to run: arrays are
+    hashed by their bytes, containers by their items and python functions by their code,
+    default arguments and closure.  Raises TypeError for other values whose repr holds their
+    address, unless strict is False.  The defaults and closures of module-level functions
+    (and of the functions they wrap) are set on import, so such values in them are skipped.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)))
+        if value.dtype.hasobject:
+            value_hash(value.tolist(), h, seen, strict)
+        else:
+            h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        h.update('%s%d' % (type(value).__name__, len(value)))
+        for v in value:
+            value_hash(v, h, seen, strict)
+    elif isinstance(value, dict):
+        h.update('dict%d' % len(value))
+        for k in sorted(value):
+            value_hash(k, h, seen, strict)
+            value_hash(value[k], h, seen, strict)
+    elif isinstance(value, functools.partial):
+        value_hash(value.func, h, seen, strict)
+        value_hash(value.args, h, seen, strict)
+        value_hash(value.keywords or {}, h, seen, strict)
+    elif hasattr(value, '__code__') or hasattr(getattr(value, '__func__', None), '__code__'):
+        target = getattr(value, '__func__', value)
+        if getattr(value, '__self__', None) is not None:
+            value_hash(value.__self__, h, seen, strict)
+        if id(target) in seen:
+            # recursive functions, e.g. decorators referring to their wrapper
+            h.update(func_name(target))
+            return
+        seen.add(id(target))
+        strict = strict and not is_module_level(target)
+        code_hash(target.__code__, h)
+        value_hash(target.__defaults__, h, seen, strict)
+        for cell in target.__closure__ or ():
+            value_hash(cell.cell_contents, h, seen, strict)
+    else:
+        r = repr(value)
+        if ' at 0x' not in r:
+            h.update(r)
+        elif strict:
+            raise TypeError('%s cannot be hashed the same way in every run' % r)
+
+
+def func_key(func):
+    """
+    Key identifying func for on-disk caches: its name (see func_name) and, for python
+    functions, a hash of its code, default arguments and closure (see value_hash), so that
+    editing the body of a function (or using another lambda) changes the key.  The functions
+    and arguments of functools.partial and the bound objects of methods are hashed too.
+    Raises TypeError if the defaults or closure hold objects with no stable hash.
+    """
+    h = hashlib.sha1()
+    value_hash(func, h)
+    return '%s:%s' % (func_name(func), h.hexdigest())
+
+
+def get_decoded_cache_key(source_paths, meta_dict, postprocess):
+    """
+    Hash of the files of source_paths (paths, sizes and modification times), the metadata
+    of meta_dict and the postprocessing chains of postprocess.
+    """
+    h = hashlib.sha1()
+    for paths in source_paths:
+        for path in paths:
+            stat = tf.gfile.Stat(path)
+            h.update(repr((path, stat.length, stat.mtime_nsec)))
+    for k in sorted(meta_dict):
+        h.update(repr((k, meta_dict[k]['dtype'], list(meta_dict[k]['shape']), meta_dict[k].get('format'))))
+    for k in sorted(postprocess):
+        for func, args, kwargs in postprocess[k]:
+            h.update(repr((k, func_key(func), args, sorted(kwargs.items()))))
+    return h.hexdigest()
+
+
+class DecodedCache(object):
+    """
+    Local, memory-mapped cache of the decoded records of a TFRecordsParallelByFileProvider.
+
+    The records read in the first epoch are decoded (with the postprocess chains of decode)
+    and appended to per-file part files in a work directory under cache_dir.  A file is
+    complete when the thread that read it moves on to another file (or restarts it), since
+    each file is read sequentially by one thread per epoch.  When all n_files files are
+    complete, the parts are gathered into one .npy array per attribute, in file order, and
+    the work directory is renamed to cache_dir/key.  From then on batches of batch_size
+    records are read from the memory-mapped arrays, in order, or if shuffle is True in a new
+    random order each epoch.
+    """
+    def __init__(self, cache_dir, key, meta_dict, decode, n_files, batch_size,
+                 shuffle=False, shuffle_seed=0):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, key)
+        self.attrs = sorted(meta_dict)
+        self.dtypes = [meta_dict[k]['dtype'] for k in self.attrs]
+        self.shapes = [list(meta_dict[k]['shape']) for k in self.attrs]
+        for k, dtype in zip(self.attrs, self.dtypes):
+            assert dtype != tf.string or meta_dict[k].get('format'), \
+                'Attribute %s is not decoded to an array and cannot be cached' % k
+        self.decode = decode
+        self.n_files = n_files
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_seed = shuffle_seed
+        self.lock = threading.Lock()
+        self.arrays = None
+        self.partitioner = None
+        self.complete = os.path.exists(os.path.join(self.path, 'done'))
+        self.work_dir = None
+        self.parts = {}
+        self.counts = {}
+        self.finished = set()
+        self.current = {}
+        self.source_of = None
+
+    def is_complete(self):
+        return self.complete
+
+    def input_op(self, read, thread_num):
+        """
+        Dictionary of decoded tensors for thread thread_num: read from the TFRecords files
+        (by calling read) and recorded until the cache is complete, then read from the cache.
+        """
+        if self.complete:
+            outs = self.read_op()
+        else:
+            def _from_records():
+                op = read()
+                keys = op.pop(RECORD_KEY)
+                op = apply_postprocess(op, self.decode)
+                return tf.py_func(functools.partial(self.record, thread_num),
+                                  [keys] + [op[k] for k in self.attrs],
+                                  self.dtypes)
+            ready = tf.py_func(self.is_complete, [], tf.bool)
+            ready.set_shape([])
+            outs = tf.cond(ready, self.read_op, _from_records)
+        if not isinstance(outs, (list, tuple)):
+            outs = [outs]
+        for o, shape in zip(outs, self.shapes):
+            o.set_shape([None] + shape)
+        return dict(zip(self.attrs, outs))
+
+    def read_op(self):
+        return tf.py_func(self.next, [], self.dtypes)
+
+    def record(self, thread_num, keys, *values):
+        with self.lock:
+            if not self.complete:
+                if self.work_dir is None:
+                    if not os.path.isdir(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    self.work_dir = tempfile.mkdtemp(dir=self.cache_dir,
+                                                     prefix=os.path.basename(self.path) + '.partial-')
+                self.record_records(thread_num, keys, values)
+        return list(values)
+
+    def record_records(self, thread_num, keys, values):
+        keys = [k.rsplit(':', 1) for k in keys]
+        for i, (fname, ind) in enumerate(keys):
+            ind = int(ind)
+            if self.source_of is not None:
+                fname = self.source_of(fname)
+            current, last_ind, recording = self.current.get(thread_num, (None, None, False))
+            if fname != current or ind <= last_ind:
+                # this thread is done with its pass over the current file
+                if recording:
+                    self.finish_file(current)
+                recording = fname not in self.parts
+                if recording:
+                    self.parts[fname] = [open(self.part_path(fname, k), 'wb') for k in self.attrs]
+                    self.counts[fname] = 0
+            self.current[thread_num] = (fname, ind, recording)
+            if recording:
+                for f, v in zip(self.parts[fname], values):
+                    f.write(np.ascontiguousarray(v[i]).tobytes())
+                self.counts[fname] += 1
+        if len(self.finished) == self.n_files:
+            self.finalize()
+
+    def part_path(self, fname, attr):
+        return os.path.join(self.work_dir, '%s.%s.part' % (hashlib.sha1(fname).hexdigest(), attr))
+
+    def finish_file(self, fname):
+        for f in self.parts[fname]:
+            f.close()
+        self.finished.add(fname)
+
+    def finalize(self):
+        files = sorted(self.parts)
+        n = sum([self.counts[fname] for fname in files])
+        for attr, dtype, shape in zip(self.attrs, self.dtypes, self.shapes):
+            dtype = np.dtype(dtype.as_numpy_dtype)
+            out = np.lib.format.open_memmap(os.path.join(self.work_dir, attr + '.npy'),
+                                            mode='w+', dtype=dtype, shape=tuple([n] + shape))
+            start = 0
+            for fname in files:
+                part_path = self.part_path(fname, attr)
+                part = np.fromfile(part_path, dtype=dtype).reshape([-1] + shape)
+                out[start: start + len(part)] = part
+                start += len(part)
+                os.remove(part_path)
+            out.flush()
+            del out
+        with open(os.path.join(self.work_dir, 'done'), 'w') as f:
+            cPickle.dump({'files': files, 'n': n}, f)
+        try:
+            os.rename(self.work_dir, self.path)
+        except OSError:
+            # another process completed the same cache first
+            shutil.rmtree(self.work_dir)
+        log.info('Decoded cache of %d records written to %s' % (n, self.path))
+        self.complete = True
+
+    def load(self):
+        with self.lock:
+            if self.arrays is None:
+                self.arrays = [np.load(os.path.join(self.path, attr + '.npy'), mmap_mode='r')
+                               for attr in self.attrs]
+                n = len(self.arrays[0])
+                # records are read from a local memory-mapped file, so a full shuffle is cheap
+                run_size = 1 if self.shuffle else n
+                self.partitioner = EpochPartitioner(n, self.batch_size, run_size=run_size,
+                                                    seed=self.shuffle_seed)
+
+    def next(self):
+        if self.partitioner is None:
+            self.load()
+        inds = self.partitioner.next()
+        return [np.asarray(arr[inds]) for arr in self.arrays]
 
 
 class ParallelBySliceProvider(DataProviderBase):
     """
     Data provider for handling parallelization by records within one large randomly-accessible file.
     See an example of usage in tfutils/tests/test_data_hdf5.py.
+
+    Besides the (numpy) postprocessing done by the readers, tensorflow postprocessing can be
+    applied to the ops, in the same form as for ParallelByFileProviderBase:
+         {attr: [(func1, args1, kwargs1), (func2, args2, kwargs2) ...], ... }
+    Readers can declare their own tensorflow postprocessing through a graph_postprocess
+    attribute, which is applied before the postprocess argument.  If postprocess_after_dequeue
+    is True, the postprocessing is applied to the dequeued batch by postprocess_batch
+    rather than to the per-thread ops, so that queues hold the data as produced by the readers.
+
+    The mode sets how the data is split between threads:
+        - 'block': each thread reads a contiguous block of the data, in the same order each epoch
+        - 'alternate': thread i reads the records i, i + n_threads, i + 2 * n_threads, ...
+        - 'shard': each thread reads whole shards (for ShardedHDF5DataReader and
+          NpyShardsDataReader)
+        - 'shuffle': the data is globally reshuffled each epoch by an EpochPartitioner, seeded
+          with shuffle_seed, in runs of run_size consecutive records (by default the HDF5 chunk
+          rows of the sources if they are chunked, otherwise batch_size // 8).  Each batch is
+          made of sorted runs, so reads stay sequential, and threads take the next batch when
+          they are ready, so threads that fall behind do not hold the others back.  Readers
+          must implement get_rows (as HDF5DataReader does).
     """
     def __init__(self,
                  basefunc,
                  kwargs,
                  mode='block',
                  batch_size=256,
-                 n_threads=1):
+                 n_threads=1,
+                 postprocess=None,
+                 postprocess_after_dequeue=False,
+                 shuffle_seed=0,
+                 run_size=None):
         self.func = basefunc
         self.kwargs = kwargs
         self.mode = mode
         self.n_threads = n_threads
         self.batch_size = batch_size
+        self.shuffle_seed = shuffle_seed
+        self.run_size = run_size
+        self.postprocess = {} if postprocess is None else postprocess
+        self.postprocess_after_dequeue = postprocess_after_dequeue
 
     def init_ops(self):
-        n = self.n_threads
-        ops = []
         tester = self.func(batch_size=self.batch_size, **self.kwargs)
-        N = tester.data_length
         labels = tester.labels
+        testbatch = tester.next()
+        if self.mode == 'shuffle':
+            run_size = self.run_size
+            if run_size is None:
+                run_size = getattr(tester, 'chunk_rows', None) or max(1, self.batch_size // 8)
+            self.partitioner = EpochPartitioner(tester.data_length, self.batch_size,
+                                                run_size=run_size, seed=self.shuffle_seed)
+            kwargs = copy.deepcopy(self.kwargs)
+            kwargs['batch_size'] = self.batch_size
+            producers = [PartitionedReader(self.func(**kwargs), self.partitioner)
+                         for _ in range(self.n_threads)]
+        else:
+            producers = [self.func(**kwargs) for kwargs in self.get_slice_kwargs(tester, self.n_threads)]
+        ops = []
+        for dp in producers:
+            op = tf.py_func(dp.next, [], [t.dtype for t in testbatch])
+            for _op, t in zip(op, testbatch):
+                _op.set_shape(t.shape)
+            op = dict(zip(labels, op))
+            ops.append(op)
+        self.set_graph_postprocess(tester)
+        if hasattr(tester, 'close'):
+            tester.close()
+        return self.postprocess_ops(ops)
 
+    def get_slice_kwargs(self, tester, n):
+        """
+        Keyword arguments of basefunc for each of n readers, each reading its own
+        subslice of the data according to the mode.
+        """
+        N = tester.data_length
         if self.mode == 'block':
-            blocksize = N / n
-            ends = [[i * blocksize, (i+1) * blocksize] for i in range(n)]
-            ends[-1][1] = max(ends[-1][1], N)
+            # align blocks to the HDF5 chunks when they index the file directly
+            align = getattr(tester, 'chunk_rows', None) if 'subslice' not in self.kwargs else None
+            ends = aligned_blocks(N, n, align)
             subslices = [np.arange(e0, e1).astype(np.int) for e0, e1 in ends]
         elif self.mode == 'alternate':
-            subslices = [np.arange(N)[i::].astype(np.int) for i in range(n)]
+            subslices = [np.arange(N)[i::n].astype(np.int) for i in range(n)]
+        elif self.mode == 'shard':
+            # give each reader whole shards, for locality
+            ends = shard_blocks(tester.shard_bounds, n)
+            if ends is None:
+                log.info('Fewer shards than readers, falling back to block mode')
+                ends = aligned_blocks(N, n)
+            elif 'subslice' in self.kwargs:
+                # convert file index boundaries to positions in the subslice
+                ends = [tester.subsliceinds.searchsorted(e).tolist() for e in ends]
+            subslices = [np.arange(e0, e1).astype(np.int) for e0, e1 in ends]
+        else:
+            raise ValueError('Slicing mode %s not recognized' % self.mode)
 
-        testbatch = tester.next()
-        for n in range(self.n_threads):
+        kwargs_list = []
+        for i in range(n):
             kwargs = copy.deepcopy(self.kwargs)
             if 'subslice' not in self.kwargs:
-                kwargs['subslice'] = subslices[n]
+                kwargs['subslice'] = subslices[i]
             else:
                 good_inds = tester.subsliceinds
-                kwargs['subslice'] = good_inds[subslices[n]]
+                kwargs['subslice'] = good_inds[subslices[i]]
             kwargs['batch_size'] = self.batch_size
-            dp = self.func(**kwargs)
-            op = tf.py_func(dp.next, [], [t.dtype for t in testbatch])
+            kwargs_list.append(kwargs)
+        return kwargs_list
+
+    def set_graph_postprocess(self, tester):
+        self.graph_postprocess = {}
+        for source, chain in getattr(tester, 'graph_postprocess', {}).items():
+            self.graph_postprocess[source] = list(chain)
+        for source, chain in self.postprocess.items():
+            self.graph_postprocess.setdefault(source, []).extend(chain)
+
+    def postprocess_ops(self, ops):
+        if not self.postprocess_after_dequeue:
+            ops = [apply_postprocess(op, self.graph_postprocess) for op in ops]
+        return ops
+
+    def postprocess_batch(self, inputs):
+        if self.postprocess_after_dequeue:
+            return apply_postprocess(inputs, self.graph_postprocess)
+        return inputs
+
+
+class BatchQueue(object):
+    """
+    Transport of batches from producer processes through a multiprocessing queue
+    (batches are pickled on the way).
+    """
+    def __init__(self, size):
+        self.queue = multiprocessing.Queue(size)
+
+    def put_batch(self, batch, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.queue.put(('batch', batch), timeout=0.1)
+            except Queue.Full:
+                continue
+            return
+
+    def put_error(self, error):
+        self.queue.put(('error', error))
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+
+class SharedMemoryRing(object):
+    """
+    Transport of batches from producer processes (or threads) through a ring of fixed-size
+    slots in shared memory.
+
+    Producers copy each batch straight into a free slot, and get copies the batch out of its
+    slot and releases the slot at once.  Slots are not held on behalf of the consumers:
+    tf.py_func runs on arbitrary threads of tensorflow's pool, and may keep aliasing the
+    arrays it returns after the call, so returning views of a slot is not safe.
+
+    Arguments:
+        - specs (list of (shape, dtype)): shape (including the batch dimension, which is the
+          maximum number of rows of a batch) and dtype of each array of a batch
+        - n_slots (int): number of slots of the ring
+    """
+    def __init__(self, specs, n_slots):
+        self.specs = [(tuple(shape), np.dtype(dtype)) for shape, dtype in specs]
+        self.offsets = []
+        slot_bytes = 0
+        for shape, dtype in self.specs:
+            self.offsets.append(slot_bytes)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            slot_bytes += (nbytes + 63) // 64 * 64
+        self.slot_bytes = slot_bytes
+        self.n_slots = n_slots
+        self.buffer = multiprocessing.RawArray('b', self.slot_bytes * n_slots)
+        self.free = multiprocessing.Queue()
+        self.full = multiprocessing.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def arrays(self, slot):
+        base = np.frombuffer(self.buffer, dtype=np.uint8)
+        arrays = []
+        for (shape, dtype), offset in zip(self.specs, self.offsets):
+            start = slot * self.slot_bytes + offset
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arrays.append(base[start: start + nbytes].view(dtype).reshape(shape))
+        return arrays
+
+    def put_batch(self, batch, stop_event):
+        while not stop_event.is_set():
+            try:
+                slot = self.free.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            n = len(batch[0])
+            for arr, val in zip(self.arrays(slot), batch):
+                arr[:n] = val
+            self.full.put(('batch', (slot, n)))
+            return
+
+    def put_error(self, error):
+        self.full.put(('error', error))
+
+    def get(self, timeout=None):
+        kind, val = self.full.get(timeout=timeout)
+        if kind != 'batch':
+            return kind, val
+        slot, n = val
+        batch = [arr[:n].copy() for arr in self.arrays(slot)]
+        self.free.put(slot)
+        return kind, batch
+
+
+class EpochPartitioner(object):
+    """
+    Thread-safe source of the batches of indices of a dataset of N records, globally
+    reshuffled each epoch.
+
+    Each epoch, the indices are cut into runs of run_size consecutive indices, and the runs
+    are permuted with a random state seeded with seed + epoch.  The permuted epochs are
+    concatenated into one stream, which is cut into batches of batch_size indices; each
+    batch is sorted so that it is read as a few sequential runs.  Batches are handed out
+    in order to whichever caller asks first.
+    """
+    def __init__(self, N, batch_size, run_size=1, seed=0):
+        self.N = N
+        self.batch_size = batch_size
+        self.run_size = max(1, min(run_size, N))
+        self.seed = seed
+        self.epoch = 0
+        self.buffer = np.zeros((0, ), dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def epoch_indices(self, epoch):
+        rng = np.random.RandomState(seed=self.seed + epoch)
+        starts = np.arange(0, self.N, self.run_size)
+        runs = [np.arange(s, min(s + self.run_size, self.N)) for s in starts[rng.permutation(len(starts))]]
+        return np.concatenate(runs)
+
+    def next(self):
+        with self.lock:
+            while len(self.buffer) < self.batch_size:
+                self.buffer = np.concatenate([self.buffer, self.epoch_indices(self.epoch)])
+                self.epoch += 1
+            batch = self.buffer[:self.batch_size]
+            self.buffer = self.buffer[self.batch_size:]
+        return np.sort(batch)
+
+
+class PartitionedReader(object):
+    """
+    Batch producer reading, with reader.get_rows, the batches of indices handed out by
+    a partitioner shared with other threads.
+    """
+    def __init__(self, reader, partitioner):
+        self.reader = reader
+        self.partitioner = partitioner
+
+    def next(self):
+        batch = self.reader.get_rows(self.partitioner.next())
+        return [batch[k] for k in self.reader.labels]
+
+
+# graph collection of the providers with a stop_on method, stopped by base.start_queues
+STOPPABLE_PROVIDERS = 'tfutils_stoppable_providers'
+
+
+def _produce_batches(func, kwargs, channel, stop_event):
+    """
+    Main function of ProcessPoolProvider workers: builds a reader and puts its batches
+    in the channel (a BatchQueue or a SharedMemoryRing) until stop_event is set.
+    """
+    try:
+        reader = func(**kwargs)
+        while not stop_event.is_set():
+            channel.put_batch(reader.next(), stop_event)
+    except Exception:
+        channel.put_error(traceback.format_exc())
+
+
+class ProcessPoolProvider(ParallelBySliceProvider):
+    """
+    Data provider running batch producers in a pool of worker processes.
+
+    Readers producing batches in python with tf.py_func (e.g. HDF5DataReader) run on
+    tensorflow's threads and mostly hold the GIL, so adding threads adds little throughput.
+    This provider instead builds n_workers readers, each in its own process and reading its
+    own subslice of the data (sliced as in ParallelBySliceProvider, according to mode), and
+    n_threads py_func ops that only fetch the produced batches.
+
+    Arguments (in addition to those of ParallelBySliceProvider):
+        - n_workers (int, default=1): number of worker processes
+        - ordered (bool, default=True): if True, batches are fetched from the workers in
+          round-robin order, so the sequence of batches is deterministic when n_threads is 1.
+          Otherwise batches are fetched from a shared queue as soon as any worker produces them.
+        - queue_size (int, default=2): number of batches each worker can produce ahead
+        - transport (str, default='queue'): how batches are moved out of the workers, either
+          'queue' (pickled through multiprocessing queues) or 'shm' (written into a
+          SharedMemoryRing, without pickling).
+        - skip_queue (bool, default=False): if True, base.get_data uses the output of the
+          (single) op as inputs instead of going through a tensorflow queue, which saves the
+          copy made by enqueue_many; the workers' buffers then act as the queue.  This
+          requires n_threads == 1 and the queue batch size to equal batch_size.
+
+    The provider adds itself to the STOPPABLE_PROVIDERS collection of the graph, so that
+    base.start_queues stops the workers with the tf.train.Coordinator of the queues (see
+    stop_on).  Otherwise call stop to shut the workers down; they are also stopped at
+    interpreter exit.
+    """
+    def __init__(self,
+                 basefunc,
+                 kwargs,
+                 n_workers=1,
+                 ordered=True,
+                 queue_size=2,
+                 transport='queue',
+                 skip_queue=False,
+                 **provider_kwargs):
+        super(ProcessPoolProvider, self).__init__(basefunc, kwargs, **provider_kwargs)
+        assert self.mode != 'shuffle', 'shuffle mode needs readers sharing one partitioner, use threads'
+        assert transport in ['queue', 'shm'], transport
+        self.n_workers = n_workers
+        self.ordered = ordered
+        self.queue_size = queue_size
+        self.transport = transport
+        self.skip_queue = skip_queue
+        if self.skip_queue:
+            assert self.n_threads == 1, 'skip_queue requires n_threads == 1'
+        self.workers = []
+        self.channels = []
+        self.next_worker = 0
+        self.lock = threading.Lock()
+        self.stop_event = multiprocessing.Event()
+
+    def init_ops(self):
+        tester = self.func(batch_size=self.batch_size, **self.kwargs)
+        labels = tester.labels
+        testbatch = tester.next()
+        worker_kwargs = self.get_slice_kwargs(tester, self.n_workers)
+        self.set_graph_postprocess(tester)
+        if hasattr(tester, 'close'):
+            tester.close()
+        self.start_workers(worker_kwargs, testbatch)
+        tf.add_to_collection(STOPPABLE_PROVIDERS, self)
+
+        ops = []
+        for _ in range(self.n_threads):
+            op = tf.py_func(self.next, [], [t.dtype for t in testbatch])
             for _op, t in zip(op, testbatch):
                 _op.set_shape(t.shape)
-            op = dict(zip(labels, op))
-            ops.append(op)
-        return ops
+            ops.append(dict(zip(labels, op)))
+        return self.postprocess_ops(ops)
+
+    def get_channel(self, n_workers, testbatch):
+        if self.transport == 'shm':
+            specs = [((self.batch_size, ) + t.shape[1:], t.dtype) for t in testbatch]
+            return SharedMemoryRing(specs, self.queue_size * n_workers)
+        return BatchQueue(self.queue_size * n_workers)
+
+    def start_workers(self, worker_kwargs, testbatch):
+        n_channels = len(worker_kwargs) if self.ordered else 1
+        n_per_channel = len(worker_kwargs) // n_channels
+        self.channels = [self.get_channel(n_per_channel, testbatch) for _ in range(n_channels)]
+        for i, kwargs in enumerate(worker_kwargs):
+            channel = self.channels[i % n_channels]
+            worker = multiprocessing.Process(target=_produce_batches,
+                                             args=(self.func, kwargs, channel, self.stop_event))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.stop)
+
+    def next(self):
+        with self.lock:
+            channel = self.channels[self.next_worker]
+            self.next_worker = (self.next_worker + 1) % len(self.channels)
+        while True:
+            try:
+                kind, val = channel.get(timeout=1.)
+            except Queue.Empty:
+                if self.stop_event.is_set() or not any([w.is_alive() for w in self.workers]):
+                    raise WorkerError('Data worker processes are not running')
+                continue
+            if kind == 'error':
+                raise WorkerError('Data worker process failed:\n%s' % val)
+            return val
+
+    def stop(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def stop_on(self, coord):
+        """
+        Stop the workers once coord (a tf.train.Coordinator) is asked to stop.  Returns the
+        thread waiting for it, to be joined with the threads of the queue runners.
+        """
+        def _wait():
+            coord.wait_for_stop()
+            self.stop()
+        thread = threading.Thread(target=_wait)
+        thread.daemon = True
+        thread.start()
+        return thread
 
 
 class HDF5DataReader(object):
@@ -486,7 +1833,11 @@ class HDF5DataReader(object):
                  mini_batch_size=None,
                  preprocess=None,
                  postprocess=None,
-                 pad=False):
+                 pad=False,
+                 read_gap=0,
+                 chunk_cache_bytes=0,
+                 preprocess_cache_dir=None,
+                 prefetch=0):
 
         """
         - hdf5source (str): path where hdf5 file resides
@@ -498,14 +1849,32 @@ class HDF5DataReader(object):
              if callable: function producing array of indexes into the source datarrays
            Regardless of how it's constructed, the provider subsets its returns to the only the indices
            specified in the subslice.
-        - mini_batch_size (int):  Used only if subslice is specifiied, this sets the size of minibatches used
-          when constructing one full batch within the subslice to return
+        - mini_batch_size (int):  Used only if subslice is specifiied, this sets the maximum number of rows
+          read at once when constructing one full batch within the subslice to return
         - preprocess (dict of callables): functions for preprocessing data in the datasources.  keys of this are subset
         - postprocess (dict of callables): functions for postprocess data.  Keys of this are subset of sourcelist.
         - pad (bool): whether to pad data returned if amount of data left to return is less then full batch size
+        - read_gap (int, default=0): Used only if subslice is specified.  Runs of subslice indices separated
+          by at most read_gap unused rows are read with a single slice read (see plan_reads).
+        - chunk_cache_bytes (int, default=0): if positive, reads of chunked (e.g. compressed) datasets go
+          through whole, chunk-aligned reads, and decompressed chunks are kept in a LRU cache of at most
+          this many bytes, shared by all readers of the same file in the process (see ChunkCache).  A batch
+          that straddles chunks then does not decompress the shared chunks twice.
+        - preprocess_cache_dir (str or None): if not None, preprocessing is not applied to the full sources
+          when the reader is constructed, but lazily, one block of rows at a time on first access, and the
+          results are stored in memory-mapped cache files in this directory (see LazyPreprocessedDataset).
+          All readers of the same source and preprocessing function share the cache, across threads and
+          processes.  The preprocess functions must then work row by row (each output row depends only on
+          the corresponding input row).
+        - prefetch (int, default=0): if positive, batches are read this many batches ahead on a background
+          thread, with read_direct into a ring of preallocated buffers (see BatchPrefetcher).  Only available
+          without subslice, preprocess or chunk cache.  The arrays passed to postprocess are then views of
+          the ring buffers, valid only until the next batch is read, so postprocess functions must not
+          return them; the arrays of the sources without postprocess are returned as copies, which
+          tf.py_func can keep.
         """
         self.hdf5source = hdf5source
-        self.file = h5py.File(self.hdf5source, 'r')
+        self.file = self.open_file()
         self.sourcelist = sourcelist
 
         self.subslice = subslice
@@ -518,9 +1887,18 @@ class HDF5DataReader(object):
 
         for source in self.sourcelist:
             self.data[source] = self.file[source]
-            if source in self.preprocess:
+            if source in self.preprocess and preprocess_cache_dir is not None:
+                self.data[source] = get_lazy_preprocessed(self.open_file,
+                                                          self.preprocess[source],
+                                                          self.hdf5source,
+                                                          source,
+                                                          preprocess_cache_dir)
+            elif source in self.preprocess:
                 print('Preprocessing %s...' % source)
                 self.data[source] = self.preprocess[source](self.data[source])
+            elif chunk_cache_bytes > 0 and self.data[source].chunks is not None:
+                cache = get_chunk_cache(self.hdf5source, chunk_cache_bytes)
+                self.data[source] = ChunkCachedDataset(self.data[source], cache)
 
         for source in sourcelist:
             if self.subslice is None:
@@ -548,21 +1926,62 @@ class HDF5DataReader(object):
         if mini_batch_size is None:
             mini_batch_size = self.batch_size
         self.mini_batch_size = mini_batch_size
+        self.read_gap = read_gap
         self.total_batches = (self.data_length - 1) // self.batch_size + 1
         self.curr_batch_num = 0
         self.curr_epoch = 1
         self.pad = pad
+        if self.chunk_rows is not None and self.batch_size % self.chunk_rows != 0:
+            log.info('batch_size %d is not a multiple of the %d rows of the chunks of %s' % (
+                self.batch_size, self.chunk_rows, self.hdf5source))
+        self.prefetcher = None
+        self.prefetch = prefetch
+        if self.prefetch > 0:
+            assert self.subslice is None, 'Prefetching is not available with subslice'
+            assert all([hasattr(self.data[source], 'read_direct') for source in self.sourcelist]), \
+                'Prefetching needs the sources to be read directly from the hdf5 file'
+            self.prefetcher = BatchPrefetcher(self, depth=self.prefetch)
+
+    def open_file(self):
+        return h5py.File(self.hdf5source, 'r')
 
     @property
     def labels(self):
         return self.sourcelist
 
+    @property
+    def chunk_rows(self):
+        """
+        Number of rows of the largest chunks (along the first axis) of the sources,
+        or None if no source is chunked.
+        """
+        rows = [self.file[source].chunks[0] for source in self.sourcelist
+                if self.file[source].chunks is not None]
+        return max(rows) if rows else None
+
     def set_epoch_batch(self, epoch, batch_num):
         self.curr_epoch = epoch
         self.curr_batch_num = batch_num
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = BatchPrefetcher(self, depth=self.prefetch)
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        self.file.close()
 
     def get_next_batch(self):
-        data = self.get_batch(self.curr_batch_num)
+        if self.prefetcher is not None:
+            data = self.prefetcher.get()
+            for source in self.sourcelist:
+                if source in self.postprocess:
+                    data[source] = self.postprocess[source](data[source], self.file)
+                else:
+                    data[source] = data[source].copy()
+        else:
+            data = self.get_batch(self.curr_batch_num)
         self.increment_batch_num()
         return data
 
@@ -579,13 +1998,30 @@ class HDF5DataReader(object):
             self.curr_epoch += 1
         self.curr_batch_num = (self.curr_batch_num + 1) % m
 
-    def get_batch(self, cbn):
-        data = {}
+    def batch_bounds(self, cbn):
         startv = cbn * self.batch_size
         endv = (cbn + 1) * self.batch_size
         if self.pad and endv > self.data_length:
             startv = self.data_length - self.batch_size
             endv = startv + self.batch_size
+        return startv, endv
+
+    def read_batch_into(self, cbn, buffers):
+        """
+        Read batch number cbn directly into the arrays of the buffers dict (one per source),
+        returning the number of rows read.
+        """
+        startv, endv = self.batch_bounds(cbn)
+        endv = min(endv, self.data_length)
+        for source in self.sourcelist:
+            self.data[source].read_direct(buffers[source],
+                                          source_sel=np.s_[startv: endv],
+                                          dest_sel=np.s_[0: endv - startv])
+        return endv - startv
+
+    def get_batch(self, cbn):
+        data = {}
+        startv, endv = self.batch_bounds(cbn)
         sourcelist = self.sourcelist
         for source in sourcelist:
             data[source] = self.get_data(self.data[source], slice(startv, endv))
@@ -593,34 +2029,717 @@ class HDF5DataReader(object):
                 data[source] = self.postprocess[source](data[source], self.file)
         return data
 
+    def get_rows(self, inds):
+        """
+        Batch of the records at positions inds (positions in the subslice, if any), with
+        postprocessing applied.
+        """
+        data = {}
+        for source in self.sourcelist:
+            if self.subslice is None:
+                data[source] = read_coalesced(self.data[source], inds,
+                                              max_gap=self.read_gap,
+                                              max_read=self.mini_batch_size)
+            else:
+                data[source] = self.get_data(self.data[source], inds)
+            if source in self.postprocess:
+                data[source] = self.postprocess[source](data[source], self.file)
+        return data
+
     def get_data(self, dsource, sliceval):
         if self.subslice is None:
             return dsource[sliceval]
         else:
             subslice_inds = self.subsliceinds[sliceval]
-            mbs = self.mini_batch_size
-            bn0 = subslice_inds.min() // mbs
-            bn1 = subslice_inds.max() // mbs
-            stims = []
-            for _bn in range(bn0, bn1 + 1):
-                _s = np.asarray(dsource[_bn * mbs: (_bn + 1) * mbs])
-                new_inds = isin(np.arange(_bn * mbs, (_bn + 1) * mbs), subslice_inds)
-                new_array = _s[new_inds]
-                stims.append(new_array)
-            stims = np.concatenate(stims)
-            return stims
+            return read_coalesced(dsource, subslice_inds,
+                                  max_gap=self.read_gap,
+                                  max_read=self.mini_batch_size)
+
+
+class ChunkCache(object):
+    """
+    Thread-safe LRU cache of decompressed HDF5 chunks, holding at most max_bytes bytes.
+    Cached arrays are made read-only, since they are shared.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.chunks:
+                val = self.chunks.pop(key)
+                self.chunks[key] = val
+                return val
+        # decompress outside of the lock so that threads can load different chunks at once
+        val = load()
+        val.flags.writeable = False
+        with self.lock:
+            if key not in self.chunks:
+                self.chunks[key] = val
+                self.nbytes += val.nbytes
+                while self.nbytes > self.max_bytes and len(self.chunks) > 1:
+                    _, old = self.chunks.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return val
+
+
+_CHUNK_CACHES = {}
+_CHUNK_CACHES_LOCK = threading.Lock()
+
+
+def get_chunk_cache(path, max_bytes):
+    """
+    Chunk cache shared by all readers of the file at path in this process.  The size of
+    the cache is set by the first reader that asks for it.  Caches are keyed on the
+    modification time of the file as well, so a file rewritten in place gets a new cache
+    (and the cache of its old contents is dropped).
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    with _CHUNK_CACHES_LOCK:
+        if key not in _CHUNK_CACHES:
+            for k in [k for k in _CHUNK_CACHES if k[0] == path]:
+                del _CHUNK_CACHES[k]
+            _CHUNK_CACHES[key] = ChunkCache(max_bytes)
+        return _CHUNK_CACHES[key]
+
+
+class ChunkCachedDataset(object):
+    """
+    Wrapper of a chunked h5py dataset, for reading row slices through a ChunkCache.
+
+    Slices along the first axis are served from whole, chunk-aligned reads, so each chunk
+    is decompressed once while in the cache.  Other selections are passed to the dataset.
+    Returned arrays may be read-only views of cached chunks.
+    """
+    def __init__(self, dataset, cache):
+        self.dataset = dataset
+        self.cache = cache
+        self.chunks = dataset.chunks
+        self.chunk_rows = dataset.chunks[0]
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.name = dataset.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_chunk(self, c):
+        cr = self.chunk_rows
+        return self.cache.get((self.name, c), lambda: self.dataset[c * cr: (c + 1) * cr])
+
+    def __getitem__(self, sliceval):
+        if not isinstance(sliceval, slice):
+            return self.dataset[sliceval]
+        start, stop, step = sliceval.indices(self.shape[0])
+        if step != 1 or start >= stop:
+            return self.dataset[sliceval]
+        cr = self.chunk_rows
+        c0, c1 = start // cr, (stop - 1) // cr
+        chunks = [self.read_chunk(c) for c in range(c0, c1 + 1)]
+        data = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        return data[start - c0 * cr: stop - c0 * cr]
+
+
+DEFAULT_PREPROCESS_BLOCK_BYTES = 2 ** 26
+
+
+class LazyPreprocessedDataset(object):
+    """
+    Result of a row-wise preprocessing function applied to a dataset, computed lazily one
+    block of rows at a time and stored in a memory-mapped cache file.
+
+    The cache consists of cache_path + '.npy', holding the preprocessed array, and
+    cache_path + '.done', holding one flag per block.  Several LazyPreprocessedDataset
+    objects (in the same or different processes) with the same cache_path share the
+    computed blocks.  The source is read through a file of its own, opened with open_file
+    (again in processes forked from the one that opened it), so that closing the readers
+    of the source does not affect it.
+
+    Arguments:
+        - open_file (callable): opens the file holding the source, e.g. HDF5DataReader.open_file
+        - source (str): key of the source in the file
+        - func (callable): preprocessing function, applied to blocks of rows of the source
+        - cache_path (str): path prefix of the cache files
+        - block_rows (int or None): rows per block.  If None, blocks of about
+          DEFAULT_PREPROCESS_BLOCK_BYTES of input, rounded to the source's chunks.
+    """
+    def __init__(self, open_file, source, func, cache_path, block_rows=None):
+        self.open_file = open_file
+        self.source = source
+        self.file = None
+        self.pid = None
+        self.func = func
+        self.cache_path = cache_path
+        dataset = self.dataset
+        n = dataset.shape[0]
+        if block_rows is None:
+            row_bytes = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+            block_rows = max(1, DEFAULT_PREPROCESS_BLOCK_BYTES // max(1, row_bytes))
+            chunks = getattr(dataset, 'chunks', None)
+            if chunks is not None:
+                block_rows = max(1, block_rows // chunks[0]) * chunks[0]
+        self.block_rows = min(block_rows, n)
+        self.n_blocks = (n - 1) // self.block_rows + 1
+        self.lock = threading.Lock()
+
+        first = None
+        if not os.path.exists(cache_path + '.npy'):
+            # the first block gives the shape and dtype of the preprocessed data
+            first = self.compute_block(0)
+            shape = (n, ) + first.shape[1:]
+            self.open_cache(cache_path + '.npy',
+                            lambda p: np.lib.format.open_memmap(p, mode='w+', dtype=first.dtype, shape=shape))
+        self.cache = np.load(cache_path + '.npy', mmap_mode='r+')
+        self.shape = self.cache.shape
+        self.dtype = self.cache.dtype
+        self.chunks = None
+        assert self.shape[0] == n, 'Cache file %s does not match the preprocessed data' % cache_path
+        self.open_cache(cache_path + '.done',
+                        lambda p: np.memmap(p, dtype=np.uint8, mode='w+', shape=(self.n_blocks, )))
+        self.done = np.memmap(cache_path + '.done', dtype=np.uint8, mode='r+', shape=(self.n_blocks, ))
+        if first is not None and not self.done[0]:
+            self.store_block(0, first)
+
+    @property
+    def dataset(self):
+        if self.file is None or self.pid != os.getpid():
+            self.file = self.open_file()
+            self.pid = os.getpid()
+        return self.file[self.source]
+
+    @staticmethod
+    def open_cache(path, create):
+        if not os.path.exists(path):
+            # create under a temporary name and link it in place, so that concurrent
+            # readers never see a partial file nor overwrite each other's
+            tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            arr = create(tmp_path)
+            arr.flush()
+            del arr
+            try:
+                os.link(tmp_path, path)
+            except OSError:
+                pass
+            os.remove(tmp_path)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def compute_block(self, b):
+        start = b * self.block_rows
+        dataset = self.dataset
+        stop = min(start + self.block_rows, dataset.shape[0])
+        out = np.asarray(self.func(dataset[start: stop]))
+        assert len(out) == stop - start, 'Lazy preprocessing must preserve the number of rows'
+        return out
+
+    def store_block(self, b, out):
+        start = b * self.block_rows
+        self.cache[start: start + len(out)] = out
+        self.cache.flush()
+        self.done[b] = 1
+        self.done.flush()
+
+    def ensure(self, start, stop):
+        for b in range(start // self.block_rows, (stop - 1) // self.block_rows + 1):
+            if not self.done[b]:
+                with self.lock:
+                    if not self.done[b]:
+                        self.store_block(b, self.compute_block(b))
+
+    def __getitem__(self, sel):
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(len(self))
+            if start < stop:
+                self.ensure(start, stop)
+            return np.array(self.cache[sel])
+        elif isinstance(sel, (int, np.integer)):
+            self.ensure(sel, sel + 1)
+            return np.array(self.cache[sel])
+        else:
+            return read_coalesced(self, np.asarray(sel))
+
+
+_LAZY_SOURCES = {}
+_LAZY_SOURCES_LOCK = threading.Lock()
+
+
+def get_lazy_preprocessed(open_file, func, hdf5source, source, cache_dir):
+    """
+    LazyPreprocessedDataset for func applied to the source of hdf5source (opened with
+    open_file), shared by all readers in the process.  The cache files are named after the
+    path and modification time of hdf5source, the source key and func (its name and code,
+    see func_key), so that changing any of these uses a new cache.
+    """
+    key = repr((os.path.abspath(hdf5source), os.path.getmtime(hdf5source), source, func_key(func)))
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+    # forked processes build their own, reading through their own file
+    registry_key = (os.getpid(), cache_path)
+    with _LAZY_SOURCES_LOCK:
+        if registry_key not in _LAZY_SOURCES:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _LAZY_SOURCES[registry_key] = LazyPreprocessedDataset(open_file, source, func, cache_path)
+        return _LAZY_SOURCES[registry_key]
+
+
+def aligned_blocks(N, n, align=None):
+    """
+    Split range(N) into n contiguous blocks, returned as [start, stop] pairs.  If align is
+    not None, block boundaries are rounded to multiples of align (e.g. the rows of the
+    HDF5 chunks), so that different threads do not read the same chunks.
+    """
+    if align is not None and align > 1:
+        bounds = [min(N, int(round(i * N / (n * align))) * align) for i in range(n + 1)]
+        ends = [[bounds[i], bounds[i + 1]] for i in range(n)]
+        ends[-1][1] = N
+        if all([e0 < e1 for e0, e1 in ends]):
+            return ends
+        # too few chunks for every thread to get some: fall back to unaligned blocks
+    blocksize = N // n
+    ends = [[i * blocksize, (i + 1) * blocksize] for i in range(n)]
+    ends[-1][1] = max(ends[-1][1], N)
+    return ends
+
+
+def plan_reads(indices, max_gap=0, max_read=None):
+    """
+    Plan the slice reads needed to fetch the rows at `indices` of an array.
+
+    The sorted unique indices are grouped into contiguous runs, and runs separated by at
+    most `max_gap` unrequested rows are merged into one read.  If `max_read` is not None,
+    reads are split so that none is longer than `max_read` rows (reads that would contain
+    no requested row are dropped).
+
+    Returns a list of (start, stop) pairs, in increasing order.
+    """
+    uniq = np.unique(indices)
+    if len(uniq) == 0:
+        return []
+    breaks = (np.diff(uniq) > max_gap + 1).nonzero()[0] + 1
+    starts = uniq[np.concatenate([[0], breaks])]
+    stops = uniq[np.concatenate([breaks - 1, [len(uniq) - 1]])] + 1
+    reads = []
+    for start, stop in zip(starts, stops):
+        if max_read is None or stop - start <= max_read:
+            reads.append((int(start), int(stop)))
+            continue
+        for p0 in range(start, stop, max_read):
+            i0, i1 = uniq.searchsorted([p0, min(p0 + max_read, stop)])
+            if i0 < i1:
+                reads.append((int(uniq[i0]), int(uniq[i1 - 1]) + 1))
+    return reads
+
+
+def read_coalesced(dsource, indices, max_gap=0, max_read=None):
+    """
+    Read the rows `dsource[indices]`, in the requested order, with the minimal set of slice
+    reads given by plan_reads.  `dsource` can be any array supporting slicing, e.g. a h5py
+    dataset.
+    """
+    indices = np.asarray(indices)
+    reads = plan_reads(indices, max_gap=max_gap, max_read=max_read)
+    if not reads:
+        return np.asarray(dsource[0:0])
+    data = np.concatenate([np.asarray(dsource[start: stop]) for start, stop in reads])
+    starts = np.array([start for start, _ in reads])
+    offsets = np.cumsum([0] + [stop - start for start, stop in reads[:-1]])
+    read_inds = starts.searchsorted(indices, side='right') - 1
+    return data[offsets[read_inds] + indices - starts[read_inds]]
+
+
+class BatchPrefetcher(object):
+    """
+    Reads the batches of a HDF5DataReader ahead on a background thread.
+
+    Each source has a ring of depth + 1 preallocated batch buffers, filled with read_direct
+    up to depth batches ahead of the consumer.  get hands out views of the buffers, so that
+    steady state reading does no allocation; the buffer handed out by one call to get is
+    recycled at the next call.
+    """
+    def __init__(self, reader, depth=1):
+        self.reader = reader
+        self.depth = depth
+        self.buffers = []
+        for _ in range(depth + 1):
+            bufs = {}
+            for source in reader.sourcelist:
+                dsource = reader.data[source]
+                bufs[source] = np.empty((reader.batch_size, ) + dsource.shape[1:], dtype=dsource.dtype)
+            self.buffers.append(bufs)
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for slot in range(depth + 1):
+            self.free.put(slot)
+        self.held = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(reader.curr_batch_num, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, cbn):
+        while True:
+            slot = self.free.get()
+            if slot is None or self.stopped.is_set():
+                return
+            try:
+                n = self.reader.read_batch_into(cbn, self.buffers[slot])
+            except Exception as error:
+                self.full.put((None, error))
+                return
+            self.full.put((slot, n))
+            cbn = (cbn + 1) % self.reader.total_batches
+
+    def get(self):
+        if self.held is not None:
+            self.free.put(self.held)
+        slot, n = self.full.get()
+        if slot is None:
+            raise n
+        self.held = slot
+        return {source: buf[:n] for source, buf in self.buffers[slot].items()}
+
+    def stop(self):
+        self.stopped.set()
+        self.free.put(None)
+        self.thread.join()
+
+
+DEFAULT_HDF5_GLOB_PATTERN = '*.hdf5'
+
+
+class ShardedDataset(object):
+    """
+    Read-only view of the datasets with the same key in several HDF5 shards, as one dataset
+    concatenated along the first axis.  Supports slices and arrays of (global) indices.
+    """
+    def __init__(self, datasets):
+        self.datasets = datasets
+        lens = [len(ds) for ds in datasets]
+        self.bounds = np.cumsum([0] + lens)
+        self.shape = (int(self.bounds[-1]), ) + datasets[0].shape[1:]
+        self.dtype = datasets[0].dtype
+        self.name = getattr(datasets[0], 'name', None)
+        # chunks differ from shard to shard, so the chunk layout is not exposed
+        self.chunks = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def overlaps(self, start, stop):
+        """(shard number, start, stop) of the parts of [start, stop) in each shard, in local indices"""
+        for i in range(len(self.datasets)):
+            b0, b1 = self.bounds[i], self.bounds[i + 1]
+            s0, s1 = max(start, b0), min(stop, b1)
+            if s0 < s1:
+                yield i, int(s0 - b0), int(s1 - b0)
+
+    def __getitem__(self, sel):
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported'
+            parts = [self.datasets[i][s0: s1] for i, s0, s1 in self.overlaps(start, stop)]
+            if not parts:
+                return np.empty((0, ) + self.shape[1:], dtype=self.dtype)
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        elif isinstance(sel, (int, np.integer)):
+            i = self.bounds.searchsorted(sel, side='right') - 1
+            return self.datasets[i][sel - self.bounds[i]]
+        else:
+            return read_coalesced(self, np.asarray(sel))
+
+    def read_direct(self, dest, source_sel, dest_sel):
+        start, stop, _ = source_sel.indices(len(self))
+        d0 = dest_sel.start or 0
+        for i, s0, s1 in self.overlaps(start, stop):
+            g0 = s0 + self.bounds[i] - start
+            if hasattr(self.datasets[i], 'read_direct'):
+                self.datasets[i].read_direct(dest,
+                                             source_sel=np.s_[s0: s1],
+                                             dest_sel=np.s_[d0 + g0: d0 + g0 + s1 - s0])
+            else:
+                dest[d0 + g0: d0 + g0 + s1 - s0] = self.datasets[i][s0: s1]
+
+
+class ShardedHDF5File(object):
+    """
+    A directory (or list) of HDF5 shards seen as one virtual file: indexing it with a key
+    gives the ShardedDataset of the datasets with that key in all shards, in shard order.
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        self.files = [h5py.File(path, 'r') for path in paths]
+
+    def __getitem__(self, key):
+        return ShardedDataset([f[key] for f in self.files])
+
+    def __contains__(self, key):
+        return key in self.files[0]
+
+    def keys(self):
+        return self.files[0].keys()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def get_shard_paths(hdf5source, file_pattern=DEFAULT_HDF5_GLOB_PATTERN):
+    if isinstance(hdf5source, list):
+        return hdf5source
+    assert os.path.isdir(hdf5source), hdf5source
+    paths = glob.glob(os.path.join(hdf5source, file_pattern))
+    paths.sort()
+    assert len(paths) > 0, 'No hdf5 shards found in %s' % hdf5source
+    return paths
+
+
+def shard_blocks(bounds, n):
+    """
+    Split shards with (cumulative) row boundaries bounds into n contiguous groups of roughly
+    equal numbers of rows, returned as [start, stop] row pairs.  Returns None if there are
+    fewer shards than groups.
+    """
+    bounds = np.asarray(bounds)
+    if len(bounds) - 1 < n:
+        return None
+    cuts = [0]
+    for i in range(1, n):
+        target = bounds[-1] * i / n
+        # closest boundary, leaving at least one shard for each remaining group
+        lo = np.searchsorted(bounds, cuts[-1], side='right')
+        hi = len(bounds) - 1 - (n - i)
+        candidates = bounds[lo: hi + 1]
+        cuts.append(int(candidates[np.abs(candidates - target).argmin()]))
+    cuts.append(int(bounds[-1]))
+    return [[cuts[i], cuts[i + 1]] for i in range(n)]
+
+
+class ShardedHDF5DataReader(HDF5DataReader):
+    def __init__(self, hdf5source, sourcelist, batch_size, file_pattern=DEFAULT_HDF5_GLOB_PATTERN, **kwargs):
+        """
+        HDF5DataReader over a set of HDF5 shards, treated as one virtual dataset.
+
+        - hdf5source (str or list of strs): directory containing the shards (the files matching
+          file_pattern, in sorted order), or list of shard paths.  All shards must contain the keys
+          in sourcelist.  Indices (e.g. in subslice) are global indices in the concatenation of
+          the shards.
+
+        All other arguments are those of HDF5DataReader.  With ParallelBySliceProvider (or
+        ProcessPoolProvider), mode='shard' gives whole shards to each reader.
+        """
+        self.file_pattern = file_pattern
+        super(ShardedHDF5DataReader, self).__init__(hdf5source, sourcelist, batch_size, **kwargs)
+
+    def open_file(self):
+        return ShardedHDF5File(get_shard_paths(self.hdf5source, self.file_pattern))
+
+    @property
+    def shard_bounds(self):
+        """Global index boundaries of the shards."""
+        return self.file[self.sourcelist[0]].bounds
+
+
+class NpyShardsFile(object):
+    """
+    A dataset directory in the columnar .npy shard format (see tfutils/manifest.py) seen as
+    one virtual file: indexing it with an attribute gives the ShardedDataset of the
+    memory-mapped shards of that attribute.  Only the attributes that are indexed are opened.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = manifest.load_manifest(directory, format=manifest.NPY_FORMAT)
+        assert self.manifest is not None, 'No npy shards manifest in %s' % directory
+        self.datasets = {}
+
+    def __getitem__(self, key):
+        if key not in self.datasets:
+            assert key in self, 'Unknown attribute %s in %s' % (key, self.directory)
+            self.datasets[key] = ShardedDataset(
+                [np.load(manifest.npy_shard_path(self.directory, key, f['name']), mmap_mode='r')
+                 for f in self.manifest['files']])
+        return self.datasets[key]
+
+    def __contains__(self, key):
+        return key in self.manifest['meta']
+
+    def keys(self):
+        return self.manifest['meta'].keys()
+
+    def close(self):
+        self.datasets = {}
+
+
+class NpyShardsDataReader(HDF5DataReader):
+    def __init__(self, source, sourcelist, batch_size, **kwargs):
+        """
+        HDF5DataReader over a dataset in the columnar .npy shard format, where each
+        attribute of each shard is a .npy file, memory-mapped when read.  Batches are
+        plain slices of the memory-mapped arrays, with no parsing or decoding, and only
+        the attributes in sourcelist are opened.
+
+        - source (str): dataset directory, with a manifest describing the shards (see
+          tfutils/manifest.py and tfutils/convert.py)
+
+        All other arguments are those of HDF5DataReader, with indices in the concatenation
+        of the shards.  With ParallelBySliceProvider, mode='shard' gives whole shards to
+        each reader.
+        """
+        super(NpyShardsDataReader, self).__init__(source, sourcelist, batch_size, **kwargs)
+
+    def open_file(self):
+        return NpyShardsFile(self.hdf5source)
+
+    @property
+    def shard_bounds(self):
+        """Global index boundaries of the shards."""
+        return self.file[self.sourcelist[0]].bounds
+
+
+class NpyShardsProvider(ParallelBySliceProvider):
+    def __init__(self,
+                 source,
+                 meta_dicts=None,
+                 batch_size=256,
+                 n_threads=1,
+                 mode='block',
+                 postprocess=None,
+                 **kwargs):
+        """
+        Data provider for datasets in the columnar .npy shard format, reading batches with
+        n_threads NpyShardsDataReader readers (see ParallelBySliceProvider).
+
+        - source (str): dataset directory
+        - meta_dicts (str, list of strs, dict or None): attributes to read (column
+          projection): an attribute name, a list of names, or a dict whose keys are the
+          names.  If None, all the attributes of the dataset are read.
+        - postprocess (dict): per-attribute postprocessing chains, applied to the tensors,
+          as in ParallelBySliceProvider.
+        - **kwargs: other keyword arguments of NpyShardsDataReader (e.g. subslice, prefetch,
+          read_gap) or of ParallelBySliceProvider (e.g. shuffle_seed, run_size, or
+          postprocess_after_dequeue).
+        """
+        if meta_dicts is None:
+            sourcelist = sorted(manifest.load_manifest(source, format=manifest.NPY_FORMAT)['meta'])
+        elif isstring(meta_dicts):
+            sourcelist = [meta_dicts]
+        else:
+            sourcelist = sorted(meta_dicts)
+        provider_kwargs = {k: kwargs.pop(k) for k in ['shuffle_seed', 'run_size', 'postprocess_after_dequeue']
+                           if k in kwargs}
+        reader_kwargs = dict(kwargs)
+        reader_kwargs.update({'source': source, 'sourcelist': sourcelist})
+        super(NpyShardsProvider, self).__init__(NpyShardsDataReader,
+                                                reader_kwargs,
+                                                mode=mode,
+                                                batch_size=batch_size,
+                                                n_threads=n_threads,
+                                                postprocess=postprocess,
+                                                **provider_kwargs)
 
 
 def get_unique_labels(larray):
-    larray = larray[:]
-    labels_unique = np.unique(larray)
-    s = larray.argsort()
-    cat_s = larray[s]
-    ss = np.array([0] + ((cat_s[1:] != cat_s[:-1]).nonzero()[0] + 1).tolist() + [len(cat_s)])
-    ssd = ss[1:] - ss[:-1]
-    labels = np.repeat(np.arange(len(labels_unique)), ssd)
-    larray = labels[perminverse(s)]
-    return larray.astype(np.int64)
+    """
+    Encode the labels in larray as integers, the index of each label in the sorted
+    array of unique labels.
+    """
+    _, labels = np.unique(larray[:], return_inverse=True)
+    return labels.astype(np.int64)
+
+
+DEFAULT_LABEL_CHUNK_ROWS = 2 ** 22
+
+
+def get_unique_labels_chunked(larray, out=None, chunk_rows=DEFAULT_LABEL_CHUNK_ROWS):
+    """
+    Out-of-core version of get_unique_labels, for label arrays too large to load in memory.
+
+    A first pass over larray, chunk_rows rows at a time, builds the sorted vocabulary of
+    labels, and a second pass writes the index of each label in the vocabulary to out.
+    Only one chunk and the vocabulary are held in memory.  The result is the same as
+    get_unique_labels(larray).
+
+    Arguments:
+        - larray: 1-d array-like supporting slicing, e.g. a h5py dataset
+        - out: where to write the int64 encoded labels.  If None, a memory-mapped .npy file
+          is created in the temporary directory and unlinked at once, so that its space is
+          freed when the array is released.  If a string, the path of a memory-mapped .npy
+          file: it is written under a temporary name and renamed into place once complete,
+          with the key of larray (see labels_source_key) in out + '.source', and if it
+          already exists with the key of larray it is reused without recomputing it.  Otherwise out must be an array-like of the length of larray
+          supporting slice assignment, e.g. a h5py dataset created in a file opened in
+          'r+' mode, to write the labels back into the HDF5 file.
+        - chunk_rows (int): rows read at once
+
+    Returns out (the memory-mapped array if out was None or a string), so that e.g.
+    functools.partial(get_unique_labels_chunked, out='/scratch/labels.npy') can be used as
+    a preprocess function of HDF5DataReader.  With a path, all the readers built by a
+    provider (and other processes) share one output file; with out=None each reader
+    computes its own.
+
+    The encoding depends on the whole array, so this is not a row-wise function: do not use
+    it as a preprocess function together with preprocess_cache_dir, which applies the
+    preprocessing one block of rows at a time.
+    """
+    n = len(larray)
+    path = None
+    if isstring(out):
+        path = out
+        key = labels_source_key(larray, chunk_rows)
+        if os.path.exists(path) and os.path.exists(path + '.source'):
+            with open(path + '.source') as f:
+                if f.read() == key:
+                    return np.load(path, mmap_mode='r')
+
+    vocab = None
+    for start in range(0, n, chunk_rows):
+        chunk_vocab = np.unique(larray[start: start + chunk_rows])
+        vocab = chunk_vocab if vocab is None else np.union1d(vocab, chunk_vocab)
+
+    tmp_path = None
+    if out is None:
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+    elif path is not None:
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    if tmp_path is not None:
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int64, shape=(n, ))
+        if path is None:
+            # the mapping stays valid; the file goes away with it
+            os.remove(tmp_path)
+    for start in range(0, n, chunk_rows):
+        out[start: start + chunk_rows] = vocab.searchsorted(larray[start: start + chunk_rows])
+    if hasattr(out, 'flush'):
+        out.flush()
+    if path is not None:
+        os.rename(tmp_path, path)
+        # the key goes last, so that an output never looks like it comes from another source
+        with open(tmp_path + '.source', 'w') as f:
+            f.write(key)
+        os.rename(tmp_path + '.source', path + '.source')
+    return out
+
+
+def labels_source_key(larray, chunk_rows=DEFAULT_LABEL_CHUNK_ROWS):
+    """
+    Key identifying the contents of larray for get_unique_labels_chunked: the path,
+    modification time and name of h5py datasets, or else a hash of the data, read
+    chunk_rows rows at a time.
+    """
+    h5file = getattr(larray, 'file', None)
+    if h5file is not None and hasattr(larray, 'name'):
+        filename = os.path.abspath(h5file.filename)
+        return repr((filename, os.path.getmtime(filename), larray.name, len(larray)))
+    h = hashlib.sha1()
+    for start in range(0, len(larray), chunk_rows):
+        chunk = np.asarray(larray[start: start + chunk_rows])
+        h.update(repr((chunk.dtype.str, chunk.shape)))
+        h.update(np.ascontiguousarray(chunk).tobytes())
+    return h.hexdigest()
 
 
 def perminverse(s):
@@ -629,11 +2748,52 @@ def perminverse(s):
 
     From yamutils
     """
-    X = np.array(range(len(s)))
-    X[s] = range(len(s))
+    X = np.empty(len(s), dtype=np.int64)
+    X[s] = np.arange(len(s))
     return X
 
 
+class Membership(object):
+    """
+    Membership test for the elements of a numpy array `Y`, built once and reusable
+    for many queries.
+
+    Integer arrays spanning a small enough range (at most bitmap_factor times the number
+    of elements of `Y`) are stored as a bitmap, so that a query is a single fancy-indexing
+    operation.  Otherwise a sorted copy of `Y` is kept and queries use searchsorted.
+    Calling the object on an array `X` returns the boolean array `X[i] in Y`.
+    """
+    def __init__(self, Y, bitmap_factor=8):
+        Y = np.asarray(Y)
+        self.size = len(Y)
+        self.bitmap = None
+        self.sorted = None
+        if self.size == 0:
+            return
+        if Y.dtype.kind in 'iub':
+            lo, hi = int(Y.min()), int(Y.max())
+            if hi - lo + 1 <= bitmap_factor * self.size:
+                self.offset = lo
+                self.bitmap = np.zeros(hi - lo + 1, dtype=bool)
+                self.bitmap[Y.astype(np.int64) - lo] = True
+                return
+        self.sorted = np.sort(Y)
+
+    def __call__(self, X):
+        X = np.asarray(X)
+        if self.size == 0:
+            return np.zeros(X.shape, dtype=bool)
+        if self.bitmap is not None:
+            inds = X.astype(np.int64) - self.offset
+            inside = (inds >= 0) & (inds < len(self.bitmap))
+            out = np.zeros(X.shape, dtype=bool)
+            out[inside] = self.bitmap[inds[inside]]
+            return out
+        D = self.sorted.searchsorted(X)
+        D[D == self.size] = 0
+        return self.sorted[D] == X
+
+
 def isin(X, Y):
     """
     Indices of elements in a numpy array that appear in another.
@@ -644,9 +2804,11 @@ def isin(X, Y):
             **X** :  numpy array
                     Numpy array to comapare to numpy array `Y`.  For each
                     element of `X`, ask if it is in `Y`.
-            **Y** :  numpy array
+            **Y** :  numpy array or Membership
                     Numpy array to which numpy array `X` is compared.  For each
-                    element of `X`, ask if it is in `Y`.
+                    element of `X`, ask if it is in `Y`.  When testing many arrays
+                    against the same `Y`, pass Membership(Y) to build the lookup
+                    structure only once.
     **Returns**
             **b** :  numpy array (bool)
                     Boolean numpy array, `len(b) = len(X)`.
@@ -654,18 +2816,9 @@ def isin(X, Y):
             :func:`tabular.fast.recarrayisin`,
             :func:`tabular.fast.arraydifference`
     """
-    if len(Y) > 0:
-        T = Y.copy()
-        T.sort()
-        D = T.searchsorted(X)
-        T = np.append(T, np.array([0]))
-        W = (T[D] == X)
-        if isinstance(W, bool):
-            return np.zeros((len(X), ), bool)
-        else:
-            return (T[D] == X)
-    else:
-        return np.zeros((len(X), ), bool)
+    if not isinstance(Y, Membership):
+        Y = Membership(Y)
+    return Y(X)
 
 
 def get_queue(nodes,
@@ -784,6 +2937,7 @@ class ImageNet(HDF5DataReader):
                  group='train',
                  batch_size=1,
                  crop_size=None,
+                 normalize_in_graph=False,
                  *args,
                  **kwargs):
         """
@@ -804,8 +2958,17 @@ class ImageNet(HDF5DataReader):
                 image at a time is ok.
             - crop_size (int or None, default: None)
                 For center crop (crop_size x crop_size). If None, no cropping will occur.
+            - normalize_in_graph (bool, default: False)
+                If False, images are returned as float32 in [0, 1].  If True, they are
+                returned as uint8, so that only the cropped pixels go through py_func and the
+                queues, and their conversion to float32 in [0, 1] is declared in
+                graph_postprocess, which ParallelBySliceProvider applies in the graph.  Only
+                use it with ParallelBySliceProvider (e.g. kwargs={'normalize_in_graph': True}).
             - *args, **kwargs
                 Extra arguments for HDF5DataProvider
+
+        Images are cropped before their conversion to float32, so only the kept pixels
+        are converted.
         """
         self.group = group
         images_key = group + '/images'
@@ -821,22 +2984,27 @@ class ImageNet(HDF5DataReader):
             self.crop_size = 256
         else:
             self.crop_size = crop_size
+        self.normalize_in_graph = normalize_in_graph
+        if normalize_in_graph:
+            self.graph_postprocess = {images_key: [(self.normalize_images, (), {})]}
 
     def postproc_img(self, ims, f):
-        norm = ims.astype(np.float32) / 255.0
-
-        off = np.random.randint(0, 256 - self.crop_size, size=2)
-
         if self.group == 'train':
-            off = np.random.randint(0, 256 - self.crop_size, size=2)
+            off = np.random.randint(0, 256 - self.crop_size + 1, size=2)
         else:
             off = int((256 - self.crop_size) / 2)
             off = [off, off]
-        images_batch = norm[:,
-                            off[0]: off[0] + self.crop_size,
-                            off[1]: off[1] + self.crop_size]
+        images_batch = ims[:,
+                           off[0]: off[0] + self.crop_size,
+                           off[1]: off[1] + self.crop_size]
+        if not self.normalize_in_graph:
+            images_batch = images_batch.astype(np.float32) / 255.0
         return images_batch
 
+    @staticmethod
+    def normalize_images(ims):
+        return tf.image.convert_image_dtype(ims, dtype=tf.float32)
+
     def postproc_labels(self, labels, f):
         return labels.astype(np.int32)
 
@@ -849,22 +3017,44 @@ class ImageNet(HDF5DataReader):
 
 class ImageNetTF(TFRecordsParallelByFileProvider):
 
-    def __init__(self, source_dirs, crop_size=224, **kwargs):
+    def __init__(self,
+                 source_dirs,
+                 crop_size=224,
+                 train=True,
+                 flip=False,
+                 color_jitter=None,
+                 seed=None,
+                 **kwargs):
         """
         ImageNet data provider for TFRecords
+
+        Images are decoded, cropped and augmented as whole batches (see tfutils.augment).
+        Arguments:
+            - crop_size (int, default=224): size of the (square) crops
+            - train (bool, default=True): random crops if True, center crops otherwise
+            - flip (bool, default=False): randomly flip images left to right
+            - color_jitter (dict or None): keyword arguments of augment.color_jitter
+            - seed (int or None): seed of the augmentation random streams
         """
         self.crop_size = crop_size
+        self.train = train
+        self.flip = flip
+        self.color_jitter = color_jitter
+        self.seed = seed
         postprocess = {'images': [(self.postprocess_images, (), {})]}
         super(ImageNetTF, self).__init__(source_dirs, postprocess=postprocess, **kwargs)
 
     def postprocess_images(self, ims):
-        def _postprocess_images(im):
-            im = tf.decode_raw(im, np.uint8)
-            im = tf.image.convert_image_dtype(im, dtype=tf.float32)
-            im = tf.reshape(im, [256, 256, 3])
-            im = tf.random_crop(im, [self.crop_size, self.crop_size, 3])
-            return im
-        return tf.map_fn(lambda im: _postprocess_images(im), ims, dtype=tf.float32)
+        if ims.dtype == tf.string:
+            # raw bytes; encoded images are already decoded by the standard postprocessing
+            ims = tf.decode_raw(ims, tf.uint8)
+            ims = tf.reshape(ims, [-1, 256, 256, 3])
+        return augment.augment_images(ims,
+                                      self.crop_size,
+                                      train=self.train,
+                                      flip=self.flip,
+                                      jitter=self.color_jitter,
+                                      seed=self.seed)
 
 
 class Coordinator(object):
@@ -901,6 +3091,55 @@ class Item(object):
                 return val
 
 
+def get_page_cache_bytes():
+    """Half of the physical memory, or 0 if it cannot be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def cache_aware_cycle(ls, sizes, cache_bytes, order='alternate', rng=None):
+    """
+    Cycle through the elements of ls, epoch after epoch, starting each epoch with the
+    elements read at the end of the previous one, which are the most likely to still be in
+    the page cache.
+
+    Arguments:
+        - ls (list): elements (e.g. files) to cycle through
+        - sizes (list of numbers): size of each element
+        - cache_bytes (int): total size of the elements expected to stay in the cache
+        - order (str): 'alternate' for epochs alternately in forward and reverse order, or
+          'rotate' for each epoch to start with the last elements of the previous epoch that
+          fit in cache_bytes, followed by the others in the same order
+        - rng (numpy RandomState or None): if not None, the order of each epoch is random:
+          the last elements of the previous epoch that fit in cache_bytes come first in
+          random order, followed by the others in random order.
+    """
+    inds = range(len(ls))
+    if rng is not None:
+        rng.shuffle(inds)
+    while True:
+        for i in inds:
+            yield ls[i]
+        m = 0
+        total = 0
+        for i in reversed(inds):
+            total += sizes[i]
+            if total > cache_bytes:
+                break
+            m += 1
+        head, tail = inds[len(inds) - m:], inds[:len(inds) - m]
+        if rng is not None:
+            rng.shuffle(head)
+            rng.shuffle(tail)
+            inds = head + tail
+        elif order == 'alternate':
+            inds = inds[::-1]
+        else:
+            inds = head + tail
+
+
 def random_cycle(ls, rng):
     local_ls = ls[:]
     while True:
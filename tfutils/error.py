@@ -18,3 +18,9 @@ class ThreadError(Exception):
     """Exception class to raise if a thread has an issue."""
 
     pass
+
+
+class WorkerError(Exception):
+    """Exception class to raise if a data worker process has an issue."""
+
+    pass
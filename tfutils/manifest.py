@@ -0,0 +1,261 @@
+"""
+Dataset manifests.
+
+A manifest is a pickle file, MANIFEST_FILENAME, stored in a dataset directory next to the
+data files.  It lists the data files with their byte sizes, record counts, modification
+times and optionally CRC32 checksums, together with the attribute metadata of the
+directory (the merged contents of its meta*.pkl files) and the compression of the files.
+Data providers use it to start without globbing the directory or unpickling the metadata
+files, and to know the exact number of records of the dataset.
+
+Manifests also describe datasets in the columnar .npy shard format (format NPY_FORMAT),
+where the files are shards and each attribute of shard name is stored in
+directory/attribute/name.npy (see npy_shard_path, and tfutils.convert for writers).
+
+Usage:
+    python -m tfutils.manifest dir1 [dir2 ...] [--pattern '*.tfrecords'] [--checksums]
+                                               [--compression GZIP]
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import zlib
+import fnmatch
+import functools
+import cPickle
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+MANIFEST_FILENAME = 'manifest.pkl'
+DEFAULT_FILE_PATTERN = '*.tfrecords'
+COMPRESSION_TYPES = {'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+                     'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB}
+MANIFEST_VERSION = 1
+TFRECORDS_FORMAT = 'tfrecords'
+NPY_FORMAT = 'npy'
+CHECKSUM_BLOCK_BYTES = 2 ** 24
+# suffix of the files being written (e.g. shards of tfutils.convert), never data files
+PARTIAL_FILE_SUFFIX = '.tmp'
+
+
+def compressed_file_pattern(file_pattern, compression):
+    """
+    Pattern of the files of a group with compression: the default pattern also matches
+    suffixed names (e.g. file.tfrecords.gz) for compressed groups.  Partial files, which
+    the widened pattern matches too, are left out by glob_data_files.
+    """
+    if compression and file_pattern == DEFAULT_FILE_PATTERN:
+        return file_pattern + '*'
+    return file_pattern
+
+
+def is_data_file(name):
+    return not name.endswith(PARTIAL_FILE_SUFFIX)
+
+
+def glob_data_files(directory, file_pattern):
+    """Sorted paths of the files of directory matching file_pattern, except partial files."""
+    return sorted([path for path in tf.gfile.Glob(os.path.join(directory, file_pattern))
+                   if is_data_file(path)])
+
+
+def count_records(path, compression=None, meta=None):
+    """
+    Number of records of the TFRecords file path, compressed with compression.  If the
+    attribute metadata meta declares packed attributes (see
+    tfutils.data.TFRecordsParallelByFileProvider), the records packed in each Example are
+    counted.
+    """
+    options = None
+    if compression is not None:
+        options = tf.python_io.TFRecordOptions(COMPRESSION_TYPES[compression])
+    packed = [k for k in meta or {} if meta[k].get('packed')]
+    if not packed:
+        return sum([1 for _ in tf.python_io.tf_record_iterator(path, options=options)])
+    k = packed[0]
+    record_bytes = tf.as_dtype(meta[k]['dtype']).size * int(np.prod(meta[k]['shape']))
+    count = 0
+    for serialized in tf.python_io.tf_record_iterator(path, options=options):
+        example = tf.train.Example.FromString(serialized)
+        count += len(example.features.feature[k].bytes_list.value[0]) // record_bytes
+    return count
+
+
+def file_checksum(path):
+    """CRC32 of the contents of the file path."""
+    crc = 0
+    with tf.gfile.GFile(path, 'rb') as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK_BYTES)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def load_meta(directory):
+    """Merged contents of the meta*.pkl files of directory."""
+    meta = {}
+    for name in sorted(tf.gfile.ListDirectory(directory)):
+        if name.startswith('meta') and name.endswith('.pkl'):
+            with tf.gfile.GFile(os.path.join(directory, name), 'rb') as f:
+                meta.update(cPickle.load(f))
+    return meta
+
+
+def build_manifest(directory,
+                   file_pattern=DEFAULT_FILE_PATTERN,
+                   checksums=False,
+                   count=count_records,
+                   meta=None,
+                   compression=None):
+    """
+    Manifest of the files of directory matching file_pattern (except partial files, see
+    PARTIAL_FILE_SUFFIX).
+
+    Arguments:
+        - directory (str): dataset directory
+        - file_pattern (str): glob pattern of the data files; for compressed files, the
+          default pattern also matches suffixed names (see compressed_file_pattern)
+        - checksums (bool, default=False): whether to compute the CRC32 of each file, which
+          requires reading all the data
+        - count (callable or None): function returning the number of records of a file,
+          called with the path and compression of the file; if None, record counts are not
+          stored
+        - meta (dict or None): attribute metadata; if None, the metadata of the meta*.pkl
+          files of directory
+        - compression (str or None): compression of the files ('GZIP' or 'ZLIB'); if None,
+          the "compression" declared in the attribute metadata, if any
+
+    Returns a dict with keys:
+        - version: MANIFEST_VERSION
+        - format: TFRECORDS_FORMAT
+        - file_pattern: file_pattern
+        - files: list of dicts, one per file in sorted order, with keys name (file name
+          relative to directory), bytes, mtime, records (or None) and crc32 (or None)
+        - meta: the attribute metadata
+        - compression: the compression of the files
+    """
+    if meta is None:
+        meta = load_meta(directory)
+    if compression is None:
+        compressions = set([meta[k].get('compression') for k in meta])
+        assert len(compressions) <= 1, compressions
+        compression = compressions.pop() if compressions else None
+    if count is count_records:
+        count = functools.partial(count_records, meta=meta)
+    file_pattern = compressed_file_pattern(file_pattern, compression)
+    paths = glob_data_files(directory, file_pattern)
+    files = []
+    for path in paths:
+        stat = tf.gfile.Stat(path)
+        files.append({'name': os.path.basename(path),
+                      'bytes': stat.length,
+                      'mtime': stat.mtime_nsec,
+                      'records': count(path, compression) if count is not None else None,
+                      'crc32': file_checksum(path) if checksums else None})
+    return {'version': MANIFEST_VERSION,
+            'format': TFRECORDS_FORMAT,
+            'file_pattern': file_pattern,
+            'files': files,
+            'meta': meta,
+            'compression': compression}
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    with tf.gfile.GFile(path + PARTIAL_FILE_SUFFIX, 'wb') as f:
+        cPickle.dump(manifest, f, cPickle.HIGHEST_PROTOCOL)
+    tf.gfile.Rename(path + PARTIAL_FILE_SUFFIX, path, overwrite=True)
+    return path
+
+
+def load_manifest(directory, file_pattern=None, format=TFRECORDS_FORMAT):
+    """
+    Manifest of directory, or None if it has none, if it describes a dataset of another
+    format, or if its file pattern differs from file_pattern (when given, and widened as by
+    compressed_file_pattern for compressed files).
+    """
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    if not tf.gfile.Exists(path):
+        return None
+    with tf.gfile.GFile(path, 'rb') as f:
+        manifest = cPickle.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    if manifest.get('format', TFRECORDS_FORMAT) != format:
+        return None
+    if file_pattern is not None and manifest['file_pattern'] != \
+            compressed_file_pattern(file_pattern, manifest.get('compression')):
+        return None
+    return manifest
+
+
+def is_stale(directory, manifest):
+    """
+    Whether the files of directory matching the pattern of the manifest are not the files
+    listed by the manifest (e.g. files were added or removed after it was built).  This
+    only lists the directory; use verify_manifest to also check sizes and checksums.
+    """
+    names = [name for name in fnmatch.filter(tf.gfile.ListDirectory(directory), manifest['file_pattern'])
+             if is_data_file(name)]
+    return sorted(names) != sorted([f['name'] for f in manifest['files']])
+
+
+def manifest_paths(directory, manifest):
+    return [os.path.join(directory, f['name']) for f in manifest['files']]
+
+
+def npy_shard_path(directory, attr, name):
+    """Path of the .npy file of attribute attr in shard name of a NPY_FORMAT dataset."""
+    return os.path.join(directory, attr, name + '.npy')
+
+
+def verify_manifest(directory, manifest, checksums=False):
+    """
+    List of the files of the manifest that are missing or whose size (or checksum, if
+    checksums is True and the manifest has them) does not match.  For NPY_FORMAT datasets,
+    list of the names of the shards with missing attribute files or mismatched total size.
+    """
+    bad = []
+    if manifest.get('format', TFRECORDS_FORMAT) == NPY_FORMAT:
+        for f in manifest['files']:
+            paths = [npy_shard_path(directory, attr, f['name']) for attr in sorted(manifest['meta'])]
+            if not all([tf.gfile.Exists(path) for path in paths]) or \
+                    sum([tf.gfile.Stat(path).length for path in paths]) != f['bytes']:
+                bad.append(f['name'])
+        return bad
+    for f, path in zip(manifest['files'], manifest_paths(directory, manifest)):
+        if not tf.gfile.Exists(path) or tf.gfile.Stat(path).length != f['bytes']:
+            bad.append(path)
+        elif checksums and f['crc32'] is not None and file_checksum(path) != f['crc32']:
+            bad.append(path)
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the manifest of dataset directories.')
+    parser.add_argument('directories', nargs='+', help='dataset directories')
+    parser.add_argument('--pattern', default=DEFAULT_FILE_PATTERN, help='glob pattern of the data files')
+    parser.add_argument('--checksums', action='store_true', help='store the CRC32 of each file')
+    parser.add_argument('--no-count', action='store_true', help='do not count records')
+    parser.add_argument('--compression', default=None, choices=sorted(COMPRESSION_TYPES),
+                        help='compression of the files, if not declared in their metadata')
+    args = parser.parse_args()
+    for directory in args.directories:
+        manifest = build_manifest(directory,
+                                  file_pattern=args.pattern,
+                                  checksums=args.checksums,
+                                  count=None if args.no_count else count_records,
+                                  compression=args.compression)
+        path = write_manifest(directory, manifest)
+        records = [f['records'] for f in manifest['files']]
+        print('%s: %d files, %d bytes%s' % (
+            path, len(records), sum([f['bytes'] for f in manifest['files']]),
+            '' if None in records else ', %d records' % sum(records)))
+
+
+if __name__ == '__main__':
+    main()
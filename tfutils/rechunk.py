@@ -0,0 +1,158 @@
+"""
+Rewrite HDF5 datasets with a chunk layout suited to batch reading.
+
+Files written one row at a time (see e.g. benchmark.create_hdf5) often end up with
+small or default chunks, which makes every batch read touch (and decompress) many chunks.
+This module rewrites such files with chunks aligned to the batch size used by
+HDF5DataReader, optionally with a fast compression filter, and reports the expected read
+amplification of batch reads before and after.
+
+Usage:
+    python -m tfutils.rechunk input.hdf5 output.hdf5 --batch-size 256 [--compression lzf]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+
+import numpy as np
+import h5py
+
+DEFAULT_BLOCK_BYTES = 2 ** 28
+
+
+def list_datasets(f):
+    """Names of all the datasets of the h5py file (or group) f."""
+    names = []
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            names.append(name)
+    f.visititems(_visit)
+    return names
+
+
+def read_amplification(dataset, batch_size):
+    """
+    Expected cost of reading the dataset in consecutive batches of batch_size rows, as
+    a dict with keys:
+        - chunks: the chunk shape of the dataset (None if contiguous)
+        - chunks_per_batch: average number of chunks touched by one batch read
+        - amplification: rows decompressed / rows returned, counting each chunk once per
+          batch read that touches it
+    """
+    n = dataset.shape[0] if dataset.shape else 0
+    chunks = dataset.chunks
+    if n == 0 or chunks is None:
+        return {'chunks': chunks, 'chunks_per_batch': 1., 'amplification': 1.}
+    cr = chunks[0]
+    # chunks also split along the other axes are all read for whole rows
+    per_row = int(np.prod([int(np.ceil(s / c)) for s, c in zip(dataset.shape[1:], chunks[1:])]))
+    starts = np.arange(0, n, batch_size)
+    stops = np.minimum(starts + batch_size, n)
+    c0 = starts // cr
+    c1 = (stops - 1) // cr
+    touched = c1 - c0 + 1
+    rows_read = np.minimum((c1 + 1) * cr, n) - c0 * cr
+    return {'chunks': chunks,
+            'chunks_per_batch': float(touched.mean() * per_row),
+            'amplification': float(rows_read.sum()) / n}
+
+
+def get_chunk_rows(row_bytes, batch_size, max_chunk_bytes=None):
+    """
+    Rows per chunk: batch_size, or if max_chunk_bytes is given and a batch is larger
+    than that, the largest divisor of batch_size whose chunks fit in max_chunk_bytes.
+    """
+    if max_chunk_bytes is None or batch_size * row_bytes <= max_chunk_bytes:
+        return batch_size
+    divisors = [d for d in range(1, batch_size + 1)
+                if batch_size % d == 0 and d * row_bytes <= max_chunk_bytes]
+    return max(divisors) if divisors else 1
+
+
+def rechunk_hdf5(source,
+                 dest,
+                 batch_size,
+                 keys=None,
+                 compression=None,
+                 compression_opts=None,
+                 max_chunk_bytes=None,
+                 block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Copy the datasets of the HDF5 file source into dest, chunked for batch reads.
+
+    Arguments:
+        - source (str): path of the input HDF5 file
+        - dest (str): path of the output HDF5 file
+        - batch_size (int): batch size of the reads the layout is optimized for.  Chunks
+          span whole rows, and batch_size rows (see get_chunk_rows for max_chunk_bytes).
+        - keys (list of strs or None): datasets to rewrite; all datasets if None.  Other
+          datasets are not copied.
+        - compression (str or None): compression filter of the output, e.g. 'lzf' (fast)
+          or 'gzip'
+        - compression_opts: options of the compression filter
+        - max_chunk_bytes (int or None): upper bound on the size of chunks
+        - block_bytes (int): approximate size of the blocks copied at once
+
+    Dataset keys, dtypes, shapes and attributes are preserved, so the output can be read
+    by HDF5DataReader in place of the input.  Returns a dict mapping each key to a pair
+    of read_amplification reports (before, after).
+    """
+    report = {}
+    with h5py.File(source, 'r') as fin, h5py.File(dest, 'w') as fout:
+        if keys is None:
+            keys = list_datasets(fin)
+        for key in keys:
+            dset = fin[key]
+            if dset.shape == () or dset.shape[0] == 0:
+                out = fout.create_dataset(key, data=dset[()])
+            else:
+                row_bytes = int(np.prod(dset.shape[1:])) * dset.dtype.itemsize
+                cr = min(get_chunk_rows(row_bytes, batch_size, max_chunk_bytes), dset.shape[0])
+                out = fout.create_dataset(key,
+                                          shape=dset.shape,
+                                          dtype=dset.dtype,
+                                          chunks=(cr, ) + dset.shape[1:],
+                                          compression=compression,
+                                          compression_opts=compression_opts)
+                # copy in blocks of whole chunks
+                block_rows = max(1, block_bytes // max(1, row_bytes * cr)) * cr
+                for start in range(0, dset.shape[0], block_rows):
+                    stop = min(start + block_rows, dset.shape[0])
+                    out[start: stop] = dset[start: stop]
+            for attr in dset.attrs:
+                out.attrs[attr] = dset.attrs[attr]
+            report[key] = (read_amplification(dset, batch_size),
+                           read_amplification(out, batch_size))
+    return report
+
+
+def print_report(report):
+    for key in sorted(report):
+        before, after = report[key]
+        print('%s: chunks %s -> %s, chunks per batch %.2f -> %.2f, read amplification %.2f -> %.2f' % (
+            key, before['chunks'], after['chunks'],
+            before['chunks_per_batch'], after['chunks_per_batch'],
+            before['amplification'], after['amplification']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite HDF5 datasets with chunks aligned to a batch size.')
+    parser.add_argument('source', help='input HDF5 file')
+    parser.add_argument('dest', help='output HDF5 file')
+    parser.add_argument('--batch-size', type=int, default=256, help='batch size of the reads')
+    parser.add_argument('--keys', nargs='*', default=None, help='datasets to rewrite (default: all)')
+    parser.add_argument('--compression', default=None, help='compression filter, e.g. lzf or gzip')
+    parser.add_argument('--compression-opts', type=int, default=None, help='compression level for gzip')
+    parser.add_argument('--max-chunk-bytes', type=int, default=None, help='upper bound on chunk size')
+    args = parser.parse_args()
+    report = rechunk_hdf5(args.source, args.dest, args.batch_size,
+                          keys=args.keys,
+                          compression=args.compression,
+                          compression_opts=args.compression_opts,
+                          max_chunk_bytes=args.max_chunk_bytes)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
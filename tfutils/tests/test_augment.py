@@ -0,0 +1,53 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+import tensorflow as tf
+
+from tfutils import augment
+
+
+def get_images(n=8, size=32):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, size=(n, size, size, 3)).astype(np.uint8)
+
+
+def test_crop():
+    ims = get_images()
+    offsets = np.array([[i, 2 * i] for i in range(len(ims))], dtype=np.int32)
+    out = augment.crop(tf.constant(ims), tf.constant(offsets), 16)
+    assert out.get_shape().as_list()[1:] == [16, 16, 3]
+    with tf.Session() as sess:
+        res = sess.run(out)
+    assert res.dtype == np.uint8
+    for im, (y, x), r in zip(ims, offsets, res):
+        assert_equal(r, im[y: y + 16, x: x + 16])
+
+
+def test_random_crop_and_flip():
+    ims = get_images()
+    images = tf.constant(ims)
+    crops = augment.random_crop(images, 24, seed=0)
+    flips = augment.random_flip_left_right(images, seed=0)
+    with tf.Session() as sess:
+        crops, flips = sess.run([crops, flips])
+    assert crops.shape == (len(ims), 24, 24, 3)
+    for im, c in zip(ims, crops):
+        found = [(y, x) for y in range(9) for x in range(9)
+                 if (im[y: y + 24, x: x + 24] == c).all()]
+        assert len(found) > 0
+    for im, f in zip(ims, flips):
+        assert (f == im).all() or (f == im[:, ::-1]).all()
+
+
+def test_augment_images():
+    ims = get_images()
+    out = augment.augment_images(tf.constant(ims), 24, flip=True,
+                                 jitter={'brightness': 0.1, 'contrast': 0.1, 'saturation': 0.1},
+                                 seed=0)
+    center = augment.augment_images(tf.constant(ims), 24, train=False)
+    with tf.Session() as sess:
+        out, center = sess.run([out, center])
+    assert out.shape == (len(ims), 24, 24, 3)
+    assert out.min() >= 0 and out.max() <= 1
+    assert_allclose(center, ims[:, 4: 28, 4: 28].astype(np.float32) / 255, rtol=1e-6)
@@ -0,0 +1,168 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal, assert_allclose
+import numpy as np
+import h5py
+import tensorflow as tf
+
+from tfutils import data
+from tfutils import convert
+from tfutils import manifest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+source_paths = [os.path.join(dir_path, 'tftestdata/images'),
+                os.path.join(dir_path, 'tftestdata/means')]
+trans_dicts = [None, {'ids': 'ids1'}]
+
+
+def test_hdf5_to_npy():
+    total_size = 1000
+    src = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False).name
+    with h5py.File(src, 'w') as f:
+        f['data'] = np.random.randn(total_size, 4, 5).astype(np.float32)
+        f['inds'] = np.arange(total_size)
+    tmpdir = tempfile.mkdtemp()
+    m = convert.hdf5_to_npy(src, tmpdir, shard_records=300, block_rows=128)
+    assert [f['records'] for f in m['files']] == [300, 300, 300, 100]
+    assert m['meta']['data'] == {'dtype': tf.float32, 'shape': [4, 5]}
+    assert manifest.verify_manifest(tmpdir, manifest.load_manifest(tmpdir, format=manifest.NPY_FORMAT)) == []
+
+    reader = data.NpyShardsDataReader(tmpdir, ['data', 'inds'], batch_size=128)
+    assert_equal(reader.shard_bounds, [0, 300, 600, 900, 1000])
+    with h5py.File(src, 'r') as f:
+        for i in range(reader.total_batches):
+            batch = reader.get_next_batch()
+            assert_equal(batch['data'], f['data'][128 * i: 128 * (i + 1)])
+
+    # only the inds column is read
+    dp = data.NpyShardsProvider(tmpdir,
+                                meta_dicts=['inds'],
+                                batch_size=50,
+                                n_threads=2,
+                                mode='shard')
+    ops = dp.init_ops()
+    assert set(ops[0].keys()) == set(['inds'])
+    sess = tf.Session()
+    r = sess.run(ops)
+    sess.close()
+    assert_equal(r[0]['inds'], np.arange(50))
+    assert_equal(r[1]['inds'], np.arange(600, 650))
+    shutil.rmtree(tmpdir)
+    os.remove(src)
+
+
+def test_tfrecords_to_npy():
+    tmpdir = tempfile.mkdtemp()
+    m = convert.tfrecords_to_npy(source_paths, tmpdir, trans_dicts=trans_dicts, shard_records=500)
+    assert [f['records'] for f in m['files']] == [500, 500, 500, 100]
+    assert set(m['meta'].keys()) == set(['images', 'ids', 'ids1', 'means'])
+
+    dp = data.NpyShardsProvider(tmpdir, batch_size=20, n_threads=1)
+    ops = dp.init_ops()
+    sess = tf.Session()
+    for i in range(10):
+        res = sess.run(ops[0])
+        assert res['images'].shape == (20, 32, 32, 3)
+        assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+        assert_equal(res['ids'], np.arange(20 * i, 20 * (i + 1)))
+        assert_equal(res['ids'], res['ids1'])
+    sess.close()
+    shutil.rmtree(tmpdir)
+
+
+def test_hdf5_to_tfrecords():
+    total_size = 1000
+    src = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False).name
+    with h5py.File(src, 'w') as f:
+        f.create_dataset('images', data=np.random.randint(0, 256, (total_size, 8, 8, 3)).astype(np.uint8),
+                         chunks=(50, 8, 8, 3))
+        f['data'] = np.random.randn(total_size, 4).astype(np.float32)
+        f['ids'] = np.arange(total_size)
+    tmpdir = tempfile.mkdtemp()
+    manifests = convert.hdf5_to_tfrecords(src, tmpdir, shard_records=300, block_rows=100,
+                                          compression='GZIP', n_workers=3)
+    assert set(manifests.keys()) == set(['images', 'data', 'ids'])
+    for k in manifests:
+        assert [f['name'] for f in manifests[k]['files']] == \
+            ['00000.tfrecords', '00001.tfrecords', '00002.tfrecords', '00003.tfrecords']
+        assert [f['records'] for f in manifests[k]['files']] == [300, 300, 300, 100]
+        assert manifests[k]['compression'] == 'GZIP'
+    assert manifests['images']['meta']['images']['shape'] == [8, 8, 3]
+
+    # converting again with fewer shards replaces the shards of the first conversion
+    manifests = convert.hdf5_to_tfrecords(src, tmpdir, shard_records=600, block_rows=100,
+                                          compression='GZIP', n_workers=2)
+    for k in manifests:
+        assert sorted(os.listdir(os.path.join(tmpdir, k))) == \
+            ['00000.tfrecords', '00001.tfrecords', 'manifest.pkl', 'meta.pkl']
+        assert [f['records'] for f in manifests[k]['files']] == [600, 400]
+
+    dp = data.TFRecordsParallelByFileProvider([os.path.join(tmpdir, k) for k in ['images', 'data', 'ids']],
+                                              n_threads=1,
+                                              batch_size=50,
+                                              shuffle=False)
+    ops = dp.init_ops()
+    sess = tf.Session()
+    tf.train.start_queue_runners(sess=sess)
+    with h5py.File(src, 'r') as f:
+        for i in range(total_size // 50):
+            res = sess.run(ops[0])
+            assert_equal(res['ids'], np.arange(50 * i, 50 * (i + 1)))
+            assert_equal(res['images'], f['images'][50 * i: 50 * (i + 1)])
+            assert_allclose(res['data'], f['data'][50 * i: 50 * (i + 1)])
+    sess.close()
+    shutil.rmtree(tmpdir)
+    os.remove(src)
+
+
+def test_hdf5_to_tfrecords_packed():
+    total_size = 1000
+    src = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False).name
+    with h5py.File(src, 'w') as f:
+        f['labels'] = np.random.randint(0, 10, total_size)
+        f['means'] = np.random.randn(total_size, 3).astype(np.float32)
+    tmpdir = tempfile.mkdtemp()
+    manifests = convert.hdf5_to_tfrecords(src, tmpdir, shard_records=300, block_rows=100, pack=64)
+    # blocks are rounded to 128 rows, and shards to 384 records
+    for k in manifests:
+        assert [f['records'] for f in manifests[k]['files']] == [384, 384, 232]
+        assert manifests[k]['meta'][k]['packed'] == 64
+        path = os.path.join(tmpdir, k, '00002.tfrecords')
+        assert sum([1 for _ in tf.python_io.tf_record_iterator(path)]) == 4
+        assert manifest.count_records(path, meta=manifests[k]['meta']) == 232
+
+    dp = data.TFRecordsParallelByFileProvider([os.path.join(tmpdir, 'labels'), os.path.join(tmpdir, 'means')],
+                                              n_threads=1,
+                                              batch_size=128,
+                                              shuffle=False)
+    assert dp.num_records == total_size
+    ops = dp.init_ops()
+    sess = tf.Session()
+    tf.train.start_queue_runners(sess=sess)
+    labels = []
+    means = []
+    for i in range(9):
+        res = sess.run(ops[0])
+        assert len(res['labels']) == len(res['means'])
+        labels.append(res['labels'])
+        means.append(res['means'])
+    sess.close()
+    with h5py.File(src, 'r') as f:
+        assert_equal(np.concatenate(labels)[:total_size], f['labels'][:])
+        assert_allclose(np.concatenate(means)[:total_size], f['means'][:])
+
+    # the dequeued Examples would still be packed
+    try:
+        data.TFRecordsParallelByFileProvider([os.path.join(tmpdir, 'labels'), os.path.join(tmpdir, 'means')],
+                                             batch_size=128,
+                                             postprocess_after_dequeue=True)
+    except AssertionError:
+        pass
+    else:
+        assert False, 'packed groups with postprocess_after_dequeue should fail'
+    shutil.rmtree(tmpdir)
+    os.remove(src)
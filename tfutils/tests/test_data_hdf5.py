@@ -2,8 +2,10 @@ from __future__ import division, print_function, absolute_import
 
 import os
 import tempfile
+import functools
+import threading
 
-from numpy.testing import assert_equal
+from numpy.testing import assert_equal, assert_allclose
 import numpy as np
 import h5py
 import tensorflow as tf
@@ -185,3 +187,447 @@ def test_random_four_threads():
     assert sl.min() > 400
     assert m.min() > 740
     return sl, m
+
+
+def test_graph_postprocess():
+    batch_size = 100
+    total_size = batch_size * 10
+
+    tmp_path = create_hdf5(total_size)
+
+    dp = data.ParallelBySliceProvider(basefunc=data.HDF5DataReader,
+                                      kwargs={'hdf5source': tmp_path,
+                                              'sourcelist': ['data', 'inds']},
+                                      batch_size=batch_size,
+                                      n_threads=1,
+                                      postprocess={'data': [(tf.multiply, (2., ), {})]})
+    ops = dp.init_ops()
+
+    sess = tf.Session()
+    r = sess.run(ops)
+    sess.close()
+    os.remove(tmp_path)
+
+    assert_equal(r[0]['data'], 2 * np.sin(np.arange(100)))
+    assert_equal(r[0]['inds'], np.arange(100))
+
+
+def test_imagenet():
+    tempf = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False)
+    tempf.close()
+    images = np.random.RandomState(0).randint(0, 256, (8, 256, 256, 3)).astype(np.uint8)
+    with h5py.File(tempf.name, 'w') as f:
+        f['val/images'] = images
+        f['val/labels'] = np.arange(8)
+    expected = images[:, 16: 240, 16: 240].astype(np.float32) / 255.0
+
+    # used directly, the reader returns float32 center crops in [0, 1]
+    reader = data.ImageNet(tempf.name, group='val', batch_size=4, crop_size=224)
+    ims, labels = reader.next()
+    assert ims.dtype == np.float32
+    assert_allclose(ims, expected[:4])
+    assert labels.dtype == np.int32
+    assert_equal(labels, np.arange(4))
+
+    # normalized in the graph, the reader returns uint8 crops
+    dp = data.ParallelBySliceProvider(basefunc=data.ImageNet,
+                                      kwargs={'data_path': tempf.name,
+                                              'group': 'val',
+                                              'crop_size': 224,
+                                              'normalize_in_graph': True},
+                                      batch_size=4,
+                                      n_threads=1)
+    ops = dp.init_ops()
+    assert ops[0]['val/images'].dtype == tf.float32
+    sess = tf.Session()
+    r = sess.run(ops)
+    sess.close()
+    os.remove(tempf.name)
+    assert_allclose(r[0]['val/images'], expected[:4], rtol=1e-6)
+    assert_equal(r[0]['val/labels'], np.arange(4))
+
+
+def test_plan_reads():
+    assert data.plan_reads([]) == []
+    assert data.plan_reads([5, 1, 2, 3, 9]) == [(1, 4), (5, 6), (9, 10)]
+    assert data.plan_reads([5, 1, 2, 3, 9], max_gap=1) == [(1, 6), (9, 10)]
+    assert data.plan_reads([5, 1, 2, 3, 9], max_gap=10) == [(1, 10)]
+    assert data.plan_reads([0, 1, 2, 3, 9], max_gap=10, max_read=3) == [(0, 3), (3, 4), (9, 10)]
+
+
+def test_read_coalesced():
+    arr = np.sin(np.arange(1000))
+    rng = np.random.RandomState(0)
+    inds = rng.permutation(1000)[:50]
+    for max_gap in [0, 5, 1000]:
+        for max_read in [None, 7]:
+            assert_equal(data.read_coalesced(arr, inds, max_gap=max_gap, max_read=max_read),
+                         arr[inds])
+
+
+def test_sparse_subslice():
+    batch_size = 10
+    total_size = 1000
+    tmp_path = create_hdf5(total_size)
+    subslice = np.arange(3, total_size, 37)
+    dp = data.HDF5DataReader(tmp_path, ['data', 'inds'],
+                             batch_size=batch_size,
+                             subslice=subslice,
+                             read_gap=10)
+    b = dp.get_next_batch()
+    os.remove(tmp_path)
+    assert_equal(b['inds'], subslice[:batch_size])
+    assert_equal(b['data'], np.sin(subslice[:batch_size]))
+
+
+def test_chunk_cache():
+    total_size = 1000
+    tempf = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False)
+    tempf.close()
+    with h5py.File(tempf.name, 'w') as f:
+        f.create_dataset('data', data=np.sin(np.arange(total_size)), chunks=(64, ), compression='gzip')
+        f.create_dataset('inds', data=np.arange(total_size), chunks=(64, ), compression='gzip')
+
+    dp = data.HDF5DataReader(tempf.name, ['data', 'inds'],
+                             batch_size=100,
+                             chunk_cache_bytes=10 ** 6)
+    assert dp.chunk_rows == 64
+    out = [dp.get_next_batch() for _ in range(dp.total_batches)]
+    assert_equal(np.concatenate([o['inds'] for o in out]), np.arange(total_size))
+    assert_equal(np.concatenate([o['data'] for o in out]), np.sin(np.arange(total_size)))
+    cache = data.get_chunk_cache(tempf.name, 0)
+    assert len(cache.chunks) == 2 * ((total_size - 1) // 64 + 1)
+
+    # a file rewritten in place is not read from the cache of its old contents
+    dp.close()
+    with h5py.File(tempf.name, 'r+') as f:
+        f['inds'][:] = np.arange(total_size) + 1
+    mtime = os.path.getmtime(tempf.name) + 1
+    os.utime(tempf.name, (mtime, mtime))
+    dp = data.HDF5DataReader(tempf.name, ['data', 'inds'],
+                             batch_size=100,
+                             chunk_cache_bytes=10 ** 6)
+    assert_equal(dp.get_next_batch()['inds'], np.arange(100) + 1)
+    assert data.get_chunk_cache(tempf.name, 0) is not cache
+    os.remove(tempf.name)
+
+
+def test_aligned_blocks():
+    assert data.aligned_blocks(1000, 2) == [[0, 500], [500, 1000]]
+    assert data.aligned_blocks(1000, 4, 64) == [[0, 256], [256, 512], [512, 768], [768, 1000]]
+    assert data.aligned_blocks(100, 4, 64) == [[0, 25], [25, 50], [50, 75], [75, 100]]
+
+
+def test_prefetch():
+    total_size = 1000
+    tmp_path = create_hdf5(total_size)
+    dp = data.HDF5DataReader(tmp_path, ['data', 'inds'], batch_size=128, prefetch=2)
+    # the returned batches stay valid after the ring buffers are reused
+    out = [dp.get_next_batch()['inds'] for _ in range(2 * dp.total_batches)]
+    dp.close()
+    assert_equal(np.concatenate(out), np.concatenate([np.arange(total_size)] * 2))
+
+    # the reader used to set up the provider does not keep its prefetching thread
+    n_threads = threading.active_count()
+    dp = data.ParallelBySliceProvider(basefunc=data.HDF5DataReader,
+                                      kwargs={'hdf5source': tmp_path,
+                                              'sourcelist': ['data', 'inds'],
+                                              'prefetch': 1},
+                                      batch_size=100,
+                                      mode='shuffle',
+                                      n_threads=2)
+    ops = dp.init_ops()
+    assert threading.active_count() == n_threads + 2
+    sess = tf.Session()
+    r = sess.run(ops)
+    sess.close()
+    assert_equal(r[0]['data'], np.sin(r[0]['inds']))
+    assert len(np.unique(np.concatenate([r[0]['inds'], r[1]['inds']]))) == 200
+    os.remove(tmp_path)
+
+
+def check_process_pool(transport):
+    batch_size = 100
+    total_size = batch_size * 10
+
+    tmp_path = create_hdf5(total_size)
+
+    dp = data.ProcessPoolProvider(basefunc=data.HDF5DataReader,
+                                  kwargs={'hdf5source': tmp_path,
+                                          'sourcelist': ['data', 'inds']},
+                                  batch_size=batch_size,
+                                  n_workers=2,
+                                  n_threads=1,
+                                  transport=transport)
+    ops = dp.init_ops()
+
+    sess = tf.Session()
+    # the workers are stopped with the coordinator of the queues
+    coord, threads = base.start_queues(sess)
+    # more steps than there are batch slots, so slots must be reused
+    r = [sess.run(ops)[0] for _ in range(12)]
+    base.stop_queues(sess, [], coord, threads)
+    sess.close()
+    os.remove(tmp_path)
+
+    assert_equal(r[0]['inds'], np.arange(100))
+    assert_equal(r[1]['inds'], np.arange(500, 600))
+    assert_equal(r[2]['inds'], np.arange(100, 200))
+    assert_equal(r[3]['data'], np.sin(np.arange(600, 700)))
+    assert_equal(r[10]['inds'], np.arange(100))
+    assert_equal(r[11]['inds'], np.arange(500, 600))
+    assert not any([w.is_alive() for w in dp.workers])
+
+
+def test_process_pool():
+    check_process_pool('queue')
+
+
+def test_process_pool_shared_memory():
+    check_process_pool('shm')
+
+
+def test_shared_memory_ring():
+    ring = data.SharedMemoryRing([((10, 3), np.float32), ((10, ), np.int64)], 2)
+    stop_event = threading.Event()
+    batches = [[np.full((10, 3), i, dtype=np.float32), np.arange(10) + 10 * i] for i in range(6)]
+
+    def produce():
+        for batch in batches:
+            ring.put_batch(batch, stop_event)
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    # every get from a different thread, as tf.py_func does
+    out = []
+    for i in range(6):
+        consumer = threading.Thread(target=lambda: out.append(ring.get(timeout=5)))
+        consumer.start()
+        consumer.join()
+    producer.join()
+    assert len(out) == 6
+    for (kind, val), batch in zip(out, batches):
+        assert kind == 'batch'
+        assert_equal(val[0], batch[0])
+        assert_equal(val[1], batch[1])
+
+
+def create_hdf5_shards(directory, sizes):
+    start = 0
+    for i, size in enumerate(sizes):
+        with h5py.File(os.path.join(directory, '%d.hdf5' % i), 'w') as f:
+            f['data'] = np.sin(np.arange(start, start + size))
+            f['inds'] = np.arange(start, start + size)
+        start += size
+
+
+def test_sharded_reader(tmpdir):
+    directory = str(tmpdir)
+    create_hdf5_shards(directory, [300, 50, 400, 250])
+    dp = data.ShardedHDF5DataReader(directory, ['data', 'inds'], batch_size=128)
+    assert dp.data_length == 1000
+    assert_equal(dp.shard_bounds, [0, 300, 350, 750, 1000])
+    out = [dp.get_next_batch() for _ in range(dp.total_batches)]
+    assert_equal(np.concatenate([o['inds'] for o in out]), np.arange(1000))
+
+    subslice = np.arange(5, 1000, 7)
+    dp = data.ShardedHDF5DataReader(directory, ['data', 'inds'], batch_size=100, subslice=subslice)
+    assert_equal(dp.get_next_batch()['data'], np.sin(subslice[:100]))
+
+    dp = data.ParallelBySliceProvider(basefunc=data.ShardedHDF5DataReader,
+                                      kwargs={'hdf5source': directory,
+                                              'sourcelist': ['data', 'inds']},
+                                      batch_size=50,
+                                      mode='shard',
+                                      n_threads=2)
+    ops = dp.init_ops()
+    sess = tf.Session()
+    r = sess.run(ops)
+    sess.close()
+    assert_equal(r[0]['inds'], np.arange(50))
+    assert_equal(r[1]['inds'], np.arange(350, 400))
+
+
+def test_shard_blocks():
+    assert data.shard_blocks([0, 10, 20, 30, 40], 3) == [[0, 10], [10, 30], [30, 40]]
+    assert data.shard_blocks([0, 10, 20], 3) is None
+
+
+def double(x):
+    return 2 * x
+
+
+def test_lazy_preprocess(tmpdir, monkeypatch):
+    total_size = 1000
+    tmp_path = create_hdf5(total_size)
+    cache_dir = str(tmpdir)
+    # blocks of 100 rows, computed as they are read
+    monkeypatch.setattr(data, 'DEFAULT_PREPROCESS_BLOCK_BYTES', 800)
+    readers = [data.HDF5DataReader(tmp_path, ['data', 'inds'],
+                                   batch_size=100,
+                                   preprocess={'data': double},
+                                   preprocess_cache_dir=cache_dir) for _ in range(2)]
+    assert readers[0].data['data'] is readers[1].data['data']
+    b = readers[0].get_next_batch()
+    assert_equal(b['data'], 2 * np.sin(np.arange(100)))
+    readers[1].set_epoch_batch(1, 9)
+    assert_equal(readers[1].get_next_batch()['data'], 2 * np.sin(np.arange(900, 1000)))
+    assert len([p for p in os.listdir(cache_dir) if p.endswith('.npy')]) == 1
+
+    # functions with the same name but different code do not share a cache
+    for k in [3, 4]:
+        reader = data.HDF5DataReader(tmp_path, ['data', 'inds'],
+                                     batch_size=100,
+                                     preprocess={'data': eval('lambda x: %d * x' % k)},
+                                     preprocess_cache_dir=cache_dir)
+        assert_equal(reader.get_next_batch()['data'], k * np.sin(np.arange(100)))
+    assert len([p for p in os.listdir(cache_dir) if p.endswith('.npy')]) == 3
+    assert data.func_key(double) == data.func_key(double)
+
+    # the cache reads its source through its own file, so closing the readers that
+    # shared it does not affect the next ones, nor the workers of a process pool
+    for reader in readers:
+        reader.close()
+    reader = data.HDF5DataReader(tmp_path, ['data', 'inds'],
+                                 batch_size=100,
+                                 preprocess={'data': double},
+                                 preprocess_cache_dir=cache_dir)
+    reader.set_epoch_batch(1, 5)
+    assert_equal(reader.get_next_batch()['data'], 2 * np.sin(np.arange(500, 600)))
+    reader.close()
+    dp = data.ProcessPoolProvider(basefunc=data.HDF5DataReader,
+                                  kwargs={'hdf5source': tmp_path,
+                                          'sourcelist': ['data', 'inds'],
+                                          'preprocess': {'data': double},
+                                          'preprocess_cache_dir': cache_dir},
+                                  batch_size=100,
+                                  n_workers=2,
+                                  n_threads=1)
+    ops = dp.init_ops()
+    sess = tf.Session()
+    r = [sess.run(ops)[0] for _ in range(4)]
+    sess.close()
+    dp.stop()
+    for b in r:
+        assert_equal(b['data'], 2 * np.sin(b['inds']))
+    assert_equal(r[1]['inds'], np.arange(500, 600))
+    os.remove(tmp_path)
+
+
+def test_func_key():
+    # arrays are hashed by their bytes, not their (truncated) repr
+    keys = []
+    for k in range(2):
+        weights = np.zeros(10000)
+        weights[5000] = k
+        keys.append(data.func_key(lambda x: weights * x))
+    assert keys[0] != keys[1]
+    assert data.func_key(functools.partial(double, x=1)) != data.func_key(functools.partial(double, x=2))
+
+    # objects hashed by address would give a new key in every run
+    def scale(x, scaler=object()):
+        return x
+    try:
+        data.func_key(scale)
+    except TypeError:
+        pass
+    else:
+        assert False, 'func_key should reject objects without a stable hash'
+
+
+def test_array_utils():
+    rng = np.random.RandomState(0)
+    s = rng.permutation(1000)
+    assert_equal(s[data.perminverse(s)], np.arange(1000))
+
+    labels = np.array(['b', 'a', 'c', 'a', 'b'])
+    assert_equal(data.get_unique_labels(labels), [1, 0, 2, 0, 1])
+
+    X = rng.randint(-5, 120, size=300)
+    for Y in [rng.randint(0, 100, size=50), np.append(rng.randint(0, 10 ** 9, size=50), 7), np.array([], dtype=int)]:
+        expected = np.array([x in set(Y) for x in X], dtype=bool)
+        assert_equal(data.isin(X, Y), expected)
+        assert_equal(data.isin(X, data.Membership(Y, bitmap_factor=0)), expected)
+
+
+def test_unique_labels_chunked(tmpdir, monkeypatch):
+    total_size = 1000
+    tmp_path = create_hdf5(total_size)
+    labels = (np.arange(total_size) * 7) % 13
+    with h5py.File(tmp_path, 'r+') as f:
+        f['labels'] = labels.astype('S2')
+        out = f.create_dataset('labels_encoded', (total_size, ), dtype=np.int64)
+        data.get_unique_labels_chunked(f['labels'], out=out, chunk_rows=64)
+        assert_equal(f['labels_encoded'][:], data.get_unique_labels(f['labels']))
+
+    out_path = os.path.join(str(tmpdir), 'labels.npy')
+    preprocess = functools.partial(data.get_unique_labels_chunked, out=out_path, chunk_rows=64)
+    dp = data.HDF5DataReader(tmp_path, ['labels', 'inds'], batch_size=100,
+                             preprocess={'labels': preprocess})
+    b = dp.get_next_batch()
+    dp.close()
+    assert_equal(b['labels'], data.get_unique_labels(labels.astype('S2'))[:100])
+    assert sorted(os.listdir(str(tmpdir))) == ['labels.npy', 'labels.npy.source']
+
+    # an existing output is reused only for the same source
+    written = os.stat(out_path).st_ino
+    with h5py.File(tmp_path, 'r') as f:
+        reused = data.get_unique_labels_chunked(f['labels'], out=out_path)
+    assert os.stat(out_path).st_ino == written
+    assert_equal(reused[:100], b['labels'])
+    with h5py.File(tmp_path, 'r+') as f:
+        f['labels'][:] = labels[::-1].astype('S2')
+    mtime = os.path.getmtime(tmp_path) + 1
+    os.utime(tmp_path, (mtime, mtime))
+    with h5py.File(tmp_path, 'r') as f:
+        relabeled = data.get_unique_labels_chunked(f['labels'], out=out_path)
+    assert_equal(relabeled, data.get_unique_labels(labels[::-1].astype('S2')))
+    assert_equal(data.get_unique_labels_chunked(np.zeros(total_size), out=out_path), 0)
+    written = os.stat(out_path).st_ino
+    assert_equal(data.get_unique_labels_chunked(np.zeros(total_size), out=out_path), 0)
+    assert os.stat(out_path).st_ino == written
+    assert sorted(os.listdir(str(tmpdir))) == ['labels.npy', 'labels.npy.source']
+    os.remove(out_path)
+    os.remove(out_path + '.source')
+    os.remove(tmp_path)
+
+    # temporary outputs leave no file behind
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    encoded = data.get_unique_labels_chunked(labels, chunk_rows=64)
+    assert_equal(encoded, data.get_unique_labels(labels))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_epoch_shuffle():
+    p = data.EpochPartitioner(1000, 125, run_size=16, seed=3)
+    batches = [p.next() for _ in range(16)]
+    for b in batches:
+        assert (np.diff(b) > 0).all()
+    # every record exactly once per epoch, a new order each epoch
+    assert_equal(np.sort(np.concatenate(batches[:8])), np.arange(1000))
+    assert_equal(np.sort(np.concatenate(batches[8:])), np.arange(1000))
+    assert not all([(b0 == b1).all() for b0, b1 in zip(batches[:8], batches[8:])])
+    q = data.EpochPartitioner(1000, 125, run_size=16, seed=3)
+    for b in batches:
+        assert_equal(q.next(), b)
+
+    fn = create_hdf5(1000)
+    dp = data.ParallelBySliceProvider(basefunc=data.HDF5DataReader,
+                                      kwargs={'hdf5source': fn,
+                                              'sourcelist': ['data', 'inds']},
+                                      batch_size=100,
+                                      mode='shuffle',
+                                      shuffle_seed=1,
+                                      run_size=10,
+                                      n_threads=4)
+    ops = dp.init_ops()
+    sess = tf.Session()
+    inds = []
+    for _ in range(3):
+        for r in sess.run(ops):
+            assert_equal(r['data'], np.sin(r['inds']))
+            inds.append(r['inds'])
+    sess.close()
+    os.remove(fn)
+    # the 12 batches read cover the whole first epoch
+    assert_equal(np.unique(np.concatenate(inds)), np.arange(1000))
@@ -1,8 +1,10 @@
 import numpy as np
 from numpy.testing import assert_allclose, assert_equal
 import os
+import cPickle
 import tfutils.data as d
 import tfutils.base as b
+from tfutils import manifest
 import tensorflow as tf
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -11,6 +13,20 @@ source_paths = [os.path.join(dir_path, 'tftestdata/images'),
 trans_dicts = [None, {'ids': 'ids1'}]
 
 
+def write_tfrecords(path, features, options=None):
+    """Write one tf.train.Example per dict of features to the TFRecords file path."""
+    writer = tf.python_io.TFRecordWriter(path, options=options)
+    for feature in features:
+        datum = tf.train.Example(features=tf.train.Features(feature=feature))
+        writer.write(datum.SerializeToString())
+    writer.close()
+
+
+def write_meta(directory, meta):
+    with open(os.path.join(directory, 'meta.pkl'), 'w') as f:
+        cPickle.dump(meta, f)
+
+
 def test_ops():
     """Tests the basic init_ops funcions.
     """
@@ -147,3 +163,274 @@ def test_item_selection():
         res = sess.run(inputs)
         assert_equal(res['ids'], res['ids1'])
         assert set(res.keys()) == set(['ids', 'ids1', 'means'])
+
+
+def test_postprocess_after_dequeue():
+    """Tests that when postprocessing is deferred until after the dequeue,
+    the queue holds the raw bytes and the data that comes out is unchanged.
+    """
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           postprocess_after_dequeue=True)
+    sess = tf.Session()
+    ops = dp.init_ops()
+    assert ops[0]['images'].dtype == tf.string
+    queue = b.get_queue(ops[0], queue_type='fifo')
+    enqueue_ops = []
+    for op in ops:
+        enqueue_ops.append(queue.enqueue_many(op))
+    tf.train.queue_runner.add_queue_runner(tf.train.queue_runner.QueueRunner(queue, enqueue_ops))
+    tf.train.start_queue_runners(sess=sess)
+    K = 31
+    inputs = dp.postprocess_batch(queue.dequeue_many(K))
+    N = 100
+    testlist = np.arange(K * N) % 1600
+    for i in range(N):
+        res = sess.run(inputs)
+        assert res['images'].shape == (K, 32, 32, 3)
+        assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+        assert_equal(res['ids'], testlist[K * i: K * (i+1)])
+
+
+def test_encoded_images(tmpdir):
+    """Tests that png-encoded image attributes declared in meta.pkl are decoded
+    by the standard postprocessing.
+    """
+    directory = str(tmpdir)
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(40, 8, 8, 3)).astype(np.uint8)
+    sess = tf.Session()
+    image = tf.placeholder(tf.uint8, shape=[8, 8, 3])
+    encoded = tf.image.encode_png(image)
+    pngs = [sess.run(encoded, feed_dict={image: im}) for im in images]
+    write_tfrecords(os.path.join(directory, '0.tfrecords'),
+                    [{'images': tf.train.Feature(bytes_list=tf.train.BytesList(value=[png]))}
+                     for png in pngs])
+    write_meta(directory, {'images': {'dtype': tf.uint8, 'shape': [8, 8, 3], 'format': 'png'}})
+
+    dp = d.TFRecordsParallelByFileProvider([directory],
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False)
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    res = [sess.run(ops[0]) for _ in range(2)]
+    assert_equal(np.concatenate([r['images'] for r in res]), images)
+
+
+def test_decoded_cache(tmpdir):
+    """Tests that the decoded records of the first epoch are cached, and that
+    providers built on a complete cache read the same data from it.
+    """
+    cache_dir = str(tmpdir)
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           decoded_cache_dir=cache_dir)
+    sess = tf.Session()
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    for i in range(100):
+        res = sess.run(ops[0])
+        assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+        assert_equal(res['ids'], res['ids1'])
+    assert dp.decoded_cache.complete
+    sess.close()
+
+    tf.reset_default_graph()
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           decoded_cache_dir=cache_dir)
+    assert dp.decoded_cache.complete
+    sess = tf.Session()
+    ops = dp.init_ops()
+    assert ops[0]['images'].get_shape().as_list() == [None, 32, 32, 3]
+    testlist = np.arange(20 * 100) % 1600
+    for i in range(100):
+        res = sess.run(ops[0])
+        assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+        assert_equal(res['ids'], testlist[20 * i: 20 * (i + 1)])
+    sess.close()
+
+
+def test_staging(tmpdir):
+    """Tests that with a staging directory the files are copied locally and
+    the data comes out in the same order as without.
+    """
+    staging_dir = str(tmpdir)
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           staging_dir=staging_dir)
+    sess = tf.Session()
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    ids = []
+    for i in range(200):
+        res = sess.run(ops[0])
+        assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+        assert_equal(res['ids'], res['ids1'])
+        ids.append(res['ids'])
+    sess.close()
+    # batches end at file boundaries, so compare the concatenated records
+    assert_equal(np.concatenate(ids)[:3200], np.arange(3200) % 1600)
+    assert len(dp.staging.files) == 2 * len(dp.source_paths[0])
+    for path, local in dp.staging.files.items():
+        assert os.path.getsize(local) == os.path.getsize(path)
+        assert dp.staging.source_of(local) == path
+
+
+def test_balanced_files():
+    """Tests the balanced assignment of files to threads, and that a provider
+    using it reads every record.
+    """
+    weights = [100, 1, 1, 1, 1, 1, 50, 50, 1, 1]
+    scheduler = d.BalancedFileScheduler(range(10), weights, 3)
+    assert [sum([weights[i] for i in p]) for p in scheduler.pending] == [100, 54, 53]
+    # thread 0 stays on its big file while the others take all the rest
+    assert scheduler.next(0) == 0
+    taken = [scheduler.next(1 + k % 2) for k in range(9)]
+    assert sorted(taken) == range(1, 10)
+    assert scheduler.epoch == 0
+    scheduler.next(0)
+    assert scheduler.epoch == 1
+
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=4,
+                                           batch_size=20,
+                                           shuffle=True,
+                                           balance=True)
+    sess = tf.Session()
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    ids = []
+    for i in range(100):
+        for res in sess.run(ops):
+            assert_allclose(res['images'].mean(1).mean(1).mean(1), res['means'], rtol=1e-05)
+            assert_equal(res['ids'], res['ids1'])
+            ids.append(res['ids'])
+    sess.close()
+    assert_equal(np.unique(np.concatenate(ids)), np.arange(1600))
+
+    # without manifests there are no record counts to balance by
+    try:
+        d.TFRecordsParallelByFileProvider(source_paths,
+                                          trans_dicts=trans_dicts,
+                                          n_threads=4,
+                                          balance='records')
+    except AssertionError:
+        pass
+    else:
+        assert False, 'balance="records" without manifests should fail'
+
+
+def test_readahead():
+    """Tests that reading ahead and dropping consumed files leaves the data unchanged.
+    """
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           readahead=1,
+                                           drop_consumed=True)
+    assert dp.readahead is not None
+    sess = tf.Session()
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    ids = []
+    for i in range(200):
+        res = sess.run(ops[0])
+        assert_equal(res['ids'], res['ids1'])
+        ids.append(res['ids'])
+    sess.close()
+    # batches end at file boundaries, so compare the concatenated records
+    assert_equal(np.concatenate(ids)[:3200], np.arange(3200) % 1600)
+
+
+def test_cache_aware_order():
+    """Tests the page-cache-aware epoch orders.
+    """
+    def take(itr, n):
+        return ''.join([itr.next() for _ in range(n)])
+
+    ls = list('abcdef')
+    sizes = [1] * 6
+    assert take(d.cache_aware_cycle(ls, sizes, 2, order='alternate'), 18) == 'abcdeffedcbaabcdef'
+    assert take(d.cache_aware_cycle(ls, sizes, 2, order='rotate'), 18) == 'abcdefefabcdcdefab'
+    itr = d.cache_aware_cycle(ls, sizes, 2, rng=np.random.RandomState(0))
+    first, second = take(itr, 6), take(itr, 6)
+    assert sorted(first) == sorted(second) == ls
+    assert set(second[:2]) == set(first[-2:])
+
+    dp = d.TFRecordsParallelByFileProvider(source_paths,
+                                           trans_dicts=trans_dicts,
+                                           n_threads=1,
+                                           batch_size=20,
+                                           shuffle=False,
+                                           epoch_order='alternate')
+    sess = tf.Session()
+    ops = dp.init_ops()
+    tf.train.start_queue_runners(sess=sess)
+    ids = np.concatenate([sess.run(ops[0])['ids'] for _ in range(170)])
+    sess.close()
+    assert_equal(ids[:1600], np.arange(1600))
+    # the second epoch reads the files backwards, starting with the last one
+    # (6.tfrecords, with ids 1312 to 1599, then 5.tfrecords with ids 1232 to 1311)
+    assert_equal(ids[1600: 1600 + 288], np.arange(1312, 1600))
+    assert_equal(ids[1600 + 288: 1600 + 368], np.arange(1232, 1312))
+
+
+def test_compressed(tmpdir):
+    """Tests reading GZIP-compressed files declared in meta.pkl, with and without
+    a manifest.
+    """
+    directory = str(tmpdir)
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP)
+    for k in range(2):
+        write_tfrecords(os.path.join(directory, '%d.tfrecords.gz' % k),
+                        [{'labels': tf.train.Feature(int64_list=tf.train.Int64List(value=[i]))}
+                         for i in range(30 * k, 30 * (k + 1))],
+                        options=options)
+    write_meta(directory, {'labels': {'dtype': tf.int64, 'shape': [], 'compression': 'GZIP'}})
+    # a partial shard being written, as by tfutils.convert
+    with open(os.path.join(directory, '2.tfrecords.tmp'), 'w') as f:
+        f.write('x')
+
+    # the default file pattern also matches the suffixed names of compressed files,
+    # also when building manifests, but not partial files
+    for file_pattern, build in [(d.DEFAULT_TFRECORDS_GLOB_PATTERN, False),
+                                ('*.tfrecords.gz', True),
+                                (d.DEFAULT_TFRECORDS_GLOB_PATTERN, True)]:
+        if build:
+            m = manifest.build_manifest(directory, file_pattern=file_pattern)
+            assert m['compression'] == 'GZIP'
+            assert [f['records'] for f in m['files']] == [30, 30]
+            manifest.write_manifest(directory, m)
+            assert not manifest.is_stale(directory, m)
+        tf.reset_default_graph()
+        dp = d.TFRecordsParallelByFileProvider([directory],
+                                               n_threads=1,
+                                               batch_size=20,
+                                               shuffle=False,
+                                               file_pattern=file_pattern)
+        assert dp.compressions == ['GZIP']
+        assert (dp.manifests is not None) == build
+        assert [os.path.basename(p) for p in dp.source_paths[0]] == ['0.tfrecords.gz', '1.tfrecords.gz']
+        sess = tf.Session()
+        ops = dp.init_ops()
+        tf.train.start_queue_runners(sess=sess)
+        labels = np.concatenate([sess.run(ops[0])['labels'] for _ in range(4)])
+        sess.close()
+        assert_equal(labels, np.arange(60))
@@ -0,0 +1,64 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+
+from tfutils import data
+from tfutils import manifest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+source_paths = [os.path.join(dir_path, 'tftestdata/images'),
+                os.path.join(dir_path, 'tftestdata/means')]
+trans_dicts = [None, {'ids': 'ids1'}]
+
+
+def test_manifest():
+    tmpdirs = []
+    for path in source_paths:
+        tmpdir = tempfile.mkdtemp()
+        for name in os.listdir(path):
+            shutil.copy(os.path.join(path, name), tmpdir)
+        m = manifest.build_manifest(tmpdir, checksums=True)
+        assert [f['name'] for f in m['files']] == sorted(
+            [n for n in os.listdir(path) if n.endswith('.tfrecords')])
+        assert sum([f['records'] for f in m['files']]) == 1600
+        assert m['meta'] == data.parse_standard_tfmeta([path])[0]
+        manifest.write_manifest(tmpdir, m)
+        assert manifest.load_manifest(tmpdir) == m
+        assert manifest.load_manifest(tmpdir, '*.tf') is None
+        assert manifest.verify_manifest(tmpdir, m, checksums=True) == []
+        tmpdirs.append(tmpdir)
+
+    dp = data.TFRecordsParallelByFileProvider(tmpdirs,
+                                              trans_dicts=trans_dicts,
+                                              n_threads=1,
+                                              batch_size=20,
+                                              shuffle=False)
+    assert dp.manifests is not None
+    assert dp.num_records == 1600
+    assert dp.total_batches == 80
+    assert sum(dp.file_bytes) == sum([f['bytes'] for m in dp.manifests for f in m['files']])
+    ops = dp.init_ops()
+    sess = tf.Session()
+    tf.train.start_queue_runners(sess=sess)
+    res = sess.run(ops[0])
+    assert (res['ids'] == res['ids1']).all()
+    sess.close()
+
+    # manifests no longer listing the files of their directory are not used
+    shutil.copy(os.path.join(tmpdirs[0], '0.tfrecords'), os.path.join(tmpdirs[0], '7.tfrecords'))
+    assert manifest.is_stale(tmpdirs[0], manifest.load_manifest(tmpdirs[0]))
+    assert not manifest.is_stale(tmpdirs[1], manifest.load_manifest(tmpdirs[1]))
+    assert data.get_manifests(tmpdirs) is None
+    os.remove(os.path.join(tmpdirs[0], '7.tfrecords'))
+    assert data.get_manifests(tmpdirs) is not None
+
+    with open(os.path.join(tmpdirs[0], '0.tfrecords'), 'a') as f:
+        f.write('x')
+    m = manifest.load_manifest(tmpdirs[0])
+    assert manifest.verify_manifest(tmpdirs[0], m) == [os.path.join(tmpdirs[0], '0.tfrecords')]
+    for tmpdir in tmpdirs:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,42 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import tempfile
+
+from numpy.testing import assert_equal
+import numpy as np
+import h5py
+
+from tfutils import data
+from tfutils import rechunk
+
+
+def test_rechunk():
+    total_size = 1000
+    src = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False).name
+    dst = tempfile.NamedTemporaryFile(suffix='.hdf5', dir='/tmp', delete=False).name
+    with h5py.File(src, 'w') as f:
+        f.create_dataset('data', (total_size, 4, 5), dtype=np.float32, chunks=(7, 4, 5))
+        f['data'][:] = np.random.randn(total_size, 4, 5)
+        f['group/inds'] = np.arange(total_size)
+
+    report = rechunk.rechunk_hdf5(src, dst, batch_size=100, compression='lzf')
+    before, after = report['data']
+    assert before['chunks_per_batch'] > after['chunks_per_batch'] == 1
+    assert after['amplification'] == 1
+
+    with h5py.File(src, 'r') as f, h5py.File(dst, 'r') as g:
+        assert g['data'].chunks == (100, 4, 5)
+        assert_equal(f['data'][:], g['data'][:])
+
+    dp = data.HDF5DataReader(dst, ['data', 'group/inds'], batch_size=100)
+    assert_equal(dp.get_next_batch()['group/inds'], np.arange(100))
+    dp.close()
+    os.remove(src)
+    os.remove(dst)
+
+
+def test_chunk_rows():
+    assert rechunk.get_chunk_rows(10, 256) == 256
+    assert rechunk.get_chunk_rows(10, 256, max_chunk_bytes=1000) == 64
+    assert rechunk.get_chunk_rows(10, 100, max_chunk_bytes=1) == 1